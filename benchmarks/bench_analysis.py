@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+'''
+Bulk header decoding benchmark.
+
+Writes a synthetic DLT_NULL/IPv4/UDP pcap with COUNT Confundo datagrams (data segments
+and SACK ACKs), then decodes it with confundo.analysis.read_pcap() and, for comparison,
+walks the same capture one record and one Header.decode() call at a time.  Needs numpy.
+
+    python3 benchmarks/bench_analysis.py --count 1000000
+'''
+
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from confundo.analysis import read_pcap, retransmissions, goodput
+from confundo.common import PAYLOAD_SIZE
+from confundo.header import Header
+from confundo.util import incSeqNum
+
+
+def make_datagrams(count):
+    payload = os.urandom(PAYLOAD_SIZE)
+    seq = 50000
+    for i in range(count):
+        if i % 2 == 0:
+            yield 5001, 5000, Header(seq, 0, 1).encode() + payload
+            seq = incSeqNum(seq, PAYLOAD_SIZE)
+        else:
+            yield 5000, 5001, Header(1, seq, 1, True, sack_blocks=[(1, 2), (3, 4)]).encode()
+
+
+def write_pcap(path, datagrams):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<I H H i I I I', 0xa1b2c3d4, 2, 4, 0, 0, 0x40000, 0))
+        for i, (src, dst, data) in enumerate(datagrams):
+            udp = struct.pack('!H H H H', src, dst, 8 + len(data), 0)
+            ip = struct.pack('!B B H H H B B H 4s 4s', 0x45, 0, 28 + len(data), 0, 0, 64, 17, 0,
+                             b'\x7f\x00\x00\x01', b'\x7f\x00\x00\x01')
+            frame = struct.pack('<I', 2) + ip + udp + data
+            f.write(struct.pack('<I I I I', i // 1000000, i % 1000000, len(frame), len(frame)))
+            f.write(frame)
+
+
+def run_per_packet(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    rows = []
+    offset = 24
+    while offset < len(data):
+        sec, usec, capLen, _ = struct.unpack_from('<I I I I', data, offset)
+        frame = data[offset + 16:offset + 16 + capLen]
+        offset += 16 + capLen
+        header = Header.decode(frame[4 + 20 + 8:])
+        rows.append((sec + usec * 1e-6, header.sequence_number, header.acknowledgment_number,
+                     header.connection_id, header.flags(), capLen - 32 - header.header_length))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confundo bulk header decoding benchmark")
+    parser.add_argument("--count", type=int, default=1000000, help="datagrams in the synthetic capture")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.pcap')
+        write_pcap(path, make_datagrams(args.count))
+
+        print(f"{'impl':>14} {'seconds':>10} {'us/pkt':>10}")
+        start = time.perf_counter()
+        packets = read_pcap(path)
+        retransmissions(packets)
+        goodput(packets)
+        seconds = time.perf_counter() - start
+        assert len(packets) == args.count
+        print(f"{'read_pcap':>14} {seconds:>10.3f} {seconds / args.count * 1e6:>10.2f}")
+
+        start = time.perf_counter()
+        run_per_packet(path)
+        seconds = time.perf_counter() - start
+        print(f"{'Header.decode':>14} {seconds:>10.3f} {seconds / args.count * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+'''
+Loopback datagram rate of confundo.batchio.
+
+A sender pushes PAYLOAD_SIZE + 12 byte datagrams to a receiver on 127.0.0.1 in windows
+of `--window` datagrams, the way Socket.send releases a congestion window, and the
+receiver drains them.  Compares plain sendto/recvfrom, BatchIO with its one-call-per-
+datagram fallback and BatchIO with sendmmsg/recvmmsg.
+
+    python3 benchmarks/bench_batchio.py --count 200000 --window 32
+'''
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from confundo.batchio import BatchIO
+from confundo.common import PAYLOAD_SIZE
+
+DATAGRAM = b"\0" * (PAYLOAD_SIZE + 12)
+
+
+class PlainIO:
+    def __init__(self, sock):
+        self.sock = sock
+
+    def sendto(self, data, addr):
+        self.sock.sendto(data, addr)
+
+    def flush(self):
+        pass
+
+    def recvfrom(self):
+        return self.sock.recvfrom(PAYLOAD_SIZE + 12)
+
+
+def run(makeIO, count, window):
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    rx.bind(("127.0.0.1", 0))
+    rx.settimeout(0.5)
+    txIO, rxIO = makeIO(tx), makeIO(rx)
+    addr = rx.getsockname()
+
+    received = 0
+    start = time.perf_counter()
+    for _ in range(count // window):
+        for _ in range(window):
+            txIO.sendto(DATAGRAM, addr)
+        txIO.flush()
+        for _ in range(window):
+            try:
+                rxIO.recvfrom()
+            except socket.timeout:
+                break
+            received += 1
+    seconds = time.perf_counter() - start
+    tx.close()
+    rx.close()
+    return seconds, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confundo batched datagram I/O benchmark")
+    parser.add_argument("--count", type=int, default=200000, help="datagrams to send")
+    parser.add_argument("--window", type=int, default=32, help="datagrams sent before draining the receiver")
+    args = parser.parse_args()
+
+    impls = [
+        ("sendto", PlainIO),
+        ("fallback", lambda sock: BatchIO(sock, useMmsg=False)),
+        ("mmsg", BatchIO),
+    ]
+    print(f"{'impl':>10} {'seconds':>10} {'received':>10} {'dgram/s':>12}")
+    for name, makeIO in impls:
+        seconds, received = run(makeIO, args.count, args.window)
+        print(f"{name:>10} {seconds:>10.3f} {received:>10} {received / seconds:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+'''
+Large-transfer benchmark for the Socket send/receive buffers.
+
+Replays the buffer operations of a transfer (MTU segments served from the send
+buffer, cumulative ACKs releasing it, in-order payloads queued and read by the
+application) for growing sizes, and compares confundo.buffer against the former
+bytes slicing/concatenation.  Linear scaling shows up as a constant time per MB.
+
+    python3 benchmarks/bench_buffers.py --sizes 1 4 16 64
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from confundo.buffer import SendBuffer, RecvBuffer
+from confundo.common import MTU
+
+WINDOW = 12000
+READ_SIZE = 4096
+
+
+def run_buffers(data):
+    outBuffer = SendBuffer()
+    inBuffer = RecvBuffer()
+    outBuffer.append(data)
+    while len(outBuffer) > 0:
+        dataS = 0
+        while dataS < WINDOW:
+            toSend = outBuffer.peek(dataS, MTU)
+            if len(toSend) == 0:
+                break
+            inBuffer.append(toSend)
+            dataS += len(toSend)
+        outBuffer.advance(dataS)
+        while len(inBuffer) > 0:
+            inBuffer.read(READ_SIZE)
+
+
+def run_bytes(data):
+    outBuffer = b""
+    inBuffer = b""
+    outBuffer += data
+    while len(outBuffer) > 0:
+        dataS = 0
+        while dataS < WINDOW:
+            toSend = outBuffer[dataS:dataS + MTU]
+            if len(toSend) == 0:
+                break
+            inBuffer += toSend
+            dataS += len(toSend)
+        outBuffer = outBuffer[dataS:]
+        while len(inBuffer) > 0:
+            inBuffer = inBuffer[READ_SIZE:]
+
+
+def measure(func, size):
+    data = os.urandom(size)
+    start = time.perf_counter()
+    func(data)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confundo send/receive buffer scaling benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16, 64], help="transfer sizes in MB")
+    parser.add_argument("--bytes-max", type=int, default=16,
+                        help="largest size (MB) to run with the bytes baseline, which is quadratic")
+    args = parser.parse_args()
+
+    print(f"{'MB':>6} {'impl':>8} {'seconds':>10} {'s/MB':>10}")
+    perMb = []
+    for mb in args.sizes:
+        seconds = measure(run_buffers, mb * 1024 * 1024)
+        perMb.append(seconds / mb)
+        print(f"{mb:>6} {'buffer':>8} {seconds:>10.3f} {seconds / mb:>10.4f}")
+        if mb <= args.bytes_max:
+            seconds = measure(run_bytes, mb * 1024 * 1024)
+            print(f"{mb:>6} {'bytes':>8} {seconds:>10.3f} {seconds / mb:>10.4f}")
+
+    print(f"buffer s/MB growth from {args.sizes[0]} MB to {args.sizes[-1]} MB: {perMb[-1] / perMb[0]:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+'''
+Header codec micro-benchmark.
+
+Builds, encodes and decodes Packet objects for data segments (12-byte header +
+PAYLOAD_SIZE payload) and SACK ACKs the way the send and receive paths do, once with
+encode_into() a reusable buffer and once with encode(), which allocates the datagram.
+The last row is the bare struct.pack/unpack format-string work the codec replaced,
+without any Packet objects, as a floor for the per-object overhead.
+
+    python3 benchmarks/bench_codec.py --count 200000
+'''
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from confundo.common import PAYLOAD_SIZE
+from confundo.packet import Packet
+
+PAYLOAD = memoryview(os.urandom(PAYLOAD_SIZE))
+
+
+def run_codec(count):
+    buf = bytearray(2048)
+    pkt = Packet()
+    for seq in range(count):
+        size = Packet(seqNum=seq, connId=1, payload=PAYLOAD).encode_into(buf)
+        pkt.decode(bytes(buf[:size]))
+        size = Packet(ackNum=seq, connId=1, isAck=True, sackBlocks=[(1, 2), (3, 4)]).encode_into(buf)
+        pkt.decode(bytes(buf[:size]))
+
+
+def run_encode(count):
+    pkt = Packet()
+    for seq in range(count):
+        pkt.decode(Packet(seqNum=seq, connId=1, payload=PAYLOAD).encode())
+        pkt.decode(Packet(ackNum=seq, connId=1, isAck=True, sackBlocks=[(1, 2), (3, 4)]).encode())
+
+
+def run_format_strings(count):
+    for seq in range(count):
+        data = struct.pack('!I I H H', seq, 0, 1, 0) + bytes(PAYLOAD)
+        struct.unpack('!I I H H', data[:12])
+        payload = data[12:]
+        options = struct.pack('!B B', 2, 18) + struct.pack('!I I', 1, 2) + struct.pack('!I I', 3, 4)
+        data = struct.pack('!I I H H', 0, seq, 1, 12) + struct.pack('!B', len(options)) + options
+        struct.unpack('!I I H H', data[:12])
+        [struct.unpack('!I I', data[j:j + 8]) for j in range(15, len(data) - 7, 8)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confundo header codec benchmark")
+    parser.add_argument("--count", type=int, default=200000, help="data segments and ACKs to encode and decode")
+    args = parser.parse_args()
+
+    print(f"{'impl':>14} {'seconds':>10} {'us/pkt':>10}")
+    for name, func in [("encode_into", run_codec), ("encode", run_encode),
+                       ("format-string", run_format_strings)]:
+        start = time.perf_counter()
+        func(args.count)
+        seconds = time.perf_counter() - start
+        print(f"{name:>14} {seconds:>10.3f} {seconds / (2 * args.count) * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+'''
+Packet tracing benchmark.
+
+Reports COUNT SEND events the way Socket._send does (check the level, then trace the
+packet) to each kind of tracer and prints the time per event: the former print() of
+format_line(), TextTracer, RingTracer recording binary records that a background thread
+drains to a file, and the disabled Tracer.  Text goes to a temporary file, so the
+numbers leave out the cost of a terminal.
+
+    python3 benchmarks/bench_trace.py --count 1000000
+'''
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from confundo.packet import Packet
+from confundo.trace import SEND, RingTracer, TextTracer, Tracer
+from confundo.util import format_line
+
+
+def run_print(packets, out):
+    with contextlib.redirect_stdout(out):
+        for packet in packets:
+            print(format_line("SEND", packet, 12000.5, 24000))
+
+
+def run_tracer(packets, tracer):
+    for packet in packets:
+        if tracer.packets:
+            tracer.packet(SEND, packet, 12000.5, 24000, packet.isDup)
+    tracer.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confundo packet tracing benchmark")
+    parser.add_argument("--count", type=int, default=1000000, help="events traced per tracer")
+    args = parser.parse_args()
+
+    packets = [Packet(seqNum=i % 50001, ackNum=1, connId=1, isAck=True, isDup=i % 10 == 0) for i in range(1000)]
+    packets = packets * (args.count // len(packets))
+    count = len(packets)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'impl':>10} {'seconds':>10} {'us/event':>10}")
+        with open(os.path.join(tmp, 'print.txt'), 'w') as out:
+            start = time.perf_counter()
+            run_print(packets, out)
+            seconds = time.perf_counter() - start
+        print(f"{'print':>10} {seconds:>10.3f} {seconds / count * 1e6:>10.2f}")
+
+        with open(os.path.join(tmp, 'text.txt'), 'w') as out:
+            start = time.perf_counter()
+            run_tracer(packets, TextTracer(stream=out))
+            seconds = time.perf_counter() - start
+        print(f"{'text':>10} {seconds:>10.3f} {seconds / count * 1e6:>10.2f}")
+
+        with open(os.path.join(tmp, 'ring.ctr'), 'wb') as out:
+            tracer = RingTracer(out, capacity=count) # nothing lost, whatever the drain thread's pace
+            start = time.perf_counter()
+            run_tracer(packets, tracer)
+            seconds = time.perf_counter() - start
+            tracer.close()
+            assert tracer.lost == 0
+        print(f"{'ring':>10} {seconds:>10.3f} {seconds / count * 1e6:>10.2f}")
+
+        start = time.perf_counter()
+        run_tracer(packets, Tracer())
+        seconds = time.perf_counter() - start
+        print(f"{'off':>10} {seconds:>10.3f} {seconds / count * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+'''
+End-to-end transfer benchmark over emulated links.
+
+Sends files of each `--sizes` (MB) over each `--profiles` link of confundo.netem, with each
+`--impl`:
+
+* client: client.py to server.py, each in a process of its own;
+* socket: confundo.Socket.send() to a confundo.Socket reading with recv(), in two threads.
+
+Each run reports the completion time (from the first SYN to the first FIN crossing the link,
+i.e. handshake and data until the last byte is acknowledged), the goodput, the
+retransmission overhead (payload bytes the sender put on the link beyond the file size, as a
+fraction of it), and the CPU time of both endpoints per MB (for `client` it includes the start
+of two interpreters, which dominates small files).  Impairments are seeded, so a profile
+drops, duplicates and reorders the same datagrams of the same sequence on every run.
+
+    python3 benchmarks/bench_transfer.py --sizes 0.1 1 4 --profiles lan wan lossy --json results.json
+
+`--json` writes the runs with the options and the environment, for tracking regressions
+across commits.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from confundo import Socket
+from confundo.metrics import Registry
+from confundo.netem import PROFILES, LinkEmulator
+from confundo.trace import Tracer
+
+READ_SIZE = 1 << 16
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_client(path, profile, seed, cc):
+    '''client.py to server.py through the link, returns (CPU seconds, data received intact, link)'''
+    with tempfile.TemporaryDirectory() as out:
+        port = free_port()
+        cpu = children_cpu()
+        server = subprocess.Popen([sys.executable, "-u", os.path.join(ROOT, "server.py"), str(port), out, "--trace", "off"],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            server.stdout.readline() # "Server listening on ...": the port is bound
+            with LinkEmulator(("127.0.0.1", port), PROFILES[profile], seed=seed, registry=Registry()) as link:
+                client = subprocess.run([sys.executable, os.path.join(ROOT, "client.py"), "127.0.0.1",
+                                         str(link.address[1]), path, "--cc", cc, "--trace", "off"],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        cpu = children_cpu() - cpu
+        if client.returncode != 0:
+            sys.stderr.write(client.stderr)
+        received = os.path.join(out, "1.file")
+        ok = client.returncode == 0 and os.path.exists(received) and digest(received) == digest(path)
+    return cpu, ok, link
+
+
+def run_socket(path, profile, seed, cc):
+    '''Socket.send() to Socket.recv() through the link, returns (CPU seconds, data received intact, link)'''
+    registry = Registry()
+    with open(path, 'rb') as f:
+        data = f.read()
+    listener = Socket(tracer=Tracer(), registry=registry)
+    listener.bind(("127.0.0.1", 0))
+    port = listener.sock.getsockname()[1]
+    cpu = [0.0, 0.0]
+    received = hashlib.md5()
+
+    def receive():
+        start = time.thread_time()
+        with listener:
+            conn = listener.accept()
+            while True:
+                chunk = conn.recv(READ_SIZE)
+                if chunk is None:
+                    break
+                received.update(chunk)
+            conn.close()
+        cpu[1] = time.thread_time() - start
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    with LinkEmulator(("127.0.0.1", port), PROFILES[profile], seed=seed, registry=registry) as link:
+        start = time.thread_time()
+        with Socket(ccAlgorithm=cc, tracer=Tracer(), registry=registry) as sender:
+            sender.connect(link.address)
+            sender.send(data)
+        cpu[0] = time.thread_time() - start
+        receiver.join()
+    return sum(cpu), received.digest() == hashlib.md5(data).digest(), link
+
+
+IMPLS = {'client': run_client, 'socket': run_socket}
+
+
+def digest(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confundo transfer benchmark over emulated links")
+    parser.add_argument("--sizes", type=float, nargs='+', default=[0.1, 1, 4], help="file sizes (MB)")
+    parser.add_argument("--profiles", choices=sorted(PROFILES), nargs='+', default=['loopback', 'lan', 'wan', 'lossy'],
+                        help="links from confundo.netem.PROFILES")
+    parser.add_argument("--impl", choices=sorted(IMPLS), nargs='+', default=['client', 'socket'],
+                        help="sender and receiver implementations")
+    parser.add_argument("--cc", default="reno", help="congestion control algorithm of the sender")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each combination")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the link impairments")
+    parser.add_argument("--json", default=None, metavar="PATH", help="write the results as JSON to PATH ('-': stdout)")
+    args = parser.parse_args()
+
+    results = []
+    out = sys.stderr if args.json == '-' else sys.stdout
+    print(f"{'impl':>7} {'profile':>9} {'MB':>6} {'seconds':>8} {'MB/s':>7} {'retx %':>7} {'CPU s/MB':>9} {'ok':>3}",
+          file=out)
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f"{size}.bin")
+            with open(path, 'wb') as f:
+                f.write(os.urandom(int(size * 1e6)))
+            nbytes = os.path.getsize(path)
+            for impl in args.impl:
+                for profile in args.profiles:
+                    for run in range(args.repeat):
+                        cpu, ok, link = IMPLS[impl](path, profile, args.seed, args.cc)
+                        forward = link.forward
+                        seconds = (forward.firstFin - forward.first) if forward.firstFin is not None else None
+                        result = {
+                            'impl': impl,
+                            'profile': profile,
+                            'size': nbytes,
+                            'run': run,
+                            'ok': ok,
+                            'seconds': seconds,
+                            'goodput': nbytes / seconds if seconds else None,
+                            'retransmit_overhead': forward.payloadBytes.value / nbytes - 1,
+                            'cpu_seconds': cpu,
+                            'cpu_per_mb': cpu / (nbytes / 1e6),
+                            'link': link.snapshot(),
+                        }
+                        results.append(result)
+                        print(f"{impl:>7} {profile:>9} {nbytes / 1e6:>6.2f} "
+                              f"{seconds if seconds is not None else float('nan'):>8.3f} "
+                              f"{(result['goodput'] or 0) / 1e6:>7.3f} {result['retransmit_overhead'] * 100:>7.2f} "
+                              f"{result['cpu_per_mb']:>9.3f} {'yes' if ok else 'NO':>3}", file=out)
+
+    if args.json is not None:
+        report = {
+            'benchmark': 'transfer',
+            'time': time.time(),
+            'options': vars(args),
+            'environment': {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+                            'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,140 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import multiprocessing
+import os
 import sys
 import socket
 import time
+from collections import deque
 from confundo.header import Header
-from confundo.common import DEFAULT_TIMEOUT, FIN_WAIT_TIMEOUT, MAX_SEQNO
+from confundo.sack import Scoreboard
+from confundo.rtt import RttEstimator
+from confundo.recovery import LossRecovery
+from confundo.cwnd_control import ALGORITHMS, make_cwnd_control
+from confundo.pacing import Pacer
+from confundo.pmtud import PathMtu, agreedMss, checkMss, dontFragment
+from confundo.batchio import BatchIO
+from confundo.buffer import mapFile
+from confundo.session import sessionChunks, sessionFiles
+from confundo.stripe import stripeChunks, stripeRanges
+from confundo.util import EXT_MOD
+from confundo.trace import LEVELS, RECV, SEND, TextTracer, makeTracer
+from confundo.common import DEFAULT_TIMEOUT, EXT_MAX_FLIGHT, FIN_WAIT_TIMEOUT, MAX_MSS, MAX_SEQNO, \
+    MTU, RETRANSMISSION_TIMEOUT
 
 
 class ConfundoClient:
 
-    def __init__(self, server_ip, server_port, filename):
+    def __init__(self, server_ip, server_port, filename, sack=True, cc_algorithm="reno", pacing=True, max_rate=None,
+                 use_mmap=True, extended_seq=True, tracer=None, mss=MAX_MSS, probe_mss=False, session_files=None,
+                 stripe=None):
         self.server_ip = server_ip
         self.server_port = server_port
         self.filename = filename
+        self.session_files = session_files  # (path, name) of each file to send as one session instead of `filename`
+        self.stripe = stripe  # (transfer, offset, length) of the range of `filename` to send as one stripe of it
+        self.use_mmap = use_mmap  # slice segments from a memory mapping of the file instead of reading copies
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(DEFAULT_TIMEOUT)
+        self.io = BatchIO(self.sock)  # sends are queued and flushed in batches before every blocking receive
+        self.tracer = tracer if tracer is not None else TextTracer()  # SEND/RECV lines on stdout by default
 
-        self.cwnd = 412
-        self.ss_thresh = 12000
+        self.cc = make_cwnd_control(cc_algorithm)  # same congestion controllers as confundo.Socket
         self.conn_id = 0
         self.seq_number = 50000
         self.ack_num = 0
         self.last_sent_data = None
+        self.sack = sack  # requested in the SYN, then whether the server agreed to use SACK
+        self.extended_seq = extended_seq  # same for 32-bit sequence numbers
+        self.seq_mod = MAX_SEQNO + 1  # size of the sequence space, 2**32 once extended sequence numbers are agreed
+        self.max_flight = MAX_SEQNO // 2  # keeps sequence numbers in flight unambiguous
+        self.scoreboard = Scoreboard()
+        self.rtt = RttEstimator(RETRANSMISSION_TIMEOUT)  # retransmission timeout follows the measured RTT
+        self.rwnd = None  # receive window advertised by the server, None if it does not advertise one
+        self.pacer = Pacer(pacing, max_rate)  # spreads each window over the RTT, max_rate caps it (bytes/s)
+        self.mss = checkMss(mss)  # largest segment offered in the SYN
+        self.pmtu = PathMtu(MTU, probe_mss)  # segment size, agreed in the handshake (and probed with probe_mss)
+        self.segment_size = MTU  # size of the next segment taken from the file
+        self.recovery = LossRecovery(self.cc, self.rtt, self.pmtu, resized=self.segment_size_changed)
+        if probe_mss:
+            dontFragment(self.sock)
 
-    def update_cwnd(self):
-        if self.cwnd < self.ss_thresh:
-            self.cwnd *= 2
-        else:
-            self.cwnd += 412  # Increment linearly in the congestion avoidance phase
+    def sample_rtt(self, ack_number):
+        rtt = self.rtt.on_ack(ack_number)
+        if rtt is not None:
+            self.cc.on_rtt_sample(rtt, self.rtt.srtt)
 
-    def send_packet(self, syn=False, ack=False, fin=False, payload=b''):
-        header = Header(self.seq_number, 0, self.conn_id, ack, syn, fin)
-        packet = header.encode() + payload
-        self.sock.sendto(packet, (self.server_ip, self.server_port))
+    def send_packet(self, syn=False, ack=False, fin=False, payload=b'', seq_number=None, dup=False, sack_permitted=False):
+        if seq_number is None:
+            seq_number = self.seq_number
+        header = Header(seq_number, self.ack_num, self.conn_id, ack, syn, fin, sack_permitted,
+                        extended_seq=syn and self.extended_seq, mss=self.mss if syn else None,
+                        session=syn and self.session_files is not None, stripe=syn and self.stripe is not None)
+        self.io.sendPacket(header, self.server_address, payload)
         self.last_sent_data = (header, payload)  # Store the last sent data for potential retransmission
-        print_msg = f"SEND {self.seq_number} {header.acknowledgment_number} {self.conn_id} {self.cwnd} {self.ss_thresh}"
-        flags = [flag for flag, is_set in [("ACK", ack), ("SYN", syn), ("FIN", fin), ("DUP", False)] if is_set]
-        print(f"{print_msg} {' '.join(flags)}")
+        if self.tracer.packets:
+            self.tracer.packet(SEND, header, self.cc.cwnd, self.cc.ssthresh, dup)
 
-    def recv_packet(self):
+    def recv_packet(self, retransmit=True):
         try:
-            data, _ = self.sock.recvfrom(424)
-            header = Header.decode(data[:12])
-            print_msg = f"RECV {header.sequence_number} {header.acknowledgment_number} {header.connection_id} {self.cwnd} {self.ss_thresh}"
-            flags = [flag for flag, is_set in [("ACK", header.ack), ("SYN", header.syn), ("FIN", header.fin), ("DUP", False)] if is_set]
-            print(f"{print_msg} {' '.join(flags)}")
-            return header, data[12:]
+            data, _ = self.io.recvfrom()
+            header = Header()
+            header_length = header.decode_from(data)
+            if header.ack and header.window is not None:
+                self.rwnd = header.window
+            if self.tracer.packets:
+                self.tracer.packet(RECV, header, self.cc.cwnd, self.cc.ssthresh)
+            return header, memoryview(data)[header_length:]
         except socket.timeout:
             # Handle the retransmission logic here
-            if self.last_sent_data:
+            if retransmit and self.last_sent_data:
                 header, payload = self.last_sent_data
-                self.send_packet(syn=header.syn, ack=header.ack, fin=header.fin, payload=payload)
+                self.send_packet(syn=header.syn, ack=header.ack, fin=header.fin, payload=payload,
+                                 sack_permitted=header.sack_permitted)
             raise
 
     def connect(self):
+        # resolve the server once: every datagram goes to the same address
+        remote = socket.getaddrinfo(self.server_ip, self.server_port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.server_address = remote[0][4]
         try:
-            # Step 1: SYN
-            self.send_packet(syn=True)
+            # Step 1: SYN, retransmitted with exponential backoff until the server answers
+            self.send_packet(syn=True, sack_permitted=self.sack)
+            self.rtt.start((self.seq_number + 1) % self.seq_mod)
 
             # Step 2: Wait for SYN|ACK
-            header, _ = self.recv_packet()
+            deadline = time.time() + DEFAULT_TIMEOUT
+            while True:
+                self.sock.settimeout(self.rtt.rto)
+                try:
+                    header, _ = self.recv_packet(retransmit=False)
+                    break
+                except socket.timeout:
+                    if time.time() > deadline:
+                        raise
+                    self.rtt.on_timeout()
+                    self.send_packet(syn=True, sack_permitted=self.sack, dup=True)
+            if header.syn and header.ack and self.session_files is not None and not header.session:
+                sys.stderr.write("ERROR: The server does not support sessions of several files.\n")
+                sys.exit(1)
+            if header.syn and header.ack and self.stripe is not None and not header.stripe:
+                sys.stderr.write("ERROR: The server does not support striped transfers.\n")
+                sys.exit(1)
             if header.syn and header.ack:
+                self.sample_rtt(header.acknowledgment_number)
                 self.conn_id = header.connection_id
-                self.seq_number += 1  # Increment sequence number
+                self.sack = self.sack and header.sack_permitted
+                self.extended_seq = self.extended_seq and header.extended_seq
+                if self.extended_seq:
+                    self.seq_mod = self.rtt.mod = self.scoreboard.mod = EXT_MOD
+                    self.max_flight = EXT_MAX_FLIGHT
+                # segments are at most the smaller of both offers, MTU for a server that makes none
+                self.pmtu.setMaximum(agreedMss(self.mss, header.mss))
+                self.segment_size_changed()
+                self.ack_num = (header.sequence_number + 1) % self.seq_mod
+                self.update_sequence_number(1)  # Increment sequence number
                 self.send_packet(ack=True)  # Send an ACK packet, not another SYN
             else:
                 sys.stderr.write("ERROR: Unexpected server response during handshake.\n")
@@ -73,30 +144,261 @@ class ConfundoClient:
             sys.exit(1)
 
     def update_sequence_number(self, increment_by=1):
-        self.seq_number = (self.seq_number + increment_by) % (MAX_SEQNO + 1)
+        self.seq_number = (self.seq_number + increment_by) % self.seq_mod
+
+    def segment_size_changed(self):
+        self.cc.set_mss(self.pmtu.size)
+        self.pacer.setSegmentSize(self.pmtu.size)
+
+    def segments(self, file):
+        '''
+        The file as segments of self.segment_size bytes, as it is when each segment is taken (the
+        last one of a mapping may be shorter).  With use_mmap (and a regular file) they are
+        memoryview slices of mappings made by confundo.buffer.mapFile, so neither the first
+        transmission nor a retransmission copies the data; otherwise each segment is a file.read().
+        '''
+        if self.use_mmap and os.path.isfile(self.filename):
+            for chunk in mapFile(file):
+                offset = 0
+                while offset < len(chunk):
+                    size = self.segment_size
+                    yield chunk[offset:offset + size]
+                    offset += size
+            return
+        while True:
+            data = file.read(self.segment_size)
+            if not data:
+                return
+            yield data
+
+    def data_segments(self):
+        '''
+        The segments to send: those of the file, or the frames of every file of the session, or
+        the stripe header and the range of the file, packed back to back
+        '''
+        if self.session_files is not None:
+            yield from self.pack(sessionChunks(self.session_files, self.use_mmap))
+        elif self.stripe is not None:
+            yield from self.pack(stripeChunks(self.filename, os.path.basename(self.filename), *self.stripe,
+                                              useMmap=self.use_mmap))
+        else:
+            with open(self.filename, 'rb') as file:
+                yield from self.segments(file)
+
+    def pack(self, chunks):
+        '''`chunks` as segments of self.segment_size bytes, each a slice of a chunk where it fits in one'''
+        pending = None  # segment spanning two chunks, the only case that needs a copy
+        for chunk in chunks:
+            chunk = memoryview(chunk)
+            offset = 0
+            while offset < len(chunk):
+                size = self.segment_size
+                if pending is not None:
+                    piece = chunk[offset:offset + max(size - len(pending), 0)]
+                    pending += piece
+                    offset += len(piece)
+                    if len(pending) >= size:
+                        yield bytes(pending)
+                        pending = None
+                elif len(chunk) - offset >= size:
+                    yield chunk[offset:offset + size]
+                    offset += size
+                else:
+                    pending = bytearray(chunk[offset:])
+                    offset = len(chunk)
+        if pending:
+            yield bytes(pending)
+
+    def resegment(self, window, *counts):
+        '''
+        Split the segments of `window` larger than the segment size (a lost path MTU probe, or
+        what was sent before a black hole sent the size back down) into pieces the path carries.
+        Returns `counts`, numbers of segments at the start of the window, counted in the new ones.
+        '''
+        size = self.pmtu.size
+        if all(len(data) <= size for _, data in window):
+            return counts
+        pieces = []
+        index = []  # new index of each old segment
+        for seq_number, data in window:
+            index.append(len(pieces))
+            for offset in range(0, len(data), size):
+                pieces.append(((seq_number + offset) % self.seq_mod, data[offset:offset + size]))
+        index.append(len(pieces))
+        window.clear()
+        window.extend(pieces)
+        return tuple(index[count] for count in counts)
 
     def send_file(self):
-        with open(self.filename, 'rb') as file:
+        '''
+        Pipelined sender: keeps up to cwnd bytes of segments of self.pmtu.size in flight.
+
+        `window` holds every segment read from the file that is not yet cumulatively ACKed,
+        oldest first; the first `n_sent` of them have been sent since the last timeout.  On
+        timeout the sender goes back to the lowest unacknowledged segment and resends from
+        there, skipping segments the server reported in SACK blocks.  DUP_ACK_THRESHOLD duplicate
+        ACKs resend the lowest unacknowledged segment right away and start NewReno fast recovery,
+        which lasts until everything sent before it is ACKed.  The retransmission timer runs for
+        self.rtt.rto since the last progress (or retransmission) regardless of other arrivals.
+        New segments are released no faster than self.pacer allows, and never beyond the receive
+        window the server advertises.  While that window is closed, the retransmission timer
+        resends the first segment as a window probe instead of backing off the congestion window.
+        With path MTU probing a new segment is now and then a probe of the next larger size;
+        a lost probe is split up before it is retransmitted.
+        '''
+        window = deque()  # (seq_number, payload) pairs
+        window_bytes = 0
+        n_sent = 0
+        sent_offset = 0  # offset of window[n_sent] from the start of the window
+        n_ever_sent = 0  # segments below this index are retransmissions
+        probe = False  # the server's window is closed: send the first segment anyway
+        eof = False
+        last_progress = timer_start = time.time()
+        self.scoreboard.clear()
+        self.recovery.reset()
+
+        with contextlib.closing(self.data_segments()) as segments:
             while True:
-                data = file.read(self.cwnd)
-                if not data:
-                    break
-                self.send_packet(ack=True, payload=data)
+                # Fill the window up to cwnd bytes not yet ACKed or SACKed (at least one segment is always
+                # allowed), but never span more than half of the sequence space, so that sequence numbers
+                # in flight stay unambiguous and fit into the server's reassembly buffer
+                self.pacer.update(self.cc.pacing_rate(self.rtt.srtt))
+                pace_wait = 0
                 while True:
-                    header, _ = self.recv_packet()
-                    if header.ack:
-                        self.update_sequence_number(len(data))
-                        self.update_cwnd()
+                    size = self.pmtu.size
+                    bytes_in_flight = sent_offset - self.scoreboard.sacked(sent_offset)
+                    if bytes_in_flight > 0 and bytes_in_flight + size > self.cc.cwnd:
+                        break
+                    if sent_offset + size > self.max_flight:
                         break
+                    if self.rwnd is not None and sent_offset + size > self.rwnd and not (probe and n_sent == 0):
+                        break  # flow control: never more than the server has room for
+                    if n_sent == len(window):
+                        # path MTU probe: a full segment of the next size, when everything lets it through
+                        mtu_probe = self.pmtu.nextProbe()
+                        if mtu_probe is not None and (bytes_in_flight + mtu_probe > self.cc.cwnd or
+                                                      sent_offset + mtu_probe > self.max_flight or
+                                                      (self.rwnd is not None and sent_offset + mtu_probe > self.rwnd)):
+                            mtu_probe = None
+                        self.segment_size = mtu_probe or size
+                        data = b'' if eof else next(segments, b'')
+                        if not data:
+                            eof = True
+                            break
+                        if len(data) == mtu_probe:
+                            self.pmtu.on_probe_sent(mtu_probe, sent_offset + mtu_probe)
+                        window.append((self.seq_number, data))
+                        window_bytes += len(data)
+                        self.update_sequence_number(len(data))
+                    seq_number, data = window[n_sent]
+                    if not self.scoreboard.covers(sent_offset, sent_offset + len(data)):
+                        pace_wait = self.pacer.delay(len(data))
+                        if pace_wait > 0:
+                            break
+                        self.send_packet(ack=True, payload=data, seq_number=seq_number, dup=n_sent < n_ever_sent)
+                        self.pacer.consume(len(data))
+                        probe = False
+                        if n_sent >= n_ever_sent:
+                            self.rtt.start((seq_number + len(data)) % self.seq_mod)
+                    n_sent += 1
+                    sent_offset += len(data)
+                    n_ever_sent = max(n_ever_sent, n_sent)
+
+                if not window and eof:
+                    break
+
+                header = None
+                remaining = timer_start + self.rtt.rto - time.time()
+                if remaining > 0:
+                    self.sock.settimeout(min(remaining, pace_wait) if pace_wait > 0 else remaining)
+                    try:
+                        header, _ = self.recv_packet(retransmit=False)
+                    except socket.timeout:
+                        pass
+                if header is None:
+                    if time.time() < timer_start + self.rtt.rto:
+                        continue  # woke up to send the next paced segment
+                    if time.time() - last_progress > DEFAULT_TIMEOUT:
+                        raise socket.timeout("no progress")
+                    # Go back to the lowest unacknowledged sequence number, as a window probe if the window
+                    # is closed (until the end of the file is read, at least a segment is left to send)
+                    probe = self.recovery.on_expiry(self.rwnd, window_bytes if eof else self.pmtu.size)
+                    n_ever_sent, = self.resegment(window, n_ever_sent)
+                    n_sent = 0
+                    sent_offset = 0
+                    timer_start = time.time()
+                    continue
+
+                if not header.ack:
+                    continue
+                if self.rwnd is not None and self.rwnd < self.pmtu.size:
+                    last_progress = time.time()  # the server is alive, its disk is just behind
+
+                # Cumulative ACK: release every segment that ends at or before the ACK number
+                partial_ack = False
+                advance = (header.acknowledgment_number - window[0][0]) % self.seq_mod
+                if 0 < advance <= window_bytes:
+                    released = 0
+                    while window and advance >= released + len(window[0][1]):
+                        _, data = window.popleft()
+                        released += len(data)
+                        window_bytes -= len(data)
+                        n_ever_sent = max(n_ever_sent - 1, 0)
+                        if n_sent > 0:  # late ACK may cover segments queued for retransmission
+                            n_sent -= 1
+                            sent_offset -= len(data)
+                    self.scoreboard.advance(released)
+                    self.sample_rtt(header.acknowledgment_number)
+                    partial_ack = self.recovery.on_new_ack(released)
+                    last_progress = timer_start = time.time()
+                elif window and self.recovery.isDuplicate(advance, sent_offset, self.rwnd):
+                    if self.recovery.on_dup_ack(window_bytes, sent_offset - self.scoreboard.sacked(sent_offset),
+                                                self.sack):
+                        n_sent, n_ever_sent = self.resegment(window, n_sent, n_ever_sent)
+                        self.resend_first(window)
+                        timer_start = time.time()
+                if self.sack and header.sack_blocks and window:
+                    self.scoreboard.update(window[0][0], header.sack_blocks, window_bytes)
+                if partial_ack:
+                    self.resend_first(window)
+
+    def resend_first(self, window):
+        '''Resend the lowest unacknowledged segment of `window` right away'''
+        if window:
+            self.rtt.on_retransmit()
+            self.send_packet(ack=True, payload=window[0][1], seq_number=window[0][0], dup=True)
+            self.pacer.consume(len(window[0][1]))
 
     def close(self):
+        fin_seq_number = self.seq_number
         self.send_packet(fin=True)
-        start_time = time.time()
-        while time.time() - start_time < FIN_WAIT_TIMEOUT:
-            header, _ = self.recv_packet()
+        self.update_sequence_number(1)
+        self.rtt.start(self.seq_number)
+
+        deadline = time.time() + DEFAULT_TIMEOUT
+        fin_acked = False
+        while time.time() < deadline:
+            self.sock.settimeout(self.rtt.rto)
+            try:
+                header, _ = self.recv_packet(retransmit=False)
+            except socket.timeout:
+                if not fin_acked:
+                    self.rtt.on_timeout()
+                    self.send_packet(fin=True, seq_number=fin_seq_number, dup=True)
+                continue
+
+            if header.ack and header.acknowledgment_number == self.seq_number and not fin_acked:
+                # FIN is acknowledged, linger for FIN_WAIT_TIMEOUT to ACK the server's FIN
+                self.sample_rtt(header.acknowledgment_number)
+                fin_acked = True
+                deadline = time.time() + FIN_WAIT_TIMEOUT
             if header.fin:
+                self.ack_num = (header.sequence_number + 1) % self.seq_mod
                 self.send_packet(ack=True)
 
+        if not fin_acked:
+            raise socket.timeout("FIN was not acknowledged")
+
     def run(self):
         try:
             self.connect()
@@ -109,15 +411,90 @@ class ConfundoClient:
             sys.stderr.write(f"ERROR: {str(e)}\n")
             sys.exit(1)
         finally:
-            self.sock.close()
+            self.io.close()
+
+
+def make_client(args, trace_file=None, max_rate=None, **options):
+    return ConfundoClient(args.host, int(args.port), args.file[0], sack=not args.no_sack, cc_algorithm=args.cc,
+                          pacing=not args.no_pacing, max_rate=max_rate, use_mmap=not args.no_mmap,
+                          extended_seq=not args.no_ext_seq, tracer=makeTracer(LEVELS[args.trace], trace_file),
+                          mss=args.mss, probe_mss=args.probe_mss, **options)
 
 
+def send_stripe(args, index, stripe, max_rate):
+    '''Process `index` of a striped transfer: one range of the file over a connection of its own'''
+    client = make_client(args, f"{args.trace_file}.{index}" if args.trace_file is not None else None, max_rate,
+                         stripe=stripe)
+    try:
+        client.run()
+    finally:
+        client.tracer.close()  # exit handlers do not run in the process
+
+
+def run_striped(args):
+    '''
+    Send args.file[0] in args.stripes byte ranges, each over a Confundo connection of its own
+    from a process of its own: every range gets its own congestion window, and the senders do
+    not share an interpreter lock.  The server writes each range in place.
+    '''
+    ranges = stripeRanges(os.path.getsize(args.file[0]), args.stripes)
+    transfer = int.from_bytes(os.urandom(8), "big")  # names the file's directory on the server
+    max_rate = args.max_rate // len(ranges) if args.max_rate is not None else None
+    sys.stdout.reconfigure(line_buffering=True)  # trace lines of different stripes do not interleave
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=send_stripe, args=(args, index, (transfer, offset, length), max_rate),
+                                 name=f"confundo-stripe-{index}")
+                 for index, (offset, length) in enumerate(ranges)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [index for index, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        sys.stderr.write(f"ERROR: Stripe(s) {', '.join(map(str, failed))} of {len(processes)} failed\n")
+        sys.exit(1)
+
 
 parser = argparse.ArgumentParser("Parser")
 parser.add_argument("host", help="Set Hostname")
 parser.add_argument("port", help="Set Port Number")
-parser.add_argument("file", help="Set File Directory")
+parser.add_argument("file", nargs="+",
+                    help="File to send; several files or directories are sent as one session, each file by name")
+parser.add_argument("--session", action="store_true", help="Send even a single file as a session, with its name")
+parser.add_argument("--stripes", type=int, default=1, metavar="N",
+                    help="Send the file in N byte ranges over N connections at once, from N processes; stripe K "
+                         "traces to TRACE_FILE.K")
+parser.add_argument("--no-sack", action="store_true", help="Do not negotiate selective acknowledgments")
+parser.add_argument("--cc", choices=sorted(ALGORITHMS), default="reno", help="Congestion control algorithm")
+parser.add_argument("--no-pacing", action="store_true", help="Send each window in one burst")
+parser.add_argument("--max-rate", type=int, default=None, help="Cap the sending rate (bytes per second)")
+parser.add_argument("--no-mmap", action="store_true", help="Read the file segment by segment instead of memory-mapping it")
+parser.add_argument("--no-ext-seq", action="store_true", help="Do not negotiate 32-bit sequence numbers")
+parser.add_argument("--mss", type=int, default=MAX_MSS, help="Largest segment to offer in the handshake (bytes)")
+parser.add_argument("--probe-mss", action="store_true",
+                    help="Start with small segments and probe the path for larger ones up to the agreed size")
+parser.add_argument("--trace", choices=LEVELS, default="packet", help="Trace every packet, only drops, or nothing")
+parser.add_argument("--trace-file", default=None,
+                    help="Record the trace in binary form to TRACE_FILE from a background thread instead of printing it")
 args = parser.parse_args()
+try:
+    checkMss(args.mss)
+except ValueError as e:
+    parser.error(f"--{e}")
+
+if args.stripes < 1:
+    parser.error("--stripes must be at least 1")
+if args.stripes > 1:
+    if args.session or len(args.file) > 1 or not os.path.isfile(args.file[0]):
+        parser.error("--stripes sends a single file")
+    run_striped(args)
+    sys.exit(0)
 
-client = ConfundoClient(args.host, int(args.port), args.file)
+session_files = None
+if args.session or len(args.file) > 1 or os.path.isdir(args.file[0]):
+    try:
+        session_files = sessionFiles(args.file)
+    except ValueError as e:
+        parser.error(str(e))
+client = make_client(args, args.trace_file, args.max_rate, session_files=session_files)
 client.run()
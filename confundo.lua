@@ -4,15 +4,33 @@ local f_seqno  = ProtoField.uint32("confundo.seqno",        "Sequence Number")
 local f_ack    = ProtoField.uint32("confundo.ack",          "ACK Number")
 local f_id     = ProtoField.uint16("confundo.connectionId", "Connection ID")
 local f_flags  = ProtoField.uint16("confundo.flags",        "Flags")
+local f_optlen = ProtoField.uint8("confundo.options_length", "Options Length")
+local f_sack_left  = ProtoField.uint32("confundo.sack.left",  "SACK Left Edge")
+local f_sack_right = ProtoField.uint32("confundo.sack.right", "SACK Right Edge")
+local f_window = ProtoField.uint32("confundo.window", "Receive Window")
+local f_mss = ProtoField.uint16("confundo.mss", "Maximum Segment Size")
 
-confundo.fields = { f_seqno, f_ack, f_id, f_flags }
+confundo.fields = { f_seqno, f_ack, f_id, f_flags, f_optlen, f_sack_left, f_sack_right, f_window, f_mss }
+
+local OPT_SACK_PERMITTED = 1
+local OPT_SACK = 2
+local OPT_WINDOW = 3
+local OPT_EXTENDED_SEQ = 4
+local OPT_MSS = 5
+local OPT_SESSION = 6
+local OPT_STRIPE = 7
 
 function confundo.dissector(tvb, pInfo, root) -- Tvb, Pinfo, TreeItem
    if (tvb:len() ~= tvb:reported_len()) then
       return 0
    end
 
-   local t = root:add(confundo, tvb(0,12))
+   local hlen = 12
+   if bit.band(tvb(11,1):uint(), 8) ~= 0 then
+      hlen = 13 + tvb(12,1):uint()
+   end
+
+   local t = root:add(confundo, tvb(0,hlen))
    t:add(f_seqno, tvb(0,4))
    t:add(f_ack, tvb(4,4))
    t:add(f_id, tvb(8,2))
@@ -29,6 +47,42 @@ function confundo.dissector(tvb, pInfo, root) -- Tvb, Pinfo, TreeItem
    if bit.band(flag, 4) ~= 0 then
       f:add(tvb(11,1), "ACK")
    end
+
+   if bit.band(flag, 8) ~= 0 then
+      f:add(tvb(11,1), "OPT")
+      local optlen = tvb(12,1):uint()
+      local o = t:add(f_optlen, tvb(12,1))
+      local i = 13
+      while i + 2 <= 13 + optlen do
+         local kind = tvb(i,1):uint()
+         local len = tvb(i+1,1):uint()
+         if len < 2 then
+            break
+         end
+         if kind == OPT_SACK_PERMITTED then
+            o:add(tvb(i,len), "SACK Permitted")
+         elseif kind == OPT_SACK then
+            local s = o:add(tvb(i,len), "SACK")
+            for j = i + 2, i + len - 8, 8 do
+               s:add(f_sack_left, tvb(j,4))
+               s:add(f_sack_right, tvb(j+4,4))
+            end
+         elseif kind == OPT_WINDOW and len >= 6 then
+            o:add(f_window, tvb(i+2,4))
+         elseif kind == OPT_EXTENDED_SEQ then
+            o:add(tvb(i,len), "Extended Sequence Numbers")
+         elseif kind == OPT_MSS and len >= 4 then
+            o:add(f_mss, tvb(i+2,2))
+         elseif kind == OPT_SESSION then
+            o:add(tvb(i,len), "Session")
+         elseif kind == OPT_STRIPE then
+            o:add(tvb(i,len), "Stripe")
+         else
+            o:add(tvb(i,len), "Unknown option " .. kind)
+         end
+         i = i + len
+      end
+   end
   
    pInfo.cols.protocol = "Confundo"
 end
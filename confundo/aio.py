@@ -0,0 +1,603 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+asyncio implementation of the Confundo protocol.
+
+One ConfundoProtocol (a DatagramProtocol) owns a UDP socket and dispatches incoming
+datagrams by (fromAddr, connId) to AsyncSocket state machines.  Nothing blocks on
+recvfrom: retransmissions and the inactivity timeout are timers armed with
+loop.call_later, so a single event loop thread can drive any number of connections.
+
+    listener = await listen(("0.0.0.0", 5000))
+    conn = await listener.accept()
+    data = await conn.recv(4096)
+
+    conn = await connect(("127.0.0.1", 5000))
+    await conn.send(data)
+    await conn.close()
+'''
+
+import asyncio
+import socket
+import time
+
+from .common import *
+from .packet import Packet
+from .cwnd_control import make_cwnd_control
+from .buffer import SendBuffer, RecvBuffer, ReassemblyBuffer
+from .delack import DelayedAck
+from .sack import Scoreboard
+from .rtt import RttEstimator
+from .recovery import LossRecovery
+from .pacing import Pacer
+from .pmtud import PathMtu, agreedMss, checkMss
+from .socket import Socket, State
+from .trace import SEND, RECV, DROPPED, defaultTracer
+from .metrics import ConnectionMetrics, Metrics
+from .util import *
+
+
+class ConfundoProtocol(asyncio.DatagramProtocol):
+    '''Datagram protocol shared by all connections on one UDP socket'''
+
+    def __init__(self, listening=False, sack=True, ccAlgorithm="reno", pacing=True, maxRate=None,
+                 recvBufferSize=RECV_BUFFER_SIZE, extendedSeq=True, tracer=None, registry=None, delayedAck=True,
+                 mss=MAX_MSS):
+        self.transport = None
+        self.listening = listening
+        self.sack = sack
+        self.ccAlgorithm = ccAlgorithm
+        self.pacing = pacing
+        self.maxRate = maxRate
+        self.recvBufferSize = recvBufferSize
+        self.extendedSeq = extendedSeq
+        self.delayedAck = delayedAck
+        self.mss = checkMss(mss)
+        self.tracer = tracer if tracer is not None else defaultTracer() # shared by all connections
+        self.connections = {}  # (fromAddr, connId) -> AsyncSocket
+        self.handshakes = {}   # fromAddr -> AsyncSocket waiting for the ACK of its SYN|ACK
+        self.client = None     # connecting socket, before the server assigns its connId
+        self.acceptQueue = asyncio.Queue()
+        self.lastConnId = 0
+        self.registry = registry # None: confundo.metrics.defaultRegistry()
+        self.metrics = None
+        if listening:
+            self.metrics = Metrics("listener", registry, lambda: {'local': self.transport and
+                                                                 self.transport.get_extra_info('sockname')})
+            self.acceptedCount = self.metrics.counter("connections_accepted")
+            self.droppedCount = self.metrics.counter("packets_dropped")
+            self.metrics.gauge("connections", lambda: len(self.connections))
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, fromAddr):
+        inPkt = Packet().decode(data)
+
+        conn = self.connections.get((fromAddr, inPkt.connId))
+        if conn is None and self.client is not None and fromAddr == self.client.remote:
+            conn = self.client
+        if conn is None and self.listening and inPkt.isSyn and inPkt.connId == 0:
+            conn = self.handshakes.get(fromAddr)
+            if conn is None:
+                conn = self._newConnection(fromAddr)
+
+        if conn is None:
+            if self.metrics is not None:
+                self.droppedCount.inc()
+            if self.tracer.drops:
+                self.tracer.packet(DROPPED, inPkt)
+            return
+        conn._onPacket(inPkt)
+
+    def error_received(self, exc):
+        pass
+
+    def _newConnection(self, fromAddr):
+        self.lastConnId = self.lastConnId % 65535 + 1
+        conn = AsyncSocket(self, fromAddr, connId=self.lastConnId, sack=self.sack, ccAlgorithm=self.ccAlgorithm,
+                           pacing=self.pacing, maxRate=self.maxRate, recvBufferSize=self.recvBufferSize,
+                           extendedSeq=self.extendedSeq, delayedAck=self.delayedAck, mss=self.mss)
+        self.connections[(fromAddr, conn.connId)] = conn
+        self.handshakes[fromAddr] = conn
+        return conn
+
+    def _register(self, conn):
+        self.connections[(conn.remote, conn.connId)] = conn
+        if self.client is conn:
+            self.client = None
+        if self.handshakes.get(conn.remote) is conn:
+            del self.handshakes[conn.remote]
+
+    def _unregister(self, conn):
+        self.connections.pop((conn.remote, conn.connId), None)
+        if self.handshakes.get(conn.remote) is conn:
+            del self.handshakes[conn.remote]
+        if self.client is conn:
+            self.client = None
+
+
+class AsyncSocket:
+    '''One Confundo connection driven by the event loop'''
+
+    def __init__(self, protocol, remote, connId=0, sack=True, ccAlgorithm="reno", pacing=True, maxRate=None,
+                 recvBufferSize=RECV_BUFFER_SIZE, extendedSeq=True, delayedAck=True, mss=MAX_MSS):
+        self.loop = asyncio.get_running_loop()
+        self.protocol = protocol
+        self.tracer = protocol.tracer
+        self.remote = remote
+        self.connId = connId
+
+        self.base = MAX_SEQNO  # Last packet from this side that has been ACK'd
+        self.seqNum = self.base
+        self.inSeq = None
+
+        self.cc = make_cwnd_control(ccAlgorithm)
+        self.rtt = RttEstimator()
+        self.pacer = Pacer(pacing, maxRate)
+        self.mss = checkMss(mss) # largest segment we accept, offered in our SYN
+        self.pmtu = PathMtu(MTU) # size of the segments we send, agreed in the handshake (no probing here)
+        self.outBuffer = SendBuffer()
+        self.inBuffer = RecvBuffer()
+        self.recvBufferSize = recvBufferSize # inBuffer never holds more, the rest of it is advertised as the window
+        self.advertised = None # window sent in our last ACK
+        self.rwnd = None # window advertised by the other side, None if it does not advertise one
+        self.probe = False # the other side's window is closed: the next segment is sent anyway as a probe
+        self.delayedAck = DelayedAck(delayedAck) # when the ACK of received data may be held back
+        self.state = State.INVALID
+        self.synReceived = False
+        self.finReceived = False
+
+        self.sack = sack # requested in the SYN, then whether both sides agreed to use SACK
+        self.scoreboard = Scoreboard()
+        self.extendedSeq = extendedSeq # same for 32-bit sequence numbers
+        self._useSeqSpace(False)
+        self.sentEnd = 0 # offset after the highest byte sent, data below it is retransmitted
+
+        self._retxTimer = None
+        self._idleTimer = None
+        self._paceTimer = None
+        self._ackTimer = None
+        self._opened = self.loop.create_future()
+        self._finAcked = self.loop.create_future()
+        self._closed = self.loop.create_future()
+        self._sendDone = None
+        self._dataReady = asyncio.Event()
+
+        self.metrics = ConnectionMetrics(protocol.registry, labels=lambda: {'connId': self.connId, 'remote': self.remote})
+        self.metrics.watch(self)
+        self.recovery = LossRecovery(self.cc, self.rtt, self.pmtu, self.metrics, self._segmentSizeChanged)
+
+    # Public API
+
+    async def send(self, data):
+        if self.state != State.OPEN:
+            raise RuntimeError("Trying to send data, but socket is not in OPEN state")
+
+        startTime = time.time()
+        self.outBuffer.append(data)
+        if self._sendDone is None or self._sendDone.done():
+            self._sendDone = self.loop.create_future()
+        self._pump()
+        await self._sendDone
+        self.metrics.sendLatency.observe(time.time() - startTime)
+        return len(data)
+
+    async def recv(self, maxSize):
+        while len(self.inBuffer) == 0:
+            if self.finReceived:
+                return None
+            if self.state == State.ERROR:
+                raise TimeoutError("timeout")
+            self._dataReady.clear()
+            await self._dataReady.wait()
+
+        data = self.inBuffer.read(maxSize)
+        if self.advertised is not None and self.advertised < self.pmtu.maximum <= self._window():
+            # the window was closed, tell the sender right away that it has reopened
+            self._send(Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                              window=self._window()))
+        return data
+
+    async def close(self):
+        if self.state != State.OPEN:
+            raise RuntimeError("Trying to send FIN, but socket is not in OPEN state")
+
+        if self._sendDone is not None:
+            await self._sendDone
+        self.state = State.FIN
+        self._sendFin()
+        await self._finAcked
+        # linger so that a FIN from the other side can still be acknowledged
+        self.loop.call_later(FIN_WAIT_TIME, self._finish, State.CLOSED)
+        await self._closed
+
+    # Events
+
+    def _onPacket(self, inPkt):
+        if self.tracer.packets:
+            self.tracer.packet(RECV, inPkt, self.cc.cwnd, self.cc.ssthresh)
+        self.metrics.packetsReceived.inc()
+        self._armIdleTimer()
+        windowOpened = False
+        if inPkt.isAck and inPkt.window is not None:
+            windowOpened = self.rwnd is not None and inPkt.window > self.rwnd
+            self.rwnd = inPkt.window
+
+        outPkt = None
+        if inPkt.isSyn:
+            self.extendedSeq = self.extendedSeq and inPkt.extendedSeq
+            if self.extendedSeq != (self.mod == EXT_MOD):
+                self._useSeqSpace(self.extendedSeq)
+                if self.state == State.SYN:
+                    self.seqNum = incSeqNum(self.base, 1, self.mod) # our SYN, numbered in the agreed space
+            self.inSeq = incSeqNum(inPkt.seqNum, 1, self.mod)
+            if inPkt.connId != 0:
+                self.connId = inPkt.connId
+            if not self.synReceived:
+                # segments are at most the smaller of both offers, MTU for a peer that makes none
+                self.pmtu.setMaximum(agreedMss(self.mss, inPkt.mss))
+                self._segmentSizeChanged()
+            self.synReceived = True
+            self.sack = self.sack and inPkt.sackPermitted
+            if self.state == State.INVALID:
+                # new incoming connection: answer with SYN|ACK and wait for the ACK
+                self._sendSyn()
+            elif self.state == State.SYN and not inPkt.isAck:
+                self._sendSyn(isDup=True)  # client retransmitted its SYN
+            else:
+                outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                                window=self._window())
+
+        elif inPkt.isFin:
+            if self.inSeq == inPkt.seqNum: # all previous packets has been received, so safe to advance
+                self.inSeq = incSeqNum(self.inSeq, 1, self.mod)
+                self.finReceived = True
+                self._dataReady.set()
+            outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                            window=self._window())
+
+        elif len(inPkt.payload) > 0:
+            free = self.recvBufferSize - len(self.inBuffer)
+            delay = False
+            if self.synReceived and not self.finReceived and self.inSeq == inPkt.seqNum and len(inPkt.payload) <= free:
+                self.inSeq = incSeqNum(self.inSeq, len(inPkt.payload), self.mod)
+                self.inBuffer.append(inPkt.payload)
+                self.inSeq, payloads = self.reassembly.pull(self.inSeq)
+                for payload in payloads:
+                    self.inBuffer.append(payload)
+                self.metrics.bytesReceived.inc(len(self.inBuffer) - (self.recvBufferSize - free))
+                self._dataReady.set()
+                delay = self.delayedAck.on_segment(len(inPkt.payload), not payloads and len(self.reassembly) == 0,
+                                                   self._window() > 0)
+            elif self.synReceived and not self.finReceived:
+                # keep it for later (unless it is beyond the window), but don't advance, which means we
+                # will send a duplicate ACK
+                self.reassembly.add(self.inSeq, inPkt.seqNum, inPkt.payload, limit=free)
+            if delay:
+                if self._ackTimer is None:
+                    self._ackTimer = self.loop.call_later(self.delayedAck.delay, self._onAckTimer)
+            else:
+                outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                                sackBlocks=self.reassembly.blocks(self.inSeq) if self.sack else (),
+                                window=self._window())
+
+        if self.state == State.SYN and self.synReceived and \
+           ((inPkt.isAck and inPkt.ackNum == self.seqNum) or len(inPkt.payload) > 0):
+            if inPkt.isAck:
+                self._sampleRtt(inPkt.ackNum)
+            self._open()
+
+        if outPkt:
+            self._send(outPkt)
+
+        if inPkt.isAck and self.state in (State.OPEN, State.FIN):
+            self._onAck(inPkt)
+
+        if windowOpened and self.state == State.OPEN and len(self.outBuffer) > 0:
+            self._pump()
+
+    def _onAck(self, inPkt):
+        advanceAmount = seqDiff(inPkt.ackNum, self.base, self.mod)
+        inFlight = max(self.sentEnd, seqDiff(self.seqNum, self.base, self.mod))
+        if advanceAmount == 0 or advanceAmount > inFlight:
+            self._onSack(inPkt)
+            if self.state == State.OPEN and self.recovery.isDuplicate(advanceAmount, self.sentEnd, self.rwnd):
+                self._onDupAck()
+            return
+
+        if seqDiff(self.seqNum, self.base, self.mod) < advanceAmount:
+            self.seqNum = inPkt.ackNum # ACK covers data we were about to retransmit
+        self.base = inPkt.ackNum
+        self._sampleRtt(inPkt.ackNum)
+        if self.state == State.FIN:
+            if self.base == self.seqNum:
+                self._cancelRetxTimer()
+                if not self._finAcked.done():
+                    self._finAcked.set_result(None)
+            return
+
+        partialAck = self.recovery.on_new_ack(advanceAmount)
+        self.outBuffer.advance(advanceAmount)
+        self.scoreboard.advance(advanceAmount)
+        self.sentEnd = max(self.sentEnd - advanceAmount, 0)
+        self._onSack(inPkt)
+        if partialAck:
+            self._retransmitFirst()
+        if len(self.outBuffer) == 0:
+            self._cancelRetxTimer()
+            if self._sendDone is not None and not self._sendDone.done():
+                self._sendDone.set_result(None)
+        else:
+            self._armRetxTimer()
+            self._pump()
+
+    def _onDupAck(self):
+        flightSize = seqDiff(self.seqNum, self.base, self.mod)
+        if self.recovery.on_dup_ack(self.sentEnd, flightSize - self.scoreboard.sacked(flightSize), self.sack):
+            self._retransmitFirst()
+            self._armRetxTimer()
+        elif self.recovery.recoverEnd is not None:
+            self._pump() # the window may have grown
+
+    def _onSack(self, inPkt):
+        if self.sack and inPkt.sackBlocks:
+            self.scoreboard.update(self.base, inPkt.sackBlocks, self.sentEnd)
+
+    def _onRetxTimeout(self):
+        self._retxTimer = None
+        if self.state == State.SYN:
+            self.rtt.on_timeout()
+            self._sendSyn(isDup=True)
+        elif self.state == State.FIN:
+            self.rtt.on_timeout()
+            self._sendFin(isDup=True)
+        elif self.state == State.OPEN and len(self.outBuffer) > 0:
+            # go back to the oldest unacknowledged byte, as a window probe if the window is closed
+            self.probe = self.recovery.on_expiry(self.rwnd, len(self.outBuffer))
+            self.seqNum = self.base
+            self._pump()
+
+    def _onPaceTimer(self):
+        self._paceTimer = None
+        if self.state == State.OPEN:
+            self._pump()
+
+    def _onIdleTimeout(self):
+        self._finish(State.ERROR)
+
+    def _onAckTimer(self):
+        self._ackTimer = None
+        self._send(Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                          window=self._window()))
+
+    # Helpers
+
+    # the same as confundo.Socket's
+    _useSeqSpace = Socket._useSeqSpace
+    _window = Socket._window
+    _segmentSizeChanged = Socket._segmentSizeChanged
+    _retransmitFirst = Socket._retransmitFirst
+
+    def _send(self, packet):
+        self.protocol.transport.sendto(packet.encode(), self.remote)
+        if packet.window is not None:
+            self.advertised = packet.window
+        if packet.isAck:
+            self.delayedAck.on_ack_sent()
+            if self._ackTimer is not None:
+                self._ackTimer.cancel()
+                self._ackTimer = None
+        if self.tracer.packets:
+            self.tracer.packet(SEND, packet, self.cc.cwnd, self.cc.ssthresh, packet.isDup)
+        metrics = self.metrics
+        metrics.packetsSent.inc()
+        size = len(packet.payload)
+        if size:
+            metrics.bytesSent.inc(size)
+            if packet.isDup:
+                metrics.retransmits.inc()
+
+    def _pump(self):
+        '''Send every segment of outBuffer that fits into the congestion window'''
+        dataS = seqDiff(self.seqNum, self.base, self.mod)
+        self.pacer.update(self.cc.pacing_rate(self.rtt.srtt))
+        while dataS < len(self.outBuffer):
+            size = self.pmtu.size
+            if dataS < self.sentEnd:
+                # retransmission: skip what the receiver reported in SACK blocks
+                skipTo = self.scoreboard.skip(dataS)
+                if skipTo != dataS:
+                    self.seqNum = incSeqNum(self.seqNum, skipTo - dataS, self.mod)
+                    dataS = skipTo
+                    continue
+                nextSacked = self.scoreboard.nextSacked(dataS)
+                if nextSacked is not None:
+                    size = min(size, nextSacked - dataS)
+            toSend = self.outBuffer.peek(dataS, size)
+            if self.cc.cwnd - (dataS - self.scoreboard.sacked(dataS)) < len(toSend):
+                break
+            if dataS + len(toSend) > self.maxFlight: # keep sequence numbers in flight unambiguous
+                break
+            if self.rwnd is not None and dataS + len(toSend) > self.rwnd and not (self.probe and dataS == 0):
+                break # flow control: never more than the receiver has room for
+            wait = self.pacer.delay(len(toSend))
+            if wait > 0:
+                if self._paceTimer is None:
+                    self._paceTimer = self.loop.call_later(wait, self._onPaceTimer)
+                break
+            pkt = Packet(seqNum=self.seqNum, connId=self.connId, payload=toSend, isDup=dataS < self.sentEnd)
+            self.seqNum = incSeqNum(self.seqNum, len(toSend), self.mod)
+            self._send(pkt)
+            self.pacer.consume(len(toSend))
+            if not pkt.isDup:
+                self.rtt.start(self.seqNum)
+            dataS += len(toSend)
+            self.sentEnd = max(self.sentEnd, dataS)
+            self.probe = False
+        if self._retxTimer is None:
+            self._armRetxTimer()
+
+    def _sendSyn(self, isDup=False):
+        synPkt = Packet(seqNum=self.base, ackNum=self.inSeq if self.synReceived else 0, connId=self.connId,
+                        isSyn=True, isAck=self.synReceived, isDup=isDup, sackPermitted=self.sack,
+                        window=self._window(), extendedSeq=self.extendedSeq, mss=self.mss)
+        self.seqNum = incSeqNum(self.base, 1, self.mod)
+        self.state = State.SYN
+        self._send(synPkt)
+        self._startTiming(isDup)
+        self._armRetxTimer()
+        self._armIdleTimer()
+
+    def _sendFin(self, isDup=False):
+        finPkt = Packet(seqNum=self.base, connId=self.connId, isFin=True, isDup=isDup)
+        self.seqNum = incSeqNum(self.base, 1, self.mod)
+        self._send(finPkt)
+        self._startTiming(isDup)
+        self._armRetxTimer()
+
+    def _sampleRtt(self, ackNum):
+        rtt = self.rtt.on_ack(ackNum)
+        if rtt is not None:
+            self.cc.on_rtt_sample(rtt, self.rtt.srtt)
+            self.metrics.rtt.observe(rtt)
+
+    def _startTiming(self, isDup):
+        '''Time a control segment that was just sent, unless it is a retransmission (Karn's rule)'''
+        if isDup:
+            self.rtt.on_retransmit()
+        else:
+            self.rtt.start(self.seqNum)
+
+    def _open(self):
+        self.base = self.seqNum
+        self.state = State.OPEN
+        self._cancelRetxTimer()
+        self.protocol._register(self)
+        if not self._opened.done():
+            self._opened.set_result(self)
+            if self.protocol.listening:
+                self.protocol.acceptedCount.inc()
+                self.protocol.acceptQueue.put_nowait(self)
+
+    def _finish(self, state):
+        if self.state in (State.CLOSED, State.ERROR):
+            return
+        self.state = state
+        self._cancelRetxTimer()
+        if self._idleTimer is not None:
+            self._idleTimer.cancel()
+        if self._paceTimer is not None:
+            self._paceTimer.cancel()
+        if self._ackTimer is not None:
+            self._ackTimer.cancel()
+        self.protocol._unregister(self)
+        self.metrics.close()
+        self._dataReady.set()
+        error = TimeoutError("timeout") if state == State.ERROR else None
+        for waiter in (self._opened, self._finAcked, self._closed, self._sendDone):
+            if waiter is not None and not waiter.done():
+                if error is not None:
+                    waiter.set_exception(error)
+                else:
+                    waiter.set_result(None)
+        if not self.protocol.listening:
+            self.protocol.transport.close()
+
+    def _armRetxTimer(self):
+        self._cancelRetxTimer()
+        self._retxTimer = self.loop.call_later(self.rtt.rto, self._onRetxTimeout)
+
+    def _cancelRetxTimer(self):
+        if self._retxTimer is not None:
+            self._retxTimer.cancel()
+            self._retxTimer = None
+
+    def _armIdleTimer(self):
+        if self._idleTimer is not None:
+            self._idleTimer.cancel()
+        self._idleTimer = self.loop.call_later(GLOBAL_TIMEOUT, self._onIdleTimeout)
+
+
+class AsyncListener:
+    '''Listening endpoint returned by listen()'''
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    async def accept(self):
+        return await self.protocol.acceptQueue.get()
+
+    def close(self):
+        self.transport.close()
+
+
+async def connect(endpoint, sack=True, ccAlgorithm="reno", pacing=True, maxRate=None, recvBufferSize=RECV_BUFFER_SIZE,
+                  extendedSeq=True, tracer=None, registry=None, delayedAck=True, mss=MAX_MSS):
+    checkMss(mss) # before the endpoint is opened
+    loop = asyncio.get_running_loop()
+    remote = await loop.getaddrinfo(endpoint[0], endpoint[1], family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    (family, type, proto, canonname, sockaddr) = remote[0]
+
+    transport, protocol = await loop.create_datagram_endpoint(lambda: ConfundoProtocol(tracer=tracer, registry=registry),
+                                                              remote_addr=sockaddr)
+    conn = AsyncSocket(protocol, sockaddr, sack=sack, ccAlgorithm=ccAlgorithm, pacing=pacing, maxRate=maxRate,
+                       recvBufferSize=recvBufferSize, extendedSeq=extendedSeq, delayedAck=delayedAck, mss=mss)
+    protocol.client = conn
+    conn._sendSyn()
+    return await conn._opened
+
+
+async def listen(endpoint, sack=True, ccAlgorithm="reno", pacing=True, maxRate=None, recvBufferSize=RECV_BUFFER_SIZE,
+                 extendedSeq=True, tracer=None, registry=None, delayedAck=True, mss=MAX_MSS):
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(lambda: ConfundoProtocol(listening=True, sack=sack,
+                                                                                       ccAlgorithm=ccAlgorithm,
+                                                                                       pacing=pacing, maxRate=maxRate,
+                                                                                       recvBufferSize=recvBufferSize,
+                                                                                       extendedSeq=extendedSeq,
+                                                                                       tracer=tracer, registry=registry,
+                                                                                       delayedAck=delayedAck, mss=mss),
+                                                              local_addr=endpoint, family=socket.AF_INET)
+    return AsyncListener(transport, protocol)
+
+
+if __name__ == '__main__':
+    import os
+
+    from .metrics import Registry
+    from .netem import PROFILES, LinkEmulator
+    from .trace import Tracer
+
+    async def transfer(data, profile, seed):
+        '''Send `data` from connect() to listen() over an emulated link, returns the data received and the sender'''
+        listener = await listen(("127.0.0.1", 0), tracer=Tracer(), registry=Registry())
+        port = listener.transport.get_extra_info('sockname')[1]
+
+        async def receive():
+            conn = await listener.accept()
+            chunks = []
+            while True:
+                chunk = await conn.recv(1 << 16)
+                if chunk is None:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+        with LinkEmulator(("127.0.0.1", port), profile, seed=seed, registry=Registry()) as link:
+            receiver = asyncio.ensure_future(receive())
+            conn = await connect(link.address, tracer=Tracer(), registry=Registry())
+            await conn.send(data)
+            await conn.close()
+            received = await receiver
+        listener.close()
+        return received, conn
+
+    data = os.urandom(300000)
+    received, conn = asyncio.run(transfer(data, PROFILES['loopback'], 0))
+    assert received == data and conn.metrics.retransmits.value == 0
+
+    # a seeded lossy link: losses are recovered by fast retransmits and partial ACKs
+    received, conn = asyncio.run(transfer(data, PROFILES['lossy'], 1))
+    assert received == data and conn.metrics.fastRetransmits.value > 0
+    print("Test passed!")
@@ -0,0 +1,361 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+Offline analysis of captures and traces.
+
+decode_headers() decodes the headers of many datagrams at once into a structured NumPy
+array (one field per column, see PACKET_DTYPE) instead of one Header.decode() call per
+datagram, and read_pcap() does the same for the UDP datagrams in a pcap file.  Traces
+printed by client.py/server.py (`SEND/RECV seq ack connId cwnd ssthresh FLAGS`) are read
+with parse_trace(); read_trace() also loads the binary traces written with `--trace-file`.
+goodput(), retransmissions() and cwnd_timeline() summarize the result per connection.
+
+NumPy is only needed by this module:
+
+    python3 -m confundo.analysis confundo.pcap
+'''
+
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .header import HEADER, HEADER_SIZE, FLAG_FIN, FLAG_SYN, FLAG_ACK, FLAG_OPT
+from .trace import FLAG_DUP, RECORD, RECV, SEND, TRACE_MAGIC
+from .util import EXT_MOD, MOD
+
+# pcap link types and the length of their link-layer header in front of IPv4
+LINK_HEADERS = {
+    0: 4,     # DLT_NULL (BSD loopback, e.g. the bundled confundo.pcap)
+    1: 14,    # DLT_EN10MB
+    101: 0,   # DLT_RAW
+    113: 16,  # DLT_LINUX_SLL
+    228: 0,   # DLT_IPV4
+}
+
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+PCAP_HEADER_SIZE = 24
+PCAP_RECORD_SIZE = 16
+UDP_HEADER_SIZE = 8
+IPPROTO_UDP = 17
+
+if np is not None:
+    # the wire layout of HEADER, so a block of headers can be reinterpreted without copying
+    WIRE_DTYPE = np.dtype([('seq', '>u4'), ('ack', '>u4'), ('connId', '>u2'), ('flags', '>u2')])
+    assert WIRE_DTYPE.itemsize == HEADER.size
+
+    PACKET_DTYPE = np.dtype([('time', 'f8'), ('seq', 'u4'), ('ack', 'u4'), ('connId', 'u2'), ('flags', 'u2'),
+                             ('length', 'u4'), ('srcPort', 'u2'), ('dstPort', 'u2')])
+    TRACE_DTYPE = np.dtype([('event', 'u1'), ('seq', 'u4'), ('ack', 'u4'), ('connId', 'u2'), ('flags', 'u2'),
+                            ('cwnd', 'i4'), ('ssthresh', 'i4')])
+    # confundo.trace.RECORD, the records of binary traces
+    RECORD_DTYPE = np.dtype({'names': ['time', 'event', 'connId', 'seq', 'ack', 'flags', 'cwnd', 'ssthresh'],
+                             'formats': ['<f8', 'u1', '<u2', '<u4', '<u4', '<u2', '<i4', '<i4'],
+                             'offsets': [0, 8, 10, 12, 16, 20, 24, 28], 'itemsize': RECORD.size})
+
+
+def _requireNumpy():
+    if np is None:
+        raise ImportError("confundo.analysis requires numpy (pip install numpy)")
+
+
+def decode_headers(data, offsets=None, lengths=None):
+    '''
+    Decode the Confundo headers of many datagrams at once.
+
+    `data` is either a sequence of datagrams or one buffer holding them, in which case
+    `offsets` and `lengths` give the position of each datagram inside it.  Returns a
+    PACKET_DTYPE array where `length` is the payload length; `time` and the ports are left 0.
+    Datagrams shorter than a header are dropped.
+    '''
+    _requireNumpy()
+    if offsets is None:
+        lengths = np.fromiter((len(d) for d in data), np.int64, len(data))
+        offsets = np.zeros(len(lengths), np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        data = b''.join(data)
+    buf = np.frombuffer(data, np.uint8)
+    offsets = np.asarray(offsets, np.int64)
+    lengths = np.asarray(lengths, np.int64)
+
+    keep = lengths >= HEADER_SIZE
+    if not keep.all():
+        offsets, lengths = offsets[keep], lengths[keep]
+
+    # gather the 12 header bytes of every datagram into one (n, 12) block, then read it as WIRE_DTYPE
+    raw = buf[offsets[:, None] + np.arange(HEADER_SIZE)].view(WIRE_DTYPE).reshape(-1)
+    packets = np.zeros(len(raw), PACKET_DTYPE)
+    packets['seq'] = raw['seq']
+    packets['ack'] = raw['ack']
+    packets['connId'] = raw['connId']
+    packets['flags'] = raw['flags']
+
+    # options: one length byte after the header, then that many bytes of TLVs
+    headerLength = np.full(len(raw), HEADER_SIZE, np.int64)
+    hasOptions = ((raw['flags'] & FLAG_OPT) != 0) & (lengths > HEADER_SIZE)
+    headerLength[hasOptions] += 1 + buf[offsets[hasOptions] + HEADER_SIZE]
+    packets['length'] = np.maximum(lengths - headerLength, 0)
+    return packets
+
+
+def read_pcap(path, port=None):
+    '''
+    Decode every Confundo datagram in a pcap capture (IPv4/UDP over the link types in
+    LINK_HEADERS).  With `port`, only datagrams from or to that UDP port are kept.
+    Returns a PACKET_DTYPE array in capture order, `time` in seconds.
+    '''
+    _requireNumpy()
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] not in PCAP_MAGIC:
+        raise ValueError(f"{path}: not a pcap file")
+    endian, resolution = PCAP_MAGIC[data[:4]]
+    linkType = struct.unpack_from(endian + 'I', data, 20)[0] & 0xFFFFFFF
+    if linkType not in LINK_HEADERS:
+        raise ValueError(f"{path}: unsupported link type {linkType}")
+
+    # record headers chain through their captured lengths, so only this walk is sequential;
+    # it just collects where each record starts, the fields are gathered with numpy afterwards
+    capLength = struct.Struct(endian + 'I')
+    starts = []
+    offset = PCAP_HEADER_SIZE
+    end = len(data) - PCAP_RECORD_SIZE
+    while offset <= end:
+        starts.append(offset)
+        offset += PCAP_RECORD_SIZE + capLength.unpack_from(data, offset + 8)[0]
+    if offset > len(data) and starts:
+        del starts[-1] # truncated last record
+
+    buf = np.frombuffer(data, np.uint8)
+    records = np.array(starts, np.int64)
+    fields = buf[records[:, None] + np.arange(PCAP_RECORD_SIZE)].view(endian + 'u4')
+    times = fields[:, 0] + fields[:, 1] * resolution
+    capLens = fields[:, 2].astype(np.int64)
+    starts = records + PCAP_RECORD_SIZE
+
+    ip = starts + LINK_HEADERS[linkType]
+    ok = capLens >= LINK_HEADERS[linkType] + 20 + UDP_HEADER_SIZE
+    ip, starts, capLens, times = ip[ok], starts[ok], capLens[ok], times[ok]
+    ihl = (buf[ip] & 0x0F).astype(np.int64) * 4
+    ok = ((buf[ip] >> 4) == 4) & (buf[ip + 9] == IPPROTO_UDP) & (ihl >= 20)
+    if linkType == 1:
+        ok &= (buf[ip - 2] == 0x08) & (buf[ip - 1] == 0x00) # EtherType IPv4
+    ip, ihl, starts, capLens, times = ip[ok], ihl[ok], starts[ok], capLens[ok], times[ok]
+
+    udp = ip + ihl
+    ok = udp + UDP_HEADER_SIZE <= starts + capLens
+    udp, starts, capLens, times = udp[ok], starts[ok], capLens[ok], times[ok]
+    srcPort = buf[udp].astype(np.int64) << 8 | buf[udp + 1]
+    dstPort = buf[udp + 2].astype(np.int64) << 8 | buf[udp + 3]
+    udpLength = buf[udp + 4].astype(np.int64) << 8 | buf[udp + 5]
+
+    payload = udp + UDP_HEADER_SIZE
+    lengths = np.minimum(udpLength - UDP_HEADER_SIZE, starts + capLens - payload)
+    ok = lengths >= HEADER_SIZE
+    if port is not None:
+        ok &= (srcPort == port) | (dstPort == port)
+
+    packets = decode_headers(data, payload[ok], lengths[ok])
+    packets['time'] = times[ok]
+    packets['srcPort'] = srcPort[ok]
+    packets['dstPort'] = dstPort[ok]
+    return packets
+
+
+def parse_trace(lines):
+    '''
+    Parse `SEND/RECV seq ack connId cwnd ssthresh FLAGS` lines as printed by client.py and
+    server.py into a TRACE_DTYPE array.  `-` (no cwnd on the server side) becomes -1;
+    other lines are skipped.
+    '''
+    _requireNumpy()
+    flagBits = {'ACK': FLAG_ACK, 'SYN': FLAG_SYN, 'FIN': FLAG_FIN, 'DUP': FLAG_DUP}
+    events = {'SEND': SEND, 'RECV': RECV}
+    rows = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 6 or fields[0] not in events:
+            continue
+        try:
+            flags = 0
+            for flag in fields[6:]:
+                flags |= flagBits[flag]
+            rows.append((events[fields[0]], int(fields[1]), int(fields[2]), int(fields[3]),
+                         flags, -1 if fields[4] == '-' else int(fields[4]),
+                         -1 if fields[5] == '-' else int(fields[5])))
+        except (ValueError, KeyError):
+            continue
+    return np.array(rows, TRACE_DTYPE)
+
+
+def read_trace(path):
+    '''TRACE_DTYPE array of a text trace or of a binary one written by confundo.trace.RingTracer'''
+    _requireNumpy()
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) == TRACE_MAGIC:
+            data = f.read()
+            records = np.frombuffer(data, RECORD_DTYPE, len(data) // RECORD.size)
+            records = records[records['event'] <= RECV] # like parse_trace, DROP events are left out
+            trace = np.empty(len(records), TRACE_DTYPE)
+            for name in TRACE_DTYPE.names:
+                trace[name] = records[name]
+            return trace
+    with open(path) as f:
+        return parse_trace(f)
+
+
+def _unwrap(seq):
+    '''
+    Sequence numbers of one flow as a monotonic int64 series, undoing the wraparound at MOD, or
+    at EXT_MOD when the flow uses extended sequence numbers (they are never below MOD after the SYN)
+    '''
+    mod = EXT_MOD if len(seq) and seq.max() >= MOD else MOD
+    step = np.diff(seq.astype(np.int64))
+    turns = np.zeros(len(seq), np.int64)
+    turns[1:] = np.cumsum((step < -mod // 2).astype(np.int64) - (step > mod // 2))
+    return seq.astype(np.int64) + turns * mod
+
+
+def _segments(packets):
+    '''Per connection: (unwrapped start, end, time) of the data-carrying datagrams, in capture order'''
+    data = packets[packets['length'] > 0]
+    flows = {}
+    for connId in np.unique(data['connId']):
+        flow = data[data['connId'] == connId]
+        start = _unwrap(flow['seq'])
+        flows[int(connId)] = (start, start + flow['length'], flow['time'])
+    return flows
+
+
+def connections(packets):
+    '''Connection IDs present in a PACKET_DTYPE or TRACE_DTYPE array'''
+    _requireNumpy()
+    return [int(connId) for connId in np.unique(packets['connId'])]
+
+
+def retransmissions(packets):
+    '''
+    Per connection, the number of data segments that start below the highest byte already
+    sent, i.e. retransmissions (or reordering, when the capture point sits after the loss).
+    Works on PACKET_DTYPE arrays; for traces count the DUP flag instead.
+    '''
+    _requireNumpy()
+    counts = {}
+    for connId, (start, end, _) in _segments(packets).items():
+        highest = np.maximum.accumulate(end)
+        counts[connId] = int(np.count_nonzero(start[1:] < highest[:-1]))
+    return counts
+
+
+def goodput(packets):
+    '''
+    Per connection, (unique payload bytes, seconds, bytes/s): the span of sequence space the
+    data segments covered over the time between the first and the last of them.
+    '''
+    _requireNumpy()
+    result = {}
+    for connId, (start, end, time) in _segments(packets).items():
+        size = int(end.max() - start.min())
+        duration = float(time[-1] - time[0])
+        result[connId] = (size, duration, size / duration if duration > 0 else float('nan'))
+    return result
+
+
+def cwnd_timeline(trace):
+    '''
+    Per connection, the sender's window from a TRACE_DTYPE array: the trace rows (`line`
+    is the row index) where cwnd or ssthresh changed, starting with the first SEND.
+    '''
+    _requireNumpy()
+    timeline = np.dtype([('line', 'i8'), ('cwnd', 'i4'), ('ssthresh', 'i4')])
+    result = {}
+    rows = np.flatnonzero((trace['event'] == SEND) & (trace['cwnd'] >= 0))
+    for connId in np.unique(trace['connId'][rows]):
+        own = rows[trace['connId'][rows] == connId]
+        cwnd, ssthresh = trace['cwnd'][own], trace['ssthresh'][own]
+        changed = np.ones(len(own), bool)
+        changed[1:] = (cwnd[1:] != cwnd[:-1]) | (ssthresh[1:] != ssthresh[:-1])
+        out = np.empty(np.count_nonzero(changed), timeline)
+        out['line'], out['cwnd'], out['ssthresh'] = own[changed], cwnd[changed], ssthresh[changed]
+        result[int(connId)] = out
+    return result
+
+
+def selfTest():
+    import os
+    from .header import Header
+
+    # read_pcap against a walk of the bundled capture one record at a time, decoded by Header
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "confundo.pcap")
+    with open(path, 'rb') as f:
+        data = f.read()
+    expected = []
+    offset = PCAP_HEADER_SIZE
+    while offset + PCAP_RECORD_SIZE <= len(data):
+        seconds, micros, capLength, _ = struct.unpack_from('<IIII', data, offset)
+        ip = data[offset + PCAP_RECORD_SIZE + LINK_HEADERS[0]:offset + PCAP_RECORD_SIZE + capLength]
+        offset += PCAP_RECORD_SIZE + capLength
+        udp = ip[(ip[0] & 0x0F) * 4:]
+        srcPort, dstPort, udpLength = struct.unpack_from('>HHH', udp)
+        datagram = udp[UDP_HEADER_SIZE:udpLength]
+        seq, ack, connId, flags = HEADER.unpack_from(datagram)
+        expected.append((seconds + micros * 1e-6, seq, ack, connId, flags,
+                         len(datagram) - Header().decode_from(datagram), srcPort, dstPort))
+    packets = read_pcap(path)
+    assert packets.tolist() == expected
+    assert list(packets['flags'][:3]) == [FLAG_SYN, FLAG_SYN | FLAG_ACK, FLAG_ACK]
+    assert packets['length'].sum() == 1732 and len(read_pcap(path, port=5001)) == 0
+
+    # options are skipped, datagrams shorter than a header dropped
+    datagrams = [Header(1, 2, 3, ack=True, sack_blocks=((10, 20),), window=1000).encode() + b'x' * 5, b'short',
+                 Header(7, syn=True).encode()]
+    packets = decode_headers(datagrams)
+    assert packets[['seq', 'ack', 'connId', 'length']].tolist() == [(1, 2, 3, 5), (7, 0, 0, 0)]
+    print("Test passed!")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Summarize Confundo captures (.pcap) and client/server traces")
+    parser.add_argument("files", nargs='*', help="pcap captures or text traces")
+    parser.add_argument("--port", type=int, help="only datagrams from or to this UDP port (pcap)")
+    parser.add_argument("--self-test", action="store_true", help="test the decoders against confundo.pcap and exit")
+    args = parser.parse_args()
+
+    if args.self_test:
+        selfTest()
+        return
+    if not args.files:
+        parser.error("the following arguments are required: files")
+
+    for path in args.files:
+        with open(path, 'rb') as f:
+            isPcap = f.read(4) in PCAP_MAGIC
+        if isPcap:
+            packets = read_pcap(path, args.port)
+            print(f"{path}: {len(packets)} datagrams")
+            rate, retx = goodput(packets), retransmissions(packets)
+            print(f"{'connId':>8} {'bytes':>10} {'seconds':>10} {'bytes/s':>12} {'retx':>6}")
+            for connId in sorted(rate):
+                size, seconds, bps = rate[connId]
+                print(f"{connId:>8} {size:>10} {seconds:>10.3f} {bps:>12.0f} {retx[connId]:>6}")
+        else:
+            trace = read_trace(path)
+            print(f"{path}: {len(trace)} trace lines")
+            dups = trace[(trace['event'] == SEND) & ((trace['flags'] & FLAG_DUP) != 0)]
+            print(f"{'connId':>8} {'sends':>8} {'dups':>6} {'changes':>8} {'max cwnd':>10}")
+            for connId, timeline in sorted(cwnd_timeline(trace).items()):
+                sends = np.count_nonzero((trace['event'] == SEND) & (trace['connId'] == connId))
+                print(f"{connId:>8} {sends:>8} {np.count_nonzero(dups['connId'] == connId):>6} "
+                      f"{len(timeline):>8} {timeline['cwnd'].max():>10}")
+
+
+if __name__ == '__main__':
+    main()
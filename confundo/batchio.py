@@ -0,0 +1,233 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+import ctypes
+import ctypes.util
+import errno
+import select
+import socket
+import struct
+import threading
+from collections import deque
+
+from .common import *
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_Iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint8 * 2),
+                ("sin_addr", ctypes.c_uint8 * 4), ("sin_zero", ctypes.c_uint8 * 8)]
+
+
+def _loadLibc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None # not Linux/glibc: fall back to one syscall per datagram
+
+_libc = _loadLibc()
+
+# per-datagram fields are read and written through memoryviews of the ctypes arrays,
+# which is much cheaper than creating a ctypes object for every access
+_MSG_SIZE = ctypes.sizeof(_Mmsghdr)
+_MSG_LEN = struct.Struct("I")
+_MSG_LEN_OFFSET = _Mmsghdr.msg_len.offset
+_IOV_SIZE = ctypes.sizeof(_Iovec)
+_IOV_LEN = struct.Struct("N")
+_IOV_LEN_OFFSET = _Iovec.iov_len.offset
+_NAME_SIZE = ctypes.sizeof(_SockaddrIn)
+_SOCKADDR_IN = struct.Struct("=HH4s8x") # sin_family, sin_port and sin_addr (both already in network order)
+_ADDR_CACHE_SIZE = 1024 # addresses whose packed sockaddr_in is kept; the caches start over when full
+
+
+class BatchIO:
+    '''
+    Batched datagram I/O on top of a UDP socket.
+
+    sendto() only copies the datagram into the next preallocated send slot and sendPacket()
+    encodes a Header/Packet straight into it, so nothing is allocated per datagram.  The slots
+    go out with one sendmmsg() call when all `batchSize` are used, on flush(), or right before
+    recvfrom() would block.  recvfrom() waits for the first datagram with recvfrom_into() (for
+    the socket timeout, or its own) and then drains whatever else is already queued in the
+    kernel with one non-blocking recvmmsg().  Without sendmmsg/recvmmsg (or on non-IPv4
+    sockets) the same interface falls back to one syscall per datagram.  Addresses are
+    (IPv4 address, port) pairs, not host names: callers resolve a name once, beforehand.
+
+    Accepted sockets share their listener's BatchIO and may be used from different threads,
+    so the send slots and the receive queue are each guarded by a lock.
+    '''
+
+    def __init__(self, sock, batchSize=BATCH_SIZE, bufSize=MAX_DATAGRAM_SIZE, useMmsg=True):
+        self.sock = sock
+        self.batchSize = batchSize
+        self.bufSize = bufSize
+        self.useMmsg = useMmsg and _libc is not None and sock.family == socket.AF_INET
+        self.outQueue = []     # (size, addr) of the datagram in each used send slot
+        self.inQueue = deque() # (data, addr) received but not returned yet
+        self.addrs = {}        # addr -> packed sockaddr_in, at most _ADDR_CACHE_SIZE of them
+        self.names = {}        # packed sockaddr_in -> addr, the same
+        self.sendLock = threading.RLock()
+        self.recvLock = threading.Lock()
+
+        self.inBuf = bytearray(batchSize * bufSize)
+        self.inViews = [memoryview(self.inBuf)[i * bufSize:(i + 1) * bufSize] for i in range(batchSize)]
+        self.outBuf = bytearray(batchSize * bufSize)
+        self.outViews = [memoryview(self.outBuf)[i * bufSize:(i + 1) * bufSize] for i in range(batchSize)]
+        if self.useMmsg:
+            self.outMsgs, self.outIovs, self.outNames = self._prepare(self.outBuf)
+            self.inMsgs, self.inIovs, self.inNames = self._prepare(self.inBuf)
+            self.outIovsView = memoryview(self.outIovs).cast("B")
+            self.outNamesView = memoryview(self.outNames).cast("B")
+            self.inMsgsView = memoryview(self.inMsgs).cast("B")
+            self.inNamesView = memoryview(self.inNames).cast("B")
+
+    def _prepare(self, buf):
+        msgs = (_Mmsghdr * self.batchSize)()
+        iovs = (_Iovec * self.batchSize)()
+        names = (_SockaddrIn * self.batchSize)()
+        base = ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+        for i in range(self.batchSize):
+            iovs[i].iov_base = base + i * self.bufSize
+            iovs[i].iov_len = self.bufSize
+            msgs[i].msg_hdr.msg_name = ctypes.addressof(names[i])
+            msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        return msgs, iovs, names
+
+    def sendto(self, data, addr):
+        with self.sendLock:
+            if len(data) > self.bufSize:
+                self.flush()
+                self.sock.sendto(data, addr)
+                return
+            self.outViews[len(self.outQueue)][:len(data)] = data
+            self._queue(len(data), addr)
+
+    def sendPacket(self, header, addr, payload=None):
+        '''Encode `header` (a Header or Packet) and `payload` directly into the next send slot'''
+        with self.sendLock:
+            view = self.outViews[len(self.outQueue)]
+            if payload is None:
+                size = header.encode_into(view)
+            else:
+                size = header.encode_into(view, payload)
+            self._queue(size, addr)
+
+    def _queue(self, size, addr):
+        self.outQueue.append((size, addr))
+        if len(self.outQueue) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        '''Send every queued datagram'''
+        with self.sendLock:
+            queue = self.outQueue
+            if not queue:
+                return
+            sent = 0
+            if self.useMmsg and len(queue) > 1:
+                sent = self._sendmmsg(queue)
+            try:
+                for i in range(sent, len(queue)):
+                    size, addr = queue[i]
+                    try:
+                        self.sock.sendto(self.outViews[i][:size], addr)
+                    except OSError as e:
+                        if e.errno != errno.EMSGSIZE:
+                            raise
+                        # a path MTU probe with "don't fragment" larger than the interface: lost
+            finally:
+                self.outQueue = []
+
+    def recvfrom(self, timeout=None):
+        '''
+        Next datagram as (bytes, addr), waiting at most `timeout` seconds (the socket timeout
+        when None); raises socket.timeout like socket.recvfrom.  The socket timeout is never
+        changed, so threads that share the socket may each wait for their own time.
+        '''
+        with self.recvLock:
+            if not self.inQueue:
+                self.flush() # about to block, don't hold back ACKs and data
+                if timeout is not None and not select.select([self.sock], [], [], max(timeout, 0.0))[0]:
+                    raise socket.timeout("timed out")
+                size, addr = self.sock.recvfrom_into(self.inViews[0])
+                self.inQueue.append((bytes(self.inViews[0][:size]), addr))
+                self._drain()
+            return self.inQueue.popleft()
+
+    def close(self):
+        self.flush()
+        self.sock.close()
+
+    def _drain(self):
+        if self.batchSize < 2:
+            return
+        if not self.useMmsg:
+            timeout = self.sock.gettimeout()
+            self.sock.settimeout(0.0) # a timeout would make recvfrom_into wait even for an empty queue
+            try:
+                for view in self.inViews[1:]:
+                    size, addr = self.sock.recvfrom_into(view)
+                    self.inQueue.append((bytes(view[:size]), addr))
+            except (BlockingIOError, InterruptedError):
+                pass
+            finally:
+                self.sock.settimeout(timeout)
+            return
+
+        # msg_namelen is overwritten with sizeof(sockaddr_in) for IPv4 senders, so it needs no reset
+        n = _libc.recvmmsg(self.sock.fileno(), ctypes.addressof(self.inMsgs) + _MSG_SIZE, self.batchSize - 1,
+                           socket.MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise OSError(err, "recvmmsg: " + errno.errorcode.get(err, str(err)))
+        names = self.names
+        for i in range(1, n + 1):
+            name = bytes(self.inNamesView[i * _NAME_SIZE:(i + 1) * _NAME_SIZE])
+            addr = names.get(name)
+            if addr is None:
+                if len(names) >= _ADDR_CACHE_SIZE:
+                    names.clear()
+                _, port, host = _SOCKADDR_IN.unpack(name)
+                addr = names[name] = (socket.inet_ntoa(host), socket.ntohs(port))
+            size, = _MSG_LEN.unpack_from(self.inMsgsView, i * _MSG_SIZE + _MSG_LEN_OFFSET)
+            self.inQueue.append((bytes(self.inViews[i][:size]), addr))
+
+    def _sendmmsg(self, queue):
+        '''Send as much of `queue` as possible with sendmmsg, returns the number of datagrams sent'''
+        for i, (size, addr) in enumerate(queue):
+            _IOV_LEN.pack_into(self.outIovsView, i * _IOV_SIZE + _IOV_LEN_OFFSET, size)
+            name = self.addrs.get(addr)
+            if name is None:
+                if len(self.addrs) >= _ADDR_CACHE_SIZE:
+                    self.addrs.clear()
+                name = self.addrs[addr] = _SOCKADDR_IN.pack(socket.AF_INET, socket.htons(addr[1]),
+                                                            socket.inet_aton(addr[0]))
+            self.outNamesView[i * _NAME_SIZE:(i + 1) * _NAME_SIZE] = name
+        count = len(queue)
+        sent = 0
+        while sent < count:
+            n = _libc.sendmmsg(self.sock.fileno(), ctypes.addressof(self.outMsgs) + sent * _MSG_SIZE, count - sent, 0)
+            if n <= 0:
+                break # socket buffer full or error: the rest goes through sendto, which waits or raises
+            sent += n
+        return sent
@@ -0,0 +1,255 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+import bisect
+from collections import deque
+import mmap
+import os
+
+from .common import MAX_REORDER_BYTES, MMAP_CHUNK
+from .header import MAX_SACK_BLOCKS
+from .util import MOD, incSeqNum, seqDiff
+
+
+class SendBuffer:
+    '''
+    Outgoing byte queue.  Data handed to Socket.send is kept as a queue of immutable
+    chunks: segments are served as memoryview slices without copying, and acknowledged
+    bytes are released from the front in amortized O(1).
+    '''
+
+    def __init__(self):
+        self.chunks = deque()
+        self.head = 0  # offset of the first unacknowledged byte inside chunks[0]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if len(data) == 0:
+            return
+        if isinstance(data, bytearray):
+            data = bytes(data) # the caller may still modify it
+        chunk = memoryview(data).cast('B')
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+    def peek(self, offset, size):
+        '''Return up to `size` bytes starting `offset` bytes after the first unacknowledged byte'''
+        offset += self.head
+        out = None
+        for chunk in self.chunks:
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            piece = chunk[offset:offset + size - (len(out) if out is not None else 0)]
+            if out is None:
+                if len(piece) == size:
+                    return piece
+                out = bytearray(piece) # segment crosses a chunk boundary, the only case that needs a copy
+            else:
+                out += piece
+            if len(out) == size:
+                break
+            offset = 0
+        return memoryview(bytes(out) if out is not None else b"")
+
+    def advance(self, amount):
+        '''Release `amount` acknowledged bytes from the front'''
+        amount = min(amount, self.size)
+        self.size -= amount
+        amount += self.head
+        while self.chunks and amount >= len(self.chunks[0]):
+            amount -= len(self.chunks.popleft())
+        self.head = amount
+
+
+def mapFile(file, chunkSize=MMAP_CHUNK, start=0, length=None):
+    '''
+    Memory-map the open regular `file` read-only, `chunkSize` bytes at a time, and yield a
+    memoryview of each mapping.  A mapping is unmapped once the last view into it is gone,
+    so a consumer that drops acknowledged data keeps only a couple of chunks mapped.  Only
+    the `length` bytes from `start` (a multiple of mmap.ALLOCATIONGRANULARITY) are mapped
+    when given.
+    '''
+    chunkSize = max(mmap.ALLOCATIONGRANULARITY, chunkSize // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY)
+    size = os.fstat(file.fileno()).st_size
+    end = size if length is None else min(start + length, size)
+    for offset in range(start, end, chunkSize):
+        yield memoryview(mmap.mmap(file.fileno(), min(chunkSize, end - offset), access=mmap.ACCESS_READ,
+                                   offset=offset))
+
+
+class RecvBuffer:
+    '''Incoming byte queue: in-order payloads are queued as-is and only copied once, by read()'''
+
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, payload):
+        if len(payload) == 0:
+            return
+        self.chunks.append(memoryview(payload))
+        self.size += len(payload)
+
+    def read(self, maxSize):
+        '''Remove and return up to `maxSize` bytes'''
+        out = bytearray()
+        while self.chunks and len(out) < maxSize:
+            chunk = self.chunks.popleft()
+            need = maxSize - len(out)
+            if len(chunk) > need:
+                self.chunks.appendleft(chunk[need:])
+                chunk = chunk[:need]
+            if len(out) == 0 and (len(chunk) == maxSize or not self.chunks):
+                self.size -= len(chunk)
+                return bytes(chunk)
+            out += chunk
+        self.size -= len(out)
+        return bytes(out)
+
+
+class ReassemblyBuffer:
+    '''
+    Out-of-order segments keyed by sequence number.  Only segments that lie within
+    `capacity` bytes after the expected sequence number are kept, which bounds memory
+    and keeps the keys unambiguous across wraparound at `mod` (MOD, or EXT_MOD with extended
+    sequence numbers).
+
+    Segments are stored by their offset from `origin`, an earlier expected sequence number, in
+    a list kept sorted with bisect, so neither pull() nor blocks() sorts.  The part of a segment
+    that is already held is trimmed away on arrival: stored pieces never overlap and each byte
+    counts once against the capacity.
+    '''
+
+    def __init__(self, capacity=MAX_REORDER_BYTES, mod=MOD):
+        self.starts = []    # offsets from origin of the stored pieces, ascending
+        self.pieces = {}    # offset from origin -> payload
+        self.origin = None  # sequence number the offsets count from
+        self.size = 0
+        self.capacity = capacity
+        self.mod = mod
+
+    def __len__(self):
+        return self.size
+
+    def add(self, expected, seqNum, payload, limit=None):
+        '''
+        Keep a segment that arrived ahead of `expected`, within `limit` bytes of it if given
+        (the advertised receive window); returns False if none of it was stored
+        '''
+        offset = seqDiff(seqNum, expected, self.mod)
+        capacity = self.capacity if limit is None else min(self.capacity, limit)
+        if offset == 0 or offset + len(payload) > capacity or len(payload) == 0:
+            return False
+        if not self.starts:
+            self.origin = expected
+        first = start = seqDiff(expected, self.origin, self.mod) + offset
+        end = start + len(payload)
+
+        # store the parts of [start, end) not covered yet, in the gaps between the pieces held
+        i = bisect.bisect_right(self.starts, start)
+        if i > 0:
+            previous = self.starts[i - 1]
+            start = max(start, previous + len(self.pieces[previous]))
+        stored = False
+        while start < end:
+            nextStart = self.starts[i] if i < len(self.starts) else end
+            if nextStart > start:
+                piece = payload[start - first:min(nextStart, end) - first]
+                self.starts.insert(i, start)
+                self.pieces[start] = piece
+                self.size += len(piece)
+                stored = True
+                i += 1
+            if nextStart >= end:
+                break
+            start = max(start, nextStart + len(self.pieces[nextStart]))
+            i += 1
+        return stored
+
+    def pull(self, expected):
+        '''Remove the segments contiguous with `expected`, returns (new expected seqNum, [payloads])'''
+        if not self.starts:
+            return expected, []
+        base = seqDiff(expected, self.origin, self.mod)
+        payloads = []
+        count = 0
+        for start in self.starts:
+            if start > base:
+                break
+            payload = self.pieces.pop(start)
+            self.size -= len(payload)
+            count += 1
+            if start + len(payload) > base:
+                # forget what is behind the expected sequence number, deliver the rest
+                payloads.append(payload[base - start:])
+                base = start + len(payload)
+        del self.starts[:count]
+        expected = incSeqNum(self.origin, base, self.mod)
+        if base > self.capacity and self.starts:
+            # count from `expected` again before the offsets grow past the sequence space
+            self.starts = [start - base for start in self.starts]
+            self.pieces = {start - base: payload for start, payload in self.pieces.items()}
+            self.origin = expected
+        return expected, payloads
+
+    def blocks(self, expected, limit=MAX_SACK_BLOCKS):
+        '''Contiguous ranges held in the buffer as (left, right) sequence numbers, lowest first'''
+        ranges = []  # [left offset, right offset]
+        for start in self.starts:
+            end = start + len(self.pieces[start])
+            if ranges and start == ranges[-1][1]:
+                ranges[-1][1] = end
+            elif len(ranges) == limit:
+                break
+            else:
+                ranges.append([start, end])
+        return [(incSeqNum(self.origin, left, self.mod), incSeqNum(self.origin, right, self.mod))
+                for (left, right) in ranges]
+
+
+if __name__ == '__main__':
+    def seq(offset):
+        return incSeqNum(expected, offset, MOD)
+
+    # segments ahead of `expected`, which is about to wrap around the sequence space
+    expected = MOD - 100
+    buf = ReassemblyBuffer(capacity=10000, mod=MOD)
+    assert buf.add(expected, seq(200), b'c' * 100) and buf.add(expected, seq(400), b'e' * 100)
+    assert not buf.add(expected, seq(200), b'c' * 100)          # duplicate
+    assert not buf.add(expected, expected, b'a' * 100)          # in order: delivered, not buffered
+    assert not buf.add(expected, seq(9950), b'z' * 100)         # beyond the capacity
+    assert not buf.add(expected, seq(600), b'z' * 100, limit=650)  # beyond the advertised window
+    assert len(buf) == 200
+    assert buf.blocks(expected) == [(seq(200), seq(300)), (seq(400), seq(500))]
+    assert buf.pull(expected) == (expected, [])
+
+    # adjacent segments make one SACK block, and are pulled once the gap before them is filled
+    assert buf.add(expected, seq(100), b'b' * 100)
+    assert buf.blocks(expected) == [(seq(100), seq(300)), (seq(400), seq(500))]
+    assert buf.blocks(expected, limit=1) == [(seq(100), seq(300))]
+    after, payloads = buf.pull(seq(100))
+    assert after == seq(300) and payloads == [b'b' * 100, b'c' * 100]
+    assert len(buf) == 100 and buf.blocks(after) == [(seq(400), seq(500))]
+
+    # overlapping segments are trimmed to the part not held yet, which counts once
+    buf = ReassemblyBuffer(capacity=10000, mod=MOD)
+    assert buf.add(expected, seq(100), b'b' * 100) and buf.add(expected, seq(300), b'd' * 100)
+    assert buf.add(expected, seq(150), b'x' * 300)              # only 200-300 and 400-450 are new
+    assert not buf.add(expected, seq(120), b'y' * 50) and len(buf) == 350
+    assert buf.blocks(expected) == [(seq(100), seq(450))]
+    after, payloads = buf.pull(seq(120))                        # in-order data covered part of it
+    assert after == seq(450) and b''.join(payloads) == b'b' * 80 + b'x' * 100 + b'd' * 100 + b'x' * 50
+    assert len(buf) == 0
+
+    recv = RecvBuffer()
+    for payload in (b'abc', b'', b'defg', b'h'):
+        recv.append(payload)
+    assert len(recv) == 8 and recv.read(2) == b'ab' and recv.read(4) == b'cdef' and recv.read(10) == b'gh'
+    assert len(recv) == 0 and recv.read(10) == b''
+    print("Test passed!")
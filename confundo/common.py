@@ -2,7 +2,7 @@
 # Copyright 2019 Alex Afanasyev
 #
 
-MTU=412
+MTU=412  # segment size of a peer that does not negotiate one, and where path MTU probing starts
 MAX_SEQNO = 50000
 RETX_TIME = 0.5
 FIN_WAIT_TIME = 2.0
@@ -10,6 +10,29 @@ SYN_WAIT_TIME = 10.0
 INIT_SSTHRESH = 12000
 GLOBAL_TIMEOUT = 10.0
 INIT_SEQ_NUM = 50000
+MAX_REORDER_BYTES = MAX_SEQNO // 2
+EXT_MAX_FLIGHT = 1 << 30         # bytes in flight with extended sequence numbers, far below half of the 32-bit space
+EXT_MAX_REORDER_BYTES = 1 << 24  # out-of-order data a receiver keeps with extended sequence numbers
+RECV_BUFFER_SIZE = 1 << 16  # receive window of confundo.Socket: data received but not read by the application
+DUP_ACK_THRESHOLD = 3
+DELAYED_ACK_SEGMENTS = 2  # full-sized in-order segments acknowledged by one ACK
+DELAYED_ACK_TIME = 0.02   # seconds an ACK waits for the next segment before it is sent anyway
+ABC_LIMIT = 2             # segments one ACK may add to cwnd in slow start (RFC 3465), however much it acknowledges
+MIN_RTO = 0.1
+MAX_RTO = 4.0
+CLOCK_GRANULARITY = 0.01
+PACING_GAIN = 1.25
+PACING_BURST = 2          # segments an idle connection may send back-to-back
+MAX_MSS = 8960            # largest segment offered in the handshake: a 9000-byte jumbo frame less IPv4, UDP and header
+PMTU_PROBE_SIZES = (1460, MAX_MSS)  # segment sizes tried by path MTU probing: Ethernet, jumbo frames
+PMTU_MAX_PROBES = 3       # lost probes of one size before probing stops below it
+PMTU_BLACKHOLE_TIMEOUTS = 2  # consecutive timeouts that send a raised segment size back to MTU
+BATCH_SIZE = 64           # datagrams per sendmmsg/recvmmsg call
+MAX_DATAGRAM_SIZE = MAX_MSS + 268  # receive buffer per datagram: header, up to 255 bytes of options and MAX_MSS
+MMAP_CHUNK = 1 << 24      # bytes of a file mapped at a time by Socket.sendfile and client.py
+SINK_BUFFER_SIZE = 1 << 20  # bytes a FileSink queues for the disk before the receiver drops data
+SINK_FLUSH_SIZE = 1 << 16   # queued bytes that start a background write
+SINK_WORKERS = 4            # threads writing FileSinks to disk
 
 # Constants
 UDP_PACKET_SIZE = 424
@@ -2,26 +2,327 @@
 # Copyright 2019 Alex Afanasyev
 #
 
+from collections import deque
+import time
+
 from .common import *
 
 class CwndControl:
-    '''Interface for the congestio control actions'''
+    '''
+    Interface for the congestio control actions, implementing Reno (slow start, AIMD and
+    NewReno fast recovery).  Other algorithms override the hooks they need; every one of them
+    keeps `cwnd` and `ssthresh` in bytes, which is what format_line prints, and counts
+    segments of `mss` bytes, the segment size of the connection (see set_mss).
+    '''
+
+    def __init__(self, mss=MTU):
+        self.mss = mss
+        self.cwnd = 1.0 * mss
+        self.ssthresh = INIT_SSTHRESH * mss / MTU
 
-    def __init__(self):
-        self.cwnd = 1.0 * MTU
-        self.ssthresh = INIT_SSTHRESH
+    def set_mss(self, mss):
+        '''
+        Segments are `mss` bytes from now on (agreed in the handshake, or raised by path MTU
+        probing).  The window stays in bytes, except that one still at its initial or
+        post-timeout size of one segment, and an untouched initial ssthresh, follow the new size.
+        '''
+        if self.cwnd == self.mss:
+            self.cwnd = 1.0 * mss
+        if self.ssthresh == INIT_SSTHRESH * self.mss / MTU:
+            self.ssthresh = INIT_SSTHRESH * mss / MTU
+        self.mss = mss
 
     def on_ack(self, ackedDataLen):
-        #
-        # IMPLEMENT this and call this method in approprite place inside confundo/socket.py
-        #
-        self.cwnd += MTU if self.cwnd < self.ssthresh else (MTU * MTU) / self.ssthresh
+        '''
+        `ackedDataLen` new bytes are acknowledged.  The window grows with the bytes acknowledged,
+        not with the number of ACKs, so a receiver that delays its ACKs does not slow it down:
+        slow start adds the bytes (at most ABC_LIMIT segments per ACK), congestion avoidance one
+        segment for every ssthresh bytes.
+        '''
+        if self.cwnd < self.ssthresh:
+            self.cwnd += min(ackedDataLen, ABC_LIMIT * self.mss)
+        else:
+            self.cwnd += self.mss * ackedDataLen / self.ssthresh
 
     def on_timeout(self):
         #
         # IMPLEMENT this and call this method in approprite place inside confundo/socket.py
         #
-        self.ssthresh, self.cwnd = self.cwnd / 2.0, 1.0 * MTU
+        self.ssthresh, self.cwnd = max(self.cwnd / 2.0, 2.0 * self.mss), 1.0 * self.mss
+
+    def on_fast_retransmit(self, flightSize):
+        '''DUP_ACK_THRESHOLD duplicate ACKs: halve the window and enter fast recovery'''
+        self.ssthresh = max(flightSize / 2.0, 2.0 * self.mss)
+        self.cwnd = self.ssthresh + DUP_ACK_THRESHOLD * self.mss
+
+    def on_dup_ack(self):
+        '''Another duplicate ACK during fast recovery: a segment has left the network'''
+        self.cwnd += self.mss
+
+    def on_partial_ack(self, ackedDataLen):
+        '''ACK for part of the data outstanding when recovery started (NewReno): deflate the window'''
+        self.cwnd = max(self.cwnd - ackedDataLen + self.mss, 1.0 * self.mss)
+
+    def on_recovery_exit(self):
+        '''All data outstanding when recovery started is acknowledged'''
+        self.cwnd = self.ssthresh
+
+    def on_rtt_sample(self, rtt, srtt):
+        '''New RTT measurement `rtt` (seconds) and the smoothed RTT `srtt` of the RttEstimator'''
+        pass
+
+    def register(self, metrics):
+        '''Add gauges of the controller's state to `metrics` (a confundo.metrics.Metrics), read at snapshot time'''
+        metrics.gauge("cwnd", lambda: self.cwnd)
+        metrics.gauge("ssthresh", lambda: self.ssthresh)
+
+    def pacing_rate(self, srtt):
+        '''Bytes per second that spread cwnd over one smoothed RTT, None while the RTT is unknown'''
+        if not srtt:
+            return None
+        return PACING_GAIN * self.cwnd / srtt
 
     def __str__(self):
         return f"cwnd:{self.cwnd} ssthreash:{self.ssthresh}"
+
+
+class CubicControl(CwndControl):
+    '''
+    CUBIC (RFC 8312): after a loss the window follows a cubic function of the time since
+    the loss, centered on the window size where the loss happened, so that growth depends
+    on elapsed time rather than on the ACK rate and long-RTT paths are filled quickly.
+    '''
+
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss=MTU):
+        super(CubicControl, self).__init__(mss)
+        self.wMax = 0.0        # window (in segments) before the last reduction
+        self.k = 0.0           # seconds it takes to grow back to wMax
+        self.epochStart = None # start of the current congestion avoidance epoch
+        self.wEst = 0.0        # Reno-friendly window estimate (in segments)
+        self.srtt = None       # smoothed RTT of the connection's RttEstimator
+
+    def on_ack(self, ackedDataLen):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += min(ackedDataLen, ABC_LIMIT * self.mss)
+            return
+
+        mss = self.mss
+        now = time.time()
+        segments = self.cwnd / mss
+        if self.epochStart is None:
+            self.epochStart = now
+            if self.wMax < segments:
+                self.k = 0.0
+                self.wMax = segments
+            self.wEst = segments
+        t = now - self.epochStart
+        rtt = self.srtt if self.srtt is not None else RETX_TIME
+        target = self.C * (t + rtt - self.k) ** 3 + self.wMax
+        self.wEst += 3 * (1 - self.BETA) / (1 + self.BETA) * max(ackedDataLen, mss) / self.cwnd
+        target = max(target, self.wEst)
+        acked = max(ackedDataLen, mss) / mss
+        if target > segments:
+            self.cwnd += mss * acked * min(target - segments, segments) / segments
+        else:
+            self.cwnd += mss * acked / (100.0 * segments)
+
+    def set_mss(self, mss):
+        # wMax and wEst count segments: keep the windows they stand for
+        self.wMax *= self.mss / mss
+        self.wEst *= self.mss / mss
+        super(CubicControl, self).set_mss(mss)
+
+    def _reduce(self):
+        segments = self.cwnd / self.mss
+        # fast convergence: release bandwidth for new flows when the window keeps shrinking
+        self.wMax = segments * (1 + self.BETA) / 2 if segments < self.wMax else segments
+        self.k = (self.wMax * (1 - self.BETA) / self.C) ** (1.0 / 3)
+        self.epochStart = None
+        return max(self.cwnd * self.BETA, 2.0 * self.mss)
+
+    def on_timeout(self):
+        self.ssthresh, self.cwnd = self._reduce(), 1.0 * self.mss
+
+    def on_fast_retransmit(self, flightSize):
+        self.ssthresh = self._reduce()
+        self.cwnd = self.ssthresh + DUP_ACK_THRESHOLD * self.mss
+
+    def on_rtt_sample(self, rtt, srtt):
+        self.srtt = srtt
+
+    def register(self, metrics):
+        super(CubicControl, self).register(metrics)
+        metrics.gauge("cubic_w_max", lambda: self.wMax * self.mss)
+
+
+class BbrControl(CwndControl):
+    '''
+    Delay/bandwidth based controller in the spirit of BBR.  The bottleneck bandwidth is the
+    maximum ACK delivery rate over the last BW_ROUNDS round trips and the propagation delay
+    is the minimum RTT seen; cwnd is CWND_GAIN times their product.  Losses do not shrink the
+    model, only a timeout collapses cwnd until ACKs let it grow back.  During startup cwnd
+    grows as in slow start, but never beyond STARTUP_GAIN times the bandwidth-delay product
+    measured so far, until the bandwidth has not increased by 25% for STARTUP_ROUNDS rounds.
+    '''
+
+    BW_ROUNDS = 10
+    CWND_GAIN = 2.0
+    STARTUP_GAIN = 2.89 # 2/ln(2): doubles the delivery rate every round
+    STARTUP_ROUNDS = 3 # rounds without bandwidth growth that end startup
+    MIN_CWND = 4 # segments
+
+    def __init__(self, mss=MTU):
+        super(BbrControl, self).__init__(mss)
+        self.minRtt = None
+        self.rates = deque(maxlen=self.BW_ROUNDS) # delivery rate (bytes/s) per round
+        self.roundStart = None
+        self.roundDelivered = 0
+        self.fullBw = 0.0
+        self.fullBwRounds = 0
+        self.startup = True
+
+    @property
+    def btlBw(self):
+        return max(self.rates) if self.rates else 0.0
+
+    def target(self, gain=CWND_GAIN):
+        '''`gain` times the bandwidth-delay product, None until both are measured'''
+        if self.minRtt is None or not self.rates:
+            return None
+        return max(gain * self.btlBw * self.minRtt, self.MIN_CWND * self.mss)
+
+    def on_ack(self, ackedDataLen):
+        now = time.time()
+        if self.roundStart is None:
+            self.roundStart = now
+        self.roundDelivered += ackedDataLen
+        if self.minRtt is not None and now - self.roundStart >= self.minRtt:
+            self.rates.append(self.roundDelivered / (now - self.roundStart))
+            self.roundStart, self.roundDelivered = now, 0
+            if self.startup:
+                if self.btlBw > 1.25 * self.fullBw:
+                    self.fullBw, self.fullBwRounds = self.btlBw, 0
+                else:
+                    self.fullBwRounds += 1
+                    self.startup = self.fullBwRounds < self.STARTUP_ROUNDS
+
+        # past startup the window drains down to the model right away
+        target = self.target(self.STARTUP_GAIN if self.startup else self.CWND_GAIN)
+        if target is None:
+            self.cwnd += ackedDataLen
+        else:
+            self.cwnd = min(self.cwnd + ackedDataLen, target)
+
+    def on_timeout(self):
+        self.cwnd = 1.0 * self.mss
+
+    def on_fast_retransmit(self, flightSize):
+        # packet conservation: keep what is in flight, the model is not reduced on a loss
+        self.cwnd = max(flightSize, self.MIN_CWND * self.mss)
+
+    def on_dup_ack(self):
+        pass
+
+    def on_partial_ack(self, ackedDataLen):
+        self.on_ack(ackedDataLen)
+
+    def on_recovery_exit(self):
+        target = self.target()
+        if target is not None:
+            self.cwnd = max(self.cwnd, target)
+
+    def on_rtt_sample(self, rtt, srtt):
+        self.minRtt = rtt if self.minRtt is None else min(self.minRtt, rtt)
+
+    def register(self, metrics):
+        super(BbrControl, self).register(metrics)
+        metrics.gauge("bbr_btl_bw", lambda: self.btlBw)
+        metrics.gauge("bbr_min_rtt", lambda: self.minRtt)
+        metrics.gauge("bbr_startup", lambda: int(self.startup))
+
+    def pacing_rate(self, srtt):
+        if not self.rates:
+            return super(BbrControl, self).pacing_rate(srtt)
+        return (self.STARTUP_GAIN if self.startup else PACING_GAIN) * self.btlBw
+
+
+ALGORITHMS = {
+    "reno": CwndControl,
+    "cubic": CubicControl,
+    "bbr": BbrControl,
+}
+
+def make_cwnd_control(name="reno", mss=MTU):
+    '''Congestion controller registered under `name` in ALGORITHMS, counting segments of `mss` bytes'''
+    try:
+        return ALGORITHMS[name](mss)
+    except KeyError:
+        raise ValueError(f"Unknown congestion control algorithm: {name}")
+
+
+if __name__ == '__main__':
+    # Reno: slow start by bytes acknowledged (at most ABC_LIMIT segments per ACK), then AIMD
+    cc = make_cwnd_control("reno")
+    cc.on_ack(MTU)
+    cc.on_ack(10 * MTU)
+    assert cc.cwnd == (2 + ABC_LIMIT) * MTU
+    cc.cwnd = cc.ssthresh
+    cc.on_ack(cc.ssthresh)  # a window's worth of ACKs in congestion avoidance: one segment more
+    assert abs(cc.cwnd - (INIT_SSTHRESH + MTU)) < 1e-6
+    cc.on_fast_retransmit(20 * MTU)
+    assert cc.ssthresh == 10 * MTU and cc.cwnd == (10 + DUP_ACK_THRESHOLD) * MTU
+    cc.on_dup_ack()
+    cc.on_partial_ack(4 * MTU)
+    assert cc.cwnd == (10 + DUP_ACK_THRESHOLD + 1 - 4 + 1) * MTU
+    cc.on_recovery_exit()
+    assert cc.cwnd == 10 * MTU
+    cc.on_timeout()
+    assert cc.ssthresh == 5 * MTU and cc.cwnd == MTU
+    cc.set_mss(1460)  # a window of one segment follows the segment size
+    assert cc.cwnd == 1460 and cc.ssthresh == 5 * MTU
+
+    # CUBIC: multiplicative decrease by BETA, then growth back towards the window before the loss
+    cc = make_cwnd_control("cubic", mss=1000)
+    cc.cwnd = cc.ssthresh = 100 * 1000
+    cc.on_fast_retransmit(cc.cwnd)
+    assert cc.ssthresh == 70 * 1000 and cc.wMax == 100
+    cc.on_recovery_exit()
+    for _ in range(200):
+        cc.on_ack(1000)
+    assert 70 * 1000 < cc.cwnd <= 100 * 1000
+    cc.set_mss(500)
+    assert cc.wMax == 200
+    cc.on_rtt_sample(0.3, 0.1)  # the estimator's smoothed RTT, not a second smoothing of the samples
+    assert cc.srtt == 0.1
+
+    # BBR-like: a loss keeps what is in flight, a timeout collapses cwnd
+    cc = make_cwnd_control("bbr")
+    cc.on_ack(5 * MTU)
+    assert cc.cwnd == 6 * MTU and cc.startup
+    cc.on_fast_retransmit(2 * MTU)
+    assert cc.cwnd == BbrControl.MIN_CWND * MTU
+    cc.on_timeout()
+    assert cc.cwnd == MTU
+
+    # startup: cwnd stays within STARTUP_GAIN bandwidth-delay products and ends once the
+    # bandwidth stops growing, draining cwnd to CWND_GAIN of them
+    cc = make_cwnd_control("bbr", mss=1000)
+    cc.on_rtt_sample(0.1, 0.1)
+    for round in range(1 + BbrControl.STARTUP_ROUNDS):
+        assert cc.startup
+        cc.roundStart = time.time() - 0.11  # one round at about 90 kB/s
+        cc.on_ack(10000)
+        assert cc.cwnd <= BbrControl.STARTUP_GAIN * 10000 * 1.01
+    assert not cc.startup
+    cc.on_ack(1000)
+    assert cc.cwnd <= BbrControl.CWND_GAIN * 10000 * 1.01
+
+    try:
+        make_cwnd_control("vegas")
+        assert False
+    except ValueError:
+        pass
+    print("Test passed!")
@@ -0,0 +1,74 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+import time
+
+from .common import *
+
+
+class DelayedAck:
+    '''
+    When a receiver acknowledges in-order data (RFC 1122 4.2.3.2, RFC 5681 4.2).
+
+    One ACK covers up to `segments` full-sized segments and none is held back longer than
+    `delay` seconds.  Only a full segment received in order with no gap behind it may wait for
+    the next one; a short one (likely the end of what the sender has), one that fills a gap or
+    arrives while one is open, and one that leaves the receive window closed are acknowledged
+    right away.  Full-sized is the largest payload received so far.
+    '''
+
+    def __init__(self, enabled=True, segments=DELAYED_ACK_SEGMENTS, delay=DELAYED_ACK_TIME):
+        self.enabled = enabled
+        self.segments = segments
+        self.delay = delay
+        self.pending = 0 # segments received since the last ACK
+        self.deadline = None # when the ACK held back for them is due
+        self.largestSegment = MTU
+
+    def on_segment(self, size, noGap, windowOpen):
+        '''
+        An in-order segment of `size` bytes was received; `noGap` is false when it filled a gap
+        or one is still open, `windowOpen` false when no segment fits into the receive window any
+        more.  Returns whether its ACK may be held back until `deadline`.
+        '''
+        self.largestSegment = max(self.largestSegment, size)
+        if not (self.enabled and size == self.largestSegment and noGap and windowOpen and
+                self.pending + 1 < self.segments):
+            return False
+        self.pending += 1
+        if self.deadline is None:
+            self.deadline = time.time() + self.delay
+        return True
+
+    def on_ack_sent(self):
+        '''An ACK was sent: it acknowledges anything held back'''
+        self.pending = 0
+        self.deadline = None
+
+    def due(self, now):
+        '''Whether the ACK held back has waited long enough'''
+        return self.deadline is not None and now >= self.deadline
+
+
+if __name__ == '__main__':
+    # a full in-order segment waits for the next one, at most `delay`
+    ack = DelayedAck()
+    assert ack.on_segment(MTU, True, True) and ack.pending == 1
+    assert not ack.due(time.time()) and ack.due(time.time() + DELAYED_ACK_TIME)
+
+    # the second full segment is acknowledged right away, with the first
+    assert not ack.on_segment(MTU, True, True)
+    ack.on_ack_sent()
+    assert ack.pending == 0 and ack.deadline is None and not ack.due(time.time() + 1)
+
+    # a gap, a closing window or a short segment is acknowledged right away
+    assert not ack.on_segment(MTU, False, True) and not ack.on_segment(MTU, True, False)
+    assert not ack.on_segment(MTU // 2, True, True) and ack.pending == 0
+
+    # a larger segment becomes the full size, the smaller ones are short from then on
+    assert ack.on_segment(2 * MTU, True, True)
+    ack.on_ack_sent()
+    assert not ack.on_segment(MTU, True, True) and ack.largestSegment == 2 * MTU
+
+    # disabled: every segment is acknowledged
+    assert not DelayedAck(enabled=False).on_segment(MTU, True, True)
+    print("Test passed!")
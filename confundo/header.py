@@ -1,42 +1,195 @@
 import struct
+
+# Options follow the 12-byte header when the OPT flag is set: one byte with the
+# total length of the options, then (kind, length, value) entries where length
+# counts the kind and length bytes as well.
+OPT_SACK_PERMITTED = 1
+OPT_SACK = 2
+OPT_WINDOW = 3  # receive window: free bytes the sender may send past the acknowledgment number
+OPT_EXTENDED_SEQ = 4  # in SYN and SYN|ACK: use the whole 32-bit sequence space instead of wrapping at MAX_SEQNO
+OPT_MSS = 5  # in SYN and SYN|ACK: largest payload the sender of the option accepts in one datagram
+OPT_SESSION = 6  # in SYN and SYN|ACK: the data is a session of framed files (confundo.session)
+OPT_STRIPE = 7  # in SYN and SYN|ACK: the data is one byte range of a striped file (confundo.stripe)
+MAX_SACK_BLOCKS = 16
+
+# Compiled once: encoding and decoding never parse a format string or build intermediate bytes
+HEADER = struct.Struct('!I I H H')
+HEADER_SIZE = HEADER.size
+OPTION = struct.Struct('!B B')
+SACK_EDGES = struct.Struct('!I I')
+WINDOW_OPTION = struct.Struct('!B B I')
+MSS_OPTION = struct.Struct('!B B H')
+
+FLAG_FIN = 1
+FLAG_SYN = 1 << 1
+FLAG_ACK = 1 << 2
+FLAG_OPT = 1 << 3
+
+
 class Header:
+    __slots__ = ('sequence_number', 'acknowledgment_number', 'connection_id', 'ack', 'syn', 'fin',
+                 'sack_permitted', 'sack_blocks', 'window', 'extended_seq', 'mss', 'session', 'stripe')
+
     def __init__(self, sequence_number=0, acknowledgment_number=0,
-                 connection_id=0, ack=False, syn=False, fin=False):
+                 connection_id=0, ack=False, syn=False, fin=False,
+                 sack_permitted=False, sack_blocks=(), window=None, extended_seq=False, mss=None, session=False,
+                 stripe=False):
         self.sequence_number = sequence_number
         self.acknowledgment_number = acknowledgment_number if ack else 0
         self.connection_id = connection_id
         self.ack = ack
         self.syn = syn
         self.fin = fin
+        self.sack_permitted = sack_permitted
+        self.sack_blocks = sack_blocks[:MAX_SACK_BLOCKS] if sack_blocks else ()  # (left, right) edges, right is exclusive
+        self.window = window  # advertised receive window in bytes, None if not advertised
+        self.extended_seq = extended_seq
+        self.mss = mss  # maximum segment size offered in a SYN or SYN|ACK, None if not offered
+        self.session = session
+        self.stripe = stripe
 
-    def encode(self):
-        # Create flags
+    def options_length(self):
+        length = 0
+        if self.sack_permitted:
+            length += 2
+        if self.sack_blocks:
+            length += 2 + 8 * len(self.sack_blocks)
+        if self.window is not None:
+            length += WINDOW_OPTION.size
+        if self.extended_seq:
+            length += 2
+        if self.mss is not None:
+            length += MSS_OPTION.size
+        if self.session:
+            length += 2
+        if self.stripe:
+            length += 2
+        return length
+
+    def encode_options(self):
+        options = bytearray(self.options_length())
+        self.encode_options_into(options, 0)
+        return bytes(options)
+
+    def encode_options_into(self, buf, offset):
+        if self.sack_permitted:
+            OPTION.pack_into(buf, offset, OPT_SACK_PERMITTED, 2)
+            offset += 2
+        if self.sack_blocks:
+            OPTION.pack_into(buf, offset, OPT_SACK, 2 + 8 * len(self.sack_blocks))
+            offset += 2
+            for left, right in self.sack_blocks:
+                SACK_EDGES.pack_into(buf, offset, left, right)
+                offset += 8
+        if self.window is not None:
+            WINDOW_OPTION.pack_into(buf, offset, OPT_WINDOW, WINDOW_OPTION.size, self.window)
+            offset += WINDOW_OPTION.size
+        if self.extended_seq:
+            OPTION.pack_into(buf, offset, OPT_EXTENDED_SEQ, 2)
+            offset += 2
+        if self.mss is not None:
+            MSS_OPTION.pack_into(buf, offset, OPT_MSS, MSS_OPTION.size, self.mss)
+            offset += MSS_OPTION.size
+        if self.session:
+            OPTION.pack_into(buf, offset, OPT_SESSION, 2)
+            offset += 2
+        if self.stripe:
+            OPTION.pack_into(buf, offset, OPT_STRIPE, 2)
+            offset += 2
+        return offset
+
+    @property
+    def header_length(self):
+        length = self.options_length()
+        return HEADER_SIZE + (1 + length if length else 0)
+
+    def flags(self):
         flags = 0
         if self.ack:
-            flags |= (1 << 2)
+            flags |= FLAG_ACK
         if self.syn:
-            flags |= (1 << 1)
+            flags |= FLAG_SYN
         if self.fin:
-            flags |= 1
+            flags |= FLAG_FIN
+        return flags
 
-        # Pack the header into bytes
-        return struct.pack('!I I H H', self.sequence_number,
-                           self.acknowledgment_number, self.connection_id,
-                           flags)
+    def encode(self):
+        if not self.sack_permitted and not self.sack_blocks and self.window is None and not self.extended_seq and \
+           self.mss is None and not self.session and not self.stripe:
+            return HEADER.pack(self.sequence_number, self.acknowledgment_number, self.connection_id, self.flags())
+        buf = bytearray(self.header_length)
+        Header.encode_into(self, buf)
+        return bytes(buf)
+
+    def encode_into(self, buf, payload=b''):
+        '''Write the header followed by `payload` at the start of `buf` (e.g., a reusable send buffer), returns the length'''
+        flags = (FLAG_ACK if self.ack else 0) | (FLAG_SYN if self.syn else 0) | (FLAG_FIN if self.fin else 0)
+        if self.sack_permitted or self.sack_blocks or self.window is not None or self.extended_seq or \
+           self.mss is not None or self.session or self.stripe:
+            flags |= FLAG_OPT
+            buf[HEADER_SIZE] = self.options_length()
+            offset = self.encode_options_into(buf, HEADER_SIZE + 1)
+        else:
+            offset = HEADER_SIZE
+        HEADER.pack_into(buf, 0, self.sequence_number, self.acknowledgment_number, self.connection_id, flags)
+        end = offset + len(payload)
+        buf[offset:end] = payload
+        return end
 
     @classmethod
     def decode(cls, data):
-        # Unpack the header from bytes
-        sequence_number, acknowledgment_number, connection_id, flags = \
-            struct.unpack('!I I H H', data[:12])
+        header = cls()
+        header.decode_from(data)
+        return header
+
+    def decode_from(self, data):
+        '''Fill this header from the start of `data`, returns the header length'''
+        (self.sequence_number, self.acknowledgment_number,
+         self.connection_id, flags) = HEADER.unpack_from(data)
 
         # Extract flags
-        ack = bool(flags & (1 << 2))
-        syn = bool(flags & (1 << 1))
-        fin = bool(flags & 1)
+        self.ack = bool(flags & FLAG_ACK)
+        self.syn = bool(flags & FLAG_SYN)
+        self.fin = bool(flags & FLAG_FIN)
+        if not self.ack:
+            self.acknowledgment_number = 0
+        self.sack_permitted = False
+        self.sack_blocks = ()
+        self.window = None
+        self.extended_seq = False
+        self.mss = None
+        self.session = False
+        self.stripe = False
+        if flags & FLAG_OPT:
+            end = HEADER_SIZE + 1 + data[HEADER_SIZE]
+            self.decode_options(data, HEADER_SIZE + 1, end)
+            return end
+        return HEADER_SIZE
 
-        return cls(sequence_number, acknowledgment_number,
-                   connection_id, ack, syn, fin)
+    def decode_options(self, data, offset=0, end=None):
+        if end is None:
+            end = len(data)
+        i = offset
+        while i + 2 <= end:
+            kind, length = data[i], data[i + 1]
+            if length < 2:
+                break
+            if kind == OPT_SACK_PERMITTED:
+                self.sack_permitted = True
+            elif kind == OPT_SACK:
+                last = min(i + length, end) - 8
+                self.sack_blocks = [SACK_EDGES.unpack_from(data, j) for j in range(i + 2, last + 1, 8)]
+            elif kind == OPT_WINDOW and length >= WINDOW_OPTION.size and i + WINDOW_OPTION.size <= end:
+                self.window = WINDOW_OPTION.unpack_from(data, i)[2]
+            elif kind == OPT_EXTENDED_SEQ:
+                self.extended_seq = True
+            elif kind == OPT_MSS and length >= MSS_OPTION.size and i + MSS_OPTION.size <= end:
+                self.mss = MSS_OPTION.unpack_from(data, i)[2]
+            elif kind == OPT_SESSION:
+                self.session = True
+            elif kind == OPT_STRIPE:
+                self.stripe = True
+            i += length  # unknown options are skipped
 
     def __str__(self):
         return f"Seq: {self.sequence_number}, Ack: {self.acknowledgment_number}, " \
@@ -58,4 +211,37 @@ if __name__ == '__main__':
     assert header.syn == decoded_header.syn
     assert header.fin == decoded_header.fin
 
+    header = Header(1000, 2000, 300, True, False, False, sack_blocks=[(3000, 3412), (4000, 4824)])
+    encoded_data = header.encode() + b'payload'
+    decoded_header = Header.decode(encoded_data)
+
+    assert decoded_header.sack_blocks == header.sack_blocks
+    assert encoded_data[decoded_header.header_length:] == b'payload'
+
+    buf = bytearray(64)
+    length = header.encode_into(buf, b'payload')
+    assert bytes(buf[:length]) == encoded_data
+    assert Header().decode_from(memoryview(buf)[:length]) == header.header_length
+
+    header = Header(1000, 2000, 300, True, window=0)
+    decoded_header = Header.decode(header.encode())
+    assert decoded_header.window == 0 and decoded_header.sack_blocks == ()
+    assert Header.decode(Header(1, 2, 3, True).encode()).window is None
+
+    header = Header(4000000000, 0, 0, syn=True, sack_permitted=True, extended_seq=True)
+    decoded_header = Header.decode(header.encode())
+    assert decoded_header.extended_seq and decoded_header.sack_permitted
+    assert decoded_header.sequence_number == 4000000000
+
+    header = Header(50000, 0, 0, syn=True, sack_permitted=True, window=65536, extended_seq=True, mss=8960)
+    decoded_header = Header.decode(header.encode())
+    assert decoded_header.mss == 8960 and decoded_header.window == 65536 and decoded_header.extended_seq
+    assert Header.decode(Header(1, 2, 3, syn=True).encode()).mss is None
+
+    decoded_header = Header.decode(Header(50000, 0, 0, syn=True, session=True).encode())
+    assert decoded_header.session and not decoded_header.extended_seq
+    assert not Header.decode(Header(1, 2, 3, syn=True, mss=412).encode()).session
+    decoded_header = Header.decode(Header(50000, 0, 0, syn=True, stripe=True).encode())
+    assert decoded_header.stripe and not decoded_header.session
+
     print("Test passed!")
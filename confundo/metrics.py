@@ -0,0 +1,343 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+Connection and server metrics.
+
+Every confundo.Socket, aio socket and server.py instance owns a Metrics set of named
+counters, gauges and latency histograms, registered in a Registry (the default one unless
+told otherwise).  Counters and histograms are updated in place by the code that owns them
+(one attribute lookup and an addition per event, no locks: each set has a single writer);
+gauges such as cwnd, srtt or the bytes in flight are callbacks evaluated only when a
+snapshot is taken, so they cost nothing on the data path.
+
+Registry.snapshot() returns plain dicts, Registry.render() the same in the Prometheus text
+format, and serve() exports them from a background thread on a local HTTP port
+(`GET /metrics`, `GET /metrics.json`) or a Unix socket (one JSON snapshot per connection):
+
+    curl -s localhost:9100/metrics
+    python3 -c "import socket; s = socket.socket(socket.AF_UNIX); s.connect('/tmp/m'); print(s.recv(1 << 20))"
+'''
+
+from bisect import bisect_left
+import http.server
+import itertools
+import json
+import os
+import socketserver
+import threading
+import time
+import weakref
+
+# upper bounds (seconds) of the latency histogram buckets, a last bucket takes the rest
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+
+class Counter:
+    '''Monotonic count of events or bytes'''
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    '''Current value of something: set() explicitly, or read from `fn` at snapshot time'''
+
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = None
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    '''Distribution of latencies (seconds) over fixed buckets; quantiles are bucket upper bounds'''
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-quantile (the maximum for the last bucket), None if empty'''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': list(zip(self.bounds + (float('inf'),), self.counts)),
+        }
+
+
+class Metrics:
+    '''
+    The named metrics of one socket or server.  `kind` and `labels` (a dict, or a function
+    returning one for labels that change, such as the connection ID) identify it in snapshots.
+    '''
+
+    def __init__(self, kind, registry=None, labels=None):
+        self.kind = kind
+        self.labels = labels if labels is not None else {}
+        self.created = time.time()
+        self.metrics = {}
+        self.registry = registry if registry is not None else defaultRegistry()
+        self.registry.register(self)
+
+    def counter(self, name):
+        return self._add(name, Counter)
+
+    def gauge(self, name, fn=None):
+        gauge = self._add(name, Gauge)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        return self._add(name, lambda: Histogram(bounds))
+
+    def _add(self, name, factory):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = factory()
+        return metric
+
+    def close(self):
+        '''
+        Leave the registry.  It only keeps weak references, but gauges reading their owner make
+        a cycle that lives until the cyclic GC runs: finished connections close their set.
+        '''
+        self.registry.unregister(self)
+
+    def snapshot(self):
+        values = {}
+        for name, metric in list(self.metrics.items()):
+            try:
+                values[name] = metric.snapshot()
+            except Exception: # a gauge callback may race with its socket being torn down
+                values[name] = None
+        labels = self.labels() if callable(self.labels) else dict(self.labels)
+        return {'kind': self.kind, 'labels': labels, 'uptime': time.time() - self.created, 'metrics': values}
+
+
+class ConnectionMetrics(Metrics):
+    '''
+    Metrics of one connection.  The counters and histograms are attributes so the data path
+    updates them without a dictionary lookup; watch() adds the gauges read from the socket.
+    '''
+
+    def __init__(self, registry=None, kind="connection", labels=None):
+        super().__init__(kind, registry, labels)
+        self.packetsSent = self.counter("packets_sent")
+        self.packetsReceived = self.counter("packets_received")
+        self.bytesSent = self.counter("bytes_sent")           # payload, retransmissions included
+        self.bytesReceived = self.counter("bytes_received")   # payload accepted in order
+        self.bytesAcked = self.counter("bytes_acked")
+        self.retransmits = self.counter("retransmits")
+        self.dupAcks = self.counter("dup_acks")
+        self.fastRetransmits = self.counter("fast_retransmits")
+        self.timeouts = self.counter("timeouts")
+        self.rtt = self.histogram("rtt")
+        self.sendLatency = self.histogram("send_latency")     # duration of the application's send() calls
+
+    def watch(self, sock):
+        '''Gauges read from `sock` (a confundo Socket or aio socket) when a snapshot is taken'''
+        sock.cc.register(self)
+        self.gauge("srtt", lambda: sock.rtt.srtt)
+        self.gauge("rto", lambda: sock.rtt.rto)
+        self.gauge("rwnd", lambda: sock.rwnd)
+        self.gauge("in_flight", lambda: (sock.seqNum - sock.base) % sock.mod)
+        self.gauge("segment_size", lambda: sock.pmtu.size)
+        self.gauge("send_buffer", lambda: len(sock.outBuffer))
+        self.gauge("recv_buffer", lambda: len(sock.inBuffer))
+        self.gauge("state", lambda: sock.state.name)
+        self.gauge("throughput", lambda: self.bytesAcked.value / max(time.time() - self.created, 1e-9))
+
+
+class Registry:
+    '''Every live Metrics set, without keeping its socket or server alive'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sets = weakref.WeakValueDictionary()
+        self.ids = itertools.count(1)
+
+    def register(self, metrics):
+        with self.lock:
+            self.sets[next(self.ids)] = metrics
+
+    def unregister(self, metrics):
+        with self.lock:
+            for key, value in list(self.sets.items()):
+                if value is metrics:
+                    del self.sets[key]
+
+    def snapshot(self):
+        '''Snapshots of all sets, in registration order'''
+        with self.lock:
+            sets = [metrics for _, metrics in sorted(self.sets.items())]
+        return [metrics.snapshot() for metrics in sets]
+
+    def render(self):
+        '''The snapshot in the Prometheus text exposition format'''
+        lines = []
+        for snap in self.snapshot():
+            labels = ",".join(f'{key}="{_labelValue(value)}"'
+                              for key, value in [('kind', snap['kind'])] + sorted(snap['labels'].items()))
+            for name, value in sorted(snap['metrics'].items()):
+                if isinstance(value, dict):
+                    for bound, count in _cumulative(value['buckets']):
+                        lines.append(f'confundo_{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f"confundo_{name}_sum{{{labels}}} {value['sum']}")
+                    lines.append(f"confundo_{name}_count{{{labels}}} {value['count']}")
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"confundo_{name}{{{labels}}} {value}")
+                elif value is not None:
+                    lines.append(f'confundo_{name}{{{labels},value="{_labelValue(value)}"}} 1')
+        return "\n".join(lines) + "\n"
+
+
+def _labelValue(value):
+    '''`value` as the inside of a quoted label value: backslash, double quote and newline escaped'''
+    if isinstance(value, tuple):
+        value = ":".join(str(part) for part in value) # socket addresses as host:port
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _cumulative(buckets):
+    total = 0
+    for bound, count in buckets:
+        total += count
+        yield ("+Inf" if bound == float('inf') else bound), total
+
+
+_default = Registry()
+
+
+def defaultRegistry():
+    return _default
+
+
+class _HttpHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, contentType = self.server.registry.render().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, contentType = json.dumps(self.server.registry.snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # stdout carries the packet trace
+
+
+class _HttpServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.sendall(json.dumps(self.server.registry.snapshot()).encode() + b"\n")
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def serve(address, registry=None):
+    '''
+    Export `registry` from a background thread: over HTTP for a (host, port) address, or as
+    one JSON snapshot per connection for a Unix socket path.  Returns the server, shutdown()
+    stops it.
+    '''
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address) # left over from a previous run
+        server = _UnixServer(address, _UnixHandler)
+    else:
+        server = _HttpServer(address, _HttpHandler)
+    server.registry = registry if registry is not None else defaultRegistry()
+    threading.Thread(target=server.serve_forever, name="confundo-metrics", daemon=True).start()
+    return server
+
+
+def parseAddress(value):
+    '''`--metrics` argument: `[host:]port` for HTTP (localhost by default), anything else is a Unix socket path'''
+    host, _, port = value.rpartition(":")
+    if port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return value
+
+
+if __name__ == '__main__':
+    registry = Registry()
+    metrics = Metrics("test", registry, {'path': 'C:\\dir "a"\nb', 'remote': ("10.0.0.1", 5000)})
+    metrics.counter("packets").inc(3)
+    metrics.gauge("cwnd", lambda: 412.5)
+    metrics.gauge("state", lambda: 'say "hi"')
+    latency = metrics.histogram("latency", bounds=(0.1, 1.0))
+    for value in (0.05, 0.5, 2.0):
+        latency.observe(value)
+    labels = 'kind="test",path="C:\\\\dir \\"a\\"\\nb",remote="10.0.0.1:5000"'
+    assert registry.render().splitlines() == [
+        f'confundo_cwnd{{{labels}}} 412.5',
+        f'confundo_latency_bucket{{{labels},le="0.1"}} 1',
+        f'confundo_latency_bucket{{{labels},le="1.0"}} 2',
+        f'confundo_latency_bucket{{{labels},le="+Inf"}} 3',
+        f'confundo_latency_sum{{{labels}}} 2.55',
+        f'confundo_latency_count{{{labels}}} 3',
+        f'confundo_packets{{{labels}}} 3',
+        f'confundo_state{{{labels},value="say \\"hi\\""}} 1',
+    ]
+    assert latency.quantile(0.5) == 1.0 and latency.quantile(1.0) == 2.0  # bucket bounds, the maximum in the last
+
+    assert parseAddress("9100") == ("127.0.0.1", 9100)
+    assert parseAddress("0.0.0.0:9100") == ("0.0.0.0", 9100)
+    assert parseAddress(":9100") == ("127.0.0.1", 9100)
+    assert parseAddress("/tmp/metrics.sock") == "/tmp/metrics.sock"
+    assert parseAddress("/tmp/a:b") == "/tmp/a:b"
+    print("Test passed!")
@@ -0,0 +1,323 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+Lossy-link emulator.
+
+LinkEmulator is a UDP proxy that stands between Confundo endpoints on the local host and
+impairs the datagrams it relays, in each direction, according to a LinkProfile: a bandwidth
+cap with a bounded bottleneck queue, propagation delay and jitter, random loss, duplication
+and reordering, and a path MTU above which datagrams are dropped.  Every random decision
+comes from a generator seeded by `seed`, one per direction, and every datagram draws the
+same numbers whatever the outcome, so the same sequence of datagrams always meets the same
+losses, duplicates, reorderings and delays.
+
+    with LinkEmulator(("127.0.0.1", 5000), PROFILES['wan'], seed=1) as link:
+        # connect to link.address instead of port 5000
+        ...
+
+or, from the command line, `python3 -m confundo.netem 5003 5000 --profile lossy --seed 1`.
+
+Reordering follows Linux netem: a reordered datagram skips the propagation delay, so it
+overtakes the datagrams in front of it (and needs a delay to have any effect).  Jitter may
+reorder as well, each datagram's delay being drawn independently.
+'''
+
+import heapq
+import itertools
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+from .common import *
+from .header import Header
+from .metrics import Metrics
+
+
+class LinkProfile:
+    '''
+    Impairments of one direction of a link.  `delay` and `jitter` are in seconds (the delay of
+    each datagram is uniform in delay ± jitter), `loss`, `duplicate` and `reorder` are
+    probabilities, `rate` caps the bandwidth in bytes per second (None: no cap), `queue` is
+    the number of bytes the bottleneck holds before it drops datagrams (None: no limit) and
+    `mtu` the largest datagram (UDP payload) the link carries, as a router that does not
+    fragment would (None: no limit).
+    '''
+
+    def __init__(self, delay=0.0, jitter=0.0, loss=0.0, duplicate=0.0, reorder=0.0, rate=None, queue=None, mtu=None):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.rate = rate
+        self.queue = queue
+        self.mtu = mtu
+
+    def __repr__(self):
+        return (f"LinkProfile(delay={self.delay}, jitter={self.jitter}, loss={self.loss}, duplicate={self.duplicate}, "
+                f"reorder={self.reorder}, rate={self.rate}, queue={self.queue}, mtu={self.mtu})")
+
+
+# Profiles for benchmarks, the same impairments in both directions
+PROFILES = {
+    'loopback': LinkProfile(),
+    'lan': LinkProfile(delay=0.0005, rate=12500000, queue=1 << 20),
+    'wan': LinkProfile(delay=0.02, jitter=0.002, loss=0.001, rate=1250000, queue=64 * 1024),
+    'lossy': LinkProfile(delay=0.01, jitter=0.001, loss=0.05, duplicate=0.01, reorder=0.01, rate=1250000,
+                         queue=64 * 1024),
+    'longfat': LinkProfile(delay=0.1, loss=0.0005, rate=2500000, queue=256 * 1024),
+}
+
+
+class _Direction:
+    '''The impairments and counters of one direction of a LinkEmulator'''
+
+    def __init__(self, profile, seed, name, registry, labels):
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.linkFree = 0.0 # time at which the bottleneck has sent everything queued so far
+        self.first = None   # arrival time of the first datagram
+        self.firstFin = None # arrival time of the first FIN
+        self.metrics = Metrics("link", registry, dict(labels, direction=name))
+        self.datagrams = self.metrics.counter("datagrams")
+        self.bytes = self.metrics.counter("bytes")
+        self.payloadBytes = self.metrics.counter("payload_bytes")
+        self.lost = self.metrics.counter("lost")
+        self.queueDrops = self.metrics.counter("queue_drops")
+        self.tooBig = self.metrics.counter("too_big")
+        self.duplicated = self.metrics.counter("duplicated")
+        self.reordered = self.metrics.counter("reordered")
+        self.metrics.gauge("queue", lambda: max(self.linkFree - time.time(), 0.0) * self.profile.rate
+                           if self.profile.rate else 0)
+
+    def schedule(self, data, now):
+        '''Departure times of `data` arriving at `now`: none if it is lost, two if it is duplicated'''
+        profile = self.profile
+        header = Header()
+        try:
+            headerLength = header.decode_from(data)
+        except (IndexError, struct.error):
+            headerLength = len(data) # not Confundo, relayed all the same
+        self.datagrams.inc()
+        self.bytes.inc(len(data))
+        self.payloadBytes.inc(max(len(data) - headerLength, 0))
+        if self.first is None:
+            self.first = now
+        if header.fin and self.firstFin is None:
+            self.firstFin = now
+
+        # always the same four draws per datagram, so that each datagram meets the same fate
+        # for a given seed whatever the profile
+        lossDraw, duplicateDraw, reorderDraw, jitterDraw = (self.random.random() for _ in range(4))
+        if lossDraw < profile.loss:
+            self.lost.inc()
+            return ()
+        if profile.mtu is not None and len(data) > profile.mtu:
+            self.tooBig.inc()
+            return ()
+
+        departure = now
+        if profile.rate:
+            start = max(now, self.linkFree)
+            if profile.queue is not None and (start - now) * profile.rate + len(data) > profile.queue:
+                self.queueDrops.inc()
+                return ()
+            departure = self.linkFree = start + len(data) / profile.rate
+
+        if reorderDraw < profile.reorder and profile.delay > 0:
+            self.reordered.inc()
+        else:
+            departure += max(profile.delay + (2 * jitterDraw - 1) * profile.jitter, 0.0)
+
+        if duplicateDraw < profile.duplicate:
+            self.duplicated.inc()
+            return (departure, departure)
+        return (departure,)
+
+
+class LinkEmulator:
+    '''
+    UDP proxy from `address` (an ephemeral port on `listen` by default) to `target` that
+    impairs the datagrams from the clients to the target according to `forward` and those
+    coming back according to `reverse` (the same profile by default).  Each client address
+    gets a socket of its own towards the target, so the target sees one peer per client.
+    The proxy runs in a background thread from start() (or `with`) to close().
+    '''
+
+    def __init__(self, target, forward=None, reverse=None, seed=0, listen=("127.0.0.1", 0), registry=None):
+        self.target = target
+        forward = forward if forward is not None else LinkProfile()
+        reverse = reverse if reverse is not None else forward
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.front.bind(listen)
+        self.address = self.front.getsockname()
+        labels = {'listen': self.address, 'target': tuple(target)}
+        self.forward = _Direction(forward, seed * 2, "forward", registry, labels)
+        self.reverse = _Direction(reverse, seed * 2 + 1, "reverse", registry, labels)
+        self.backs = {}      # client address -> socket towards the target
+        self.clients = {}    # that socket -> client address
+        self.pending = []    # heap of (departure, order, socket, data, address)
+        self.order = itertools.count()
+        self.closed = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="confundo-netem", daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        '''Stop relaying; datagrams still in flight are discarded'''
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        for sock in [self.front] + list(self.backs.values()):
+            sock.close()
+
+    def run(self):
+        while not self.closed.is_set():
+            timeout = 0.05 # how often close() is noticed
+            if self.pending:
+                timeout = min(max(self.pending[0][0] - time.time(), 0.0), timeout)
+            readable, _, _ = select.select([self.front] + list(self.clients), [], [], timeout)
+            now = time.time()
+            for sock in readable:
+                try:
+                    data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+                except OSError:
+                    continue
+                if sock is self.front:
+                    back = self.backs.get(addr)
+                    if back is None:
+                        back = self.backs[addr] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        back.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+                        back.bind((self.address[0], 0))
+                        self.clients[back] = addr
+                    self._queue(self.forward, data, now, back, self.target)
+                else:
+                    self._queue(self.reverse, data, now, self.front, self.clients[sock])
+            self._release(time.time())
+
+    def _queue(self, direction, data, now, sock, addr):
+        for departure in direction.schedule(data, now):
+            heapq.heappush(self.pending, (departure, next(self.order), sock, data, addr))
+
+    def _release(self, now):
+        while self.pending and self.pending[0][0] <= now:
+            _, _, sock, data, addr = heapq.heappop(self.pending)
+            try:
+                sock.sendto(data, addr)
+            except OSError:
+                pass # nobody listening (yet): the datagram is lost like any other
+
+    def snapshot(self):
+        '''Counters of both directions, as Metrics.snapshot() of each'''
+        return {'forward': self.forward.metrics.snapshot(), 'reverse': self.reverse.metrics.snapshot()}
+
+
+def makeProfile(name=None, **overrides):
+    '''PROFILES[name] (no impairment without a name) with the attributes in `overrides` not None replaced'''
+    base = PROFILES[name] if name is not None else LinkProfile()
+    profile = LinkProfile(base.delay, base.jitter, base.loss, base.duplicate, base.reorder, base.rate, base.queue,
+                          base.mtu)
+    for key, value in overrides.items():
+        if value is not None:
+            setattr(profile, key, value)
+    return profile
+
+
+def selfTest():
+    from .metrics import Registry
+    registry = Registry()
+
+    # the same seed gives the same fates; more loss only adds losses, the other draws stay
+    datagrams = [Header(i, connection_id=1).encode() + bytes(100) for i in range(2000)]
+    profile = LinkProfile(delay=0.02, jitter=0.005, loss=0.1)
+    first, second = (_Direction(profile, 7, "forward", registry, {}) for _ in range(2))
+    fates = [first.schedule(data, 0.0) for data in datagrams]
+    assert fates == [second.schedule(data, 0.0) for data in datagrams]
+    lost = {i for i, fate in enumerate(fates) if not fate}
+    assert first.lost.value == len(lost) and 150 < len(lost) < 250
+    assert all(0.015 <= fate[0] <= 0.025 for fate in fates if fate)
+    lossier = _Direction(LinkProfile(delay=0.02, jitter=0.005, loss=0.3), 7, "forward", registry, {})
+    lossierFates = [lossier.schedule(data, 0.0) for data in datagrams]
+    assert lost < {i for i, fate in enumerate(lossierFates) if not fate}
+    assert all(fate == lossierFates[i] for i, fate in enumerate(fates) if fate and lossierFates[i])
+
+    # a seeded link relays what it does not lose, no earlier than the delay
+    target = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target.bind(("127.0.0.1", 0))
+    target.settimeout(1.0)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with LinkEmulator(target.getsockname(), LinkProfile(delay=0.02, loss=0.5), seed=3, registry=registry) as link:
+        start = time.time()
+        for data in datagrams[:100]:
+            client.sendto(data, link.address)
+        received = []
+        try:
+            while True:
+                received.append(target.recvfrom(MAX_DATAGRAM_SIZE)[0])
+        except socket.timeout:
+            pass
+        assert time.time() - start >= 0.02
+        assert len(received) == 100 - link.forward.lost.value and 25 < len(received) < 75
+        assert received == [data for data in datagrams[:100] if data in received] # in order, no jitter
+    client.close()
+    target.close()
+    print("Test passed!")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Relay UDP datagrams to a Confundo endpoint over an emulated lossy link")
+    parser.add_argument("port", type=int, nargs='?', help="Port to listen on")
+    parser.add_argument("target", nargs='?', help="[HOST:]PORT to relay to (127.0.0.1 by default)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=None, help="Start from a predefined link")
+    parser.add_argument("--delay", type=float, default=None, help="One-way delay (ms)")
+    parser.add_argument("--jitter", type=float, default=None, help="Delay variation (ms)")
+    parser.add_argument("--loss", type=float, default=None, help="Loss probability")
+    parser.add_argument("--duplicate", type=float, default=None, help="Duplication probability")
+    parser.add_argument("--reorder", type=float, default=None, help="Probability that a datagram skips the delay")
+    parser.add_argument("--rate", type=int, default=None, help="Bandwidth cap (bytes per second)")
+    parser.add_argument("--queue", type=int, default=None, help="Bottleneck queue (bytes)")
+    parser.add_argument("--mtu", type=int, default=None, help="Largest datagram relayed (bytes of UDP payload)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random decisions")
+    parser.add_argument("--self-test", action="store_true", help="Test the emulator and exit")
+    args = parser.parse_args()
+
+    if args.self_test:
+        selfTest()
+        return
+    if args.port is None or args.target is None:
+        parser.error("the following arguments are required: port, target")
+
+    host, _, port = args.target.rpartition(":")
+    profile = makeProfile(args.profile,
+                          delay=args.delay / 1000 if args.delay is not None else None,
+                          jitter=args.jitter / 1000 if args.jitter is not None else None,
+                          loss=args.loss, duplicate=args.duplicate, reorder=args.reorder, rate=args.rate,
+                          queue=args.queue, mtu=args.mtu)
+    link = LinkEmulator((host or "127.0.0.1", int(port)), profile, seed=args.seed, listen=("0.0.0.0", args.port))
+    print(f"Relaying 0.0.0.0:{args.port} to {host or '127.0.0.1'}:{port} over {profile}")
+    try:
+        link.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for name, snap in link.snapshot().items():
+            print(name, " ".join(f"{key}={value}" for key, value in snap['metrics'].items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+import time
+
+from .common import *
+
+
+class Pacer:
+    '''
+    Token bucket that spreads segments over the RTT instead of sending the whole window in
+    one burst.  The rate comes from the congestion controller (CwndControl.pacing_rate) and is
+    optionally capped by `maxRate`; tokens are bytes and at most `burst` of them accumulate,
+    so an idle connection may send PACING_BURST segments back-to-back.  Without a known rate
+    (no RTT sample yet and no cap) the sender is not paced.
+    '''
+
+    def __init__(self, enabled=True, maxRate=None, burst=PACING_BURST * MTU):
+        self.enabled = enabled
+        self.maxRate = maxRate # bytes per second, None for no cap
+        self.burst = burst
+        self.rate = None
+        self.tokens = burst
+        self.lastTime = time.time()
+
+    def setSegmentSize(self, size):
+        '''Segments are `size` bytes from now on: the burst stays PACING_BURST segments'''
+        self.burst = PACING_BURST * size
+
+    def update(self, rate):
+        '''Set the rate (bytes per second) suggested by the congestion controller, None if unknown'''
+        if not self.enabled:
+            rate = None
+        if self.maxRate is not None:
+            rate = self.maxRate if rate is None else min(rate, self.maxRate)
+        self._refill()
+        self.rate = rate
+
+    def delay(self, size):
+        '''Seconds to wait before `size` more bytes may be sent'''
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        if self.tokens >= min(size, self.burst):
+            return 0.0
+        return (min(size, self.burst) - self.tokens) / self.rate
+
+    def consume(self, size):
+        '''`size` bytes were sent; retransmissions that bypass delay() may leave the bucket in debt'''
+        if self.rate is not None:
+            self.tokens -= size
+
+    def _refill(self):
+        now = time.time()
+        if self.rate is not None:
+            self.tokens = min(self.tokens + (now - self.lastTime) * self.rate, self.burst)
+        self.lastTime = now
+
+
+if __name__ == '__main__':
+    # not paced until the congestion controller knows a rate
+    pacer = Pacer()
+    assert pacer.delay(MTU) == 0.0
+
+    # a full bucket sends PACING_BURST segments back-to-back, then one every MTU / rate seconds
+    pacer.update(100 * MTU)
+    for _ in range(PACING_BURST):
+        assert pacer.delay(MTU) == 0.0
+        pacer.consume(MTU)
+    assert abs(pacer.delay(MTU) - 0.01) < 0.002
+    pacer.consume(MTU) # a retransmission that did not wait leaves the bucket in debt
+    assert abs(pacer.delay(MTU) - 0.02) < 0.002
+
+    # segments sent as delay() allows go out at the rate
+    start = time.time()
+    for _ in range(10):
+        time.sleep(pacer.delay(MTU))
+        pacer.consume(MTU)
+    assert 0.1 <= time.time() - start < 0.2
+
+    # an idle connection saves up at most the burst
+    pacer.lastTime -= 10
+    assert pacer.delay(PACING_BURST * MTU) == 0.0 and pacer.delay(PACING_BURST * MTU + 1) == 0.0
+    pacer.consume(PACING_BURST * MTU)
+    assert pacer.delay(MTU) > 0.0
+
+    # maxRate caps the rate of the controller and paces on its own; disabled, only the cap paces
+    capped = Pacer(maxRate=1000)
+    capped.update(10 ** 6)
+    assert capped.rate == 1000
+    capped.update(None)
+    assert capped.rate == 1000
+    disabled = Pacer(enabled=False)
+    disabled.update(10 ** 6)
+    assert disabled.rate is None and disabled.delay(10 ** 6) == 0.0
+    print("Test passed!")
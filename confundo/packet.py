@@ -7,15 +7,34 @@ from .header import Header
 class Packet(Header):
     '''Abstraction to handle the whole Confundo packet (e.g., with payload, if present)'''
 
-    def __init__(self, payload=b"", isDup=False, **kwargs):
-        super(Packet, self).__init__(**kwargs)
+    __slots__ = ('payload', 'isDup')
+
+    def __init__(self, payload=b"", isDup=False, seqNum=0, ackNum=0, connId=0, isAck=False, isSyn=False, isFin=False,
+                 sackPermitted=False, sackBlocks=(), window=None, extendedSeq=False, mss=None, session=False,
+                 stripe=False):
+        super(Packet, self).__init__(seqNum, ackNum, connId, isAck, isSyn, isFin, sackPermitted, sackBlocks, window,
+                                     extendedSeq, mss, session, stripe)
         self.payload = payload
         self.isDup = isDup # only for printing flags
 
+    # Short field names used by confundo.socket and format_line
+    seqNum = property(lambda self: self.sequence_number)
+    ackNum = property(lambda self: self.acknowledgment_number)
+    connId = property(lambda self: self.connection_id)
+    isAck = property(lambda self: self.ack)
+    isSyn = property(lambda self: self.syn)
+    isFin = property(lambda self: self.fin)
+    sackPermitted = property(lambda self: self.sack_permitted)
+    sackBlocks = property(lambda self: self.sack_blocks)
+    extendedSeq = property(lambda self: self.extended_seq)
+
     def decode(self, fullPacket):
-        super(Packet, self).decode(fullPacket[0:12])
-        self.payload = fullPacket[12:]
+        # the payload is a view into the received datagram, not a copy
+        self.payload = memoryview(fullPacket)[self.decode_from(fullPacket):]
         return self
 
     def encode(self):
         return super(Packet, self).encode() + self.payload
+
+    def encode_into(self, buf, payload=None):
+        return Header.encode_into(self, buf, self.payload if payload is None else payload)
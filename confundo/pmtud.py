@@ -0,0 +1,165 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+import socket
+import sys
+
+from .common import *
+
+# <netinet/in.h> on Linux, not exported by the socket module
+_IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+_IP_PMTUDISC_PROBE = getattr(socket, 'IP_PMTUDISC_PROBE', 3) # set DF, ignore the kernel's path MTU cache
+
+
+def checkMss(mss):
+    '''
+    `mss`, the largest segment to offer in a handshake; ValueError unless it is between MTU,
+    which every peer must accept, and MAX_MSS, which fits the datagram buffers and the option.
+    '''
+    if not MTU <= mss <= MAX_MSS:
+        raise ValueError(f"mss must be between {MTU} and {MAX_MSS} bytes, not {mss}")
+    return mss
+
+
+def agreedMss(mss, peerMss):
+    '''Segments are at most the smaller of both offers in the handshake, MTU for a peer that makes none (or less)'''
+    return min(mss, max(peerMss or MTU, MTU))
+
+
+def dontFragment(sock):
+    '''
+    Send the datagrams of `sock` with the IP "don't fragment" bit, so that a probe larger than
+    the path is dropped instead of fragmented.  Returns False where this is not supported:
+    probes are then fragmented like any datagram and always get through.
+    '''
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, _IP_MTU_DISCOVER, _IP_PMTUDISC_PROBE)
+    except OSError:
+        return False
+    return True
+
+
+class PathMtu:
+    '''
+    Segment size of a sender, with optional packetization layer path MTU discovery (RFC 4821,
+    simplified).
+
+    Without probing the segment size is `maximum`, the size agreed in the handshake.  With
+    probing the connection starts with `base`-byte segments, which any path carries, and tries
+    each larger size of PMTU_PROBE_SIZES up to `maximum` by sending one segment of that size
+    filled with data (the probe).  An ACK that covers the probe confirms the size, which
+    becomes the segment size; a probe lost PMTU_MAX_PROBES times ends the search below its
+    size.  Probe losses are handled as any loss by congestion control.  When a raised size
+    runs into PMTU_BLACKHOLE_TIMEOUTS timeouts in a row the path has probably shrunk: the
+    size goes back to `base` and the search starts over.
+
+    The sender reports its events with offsets from the first unacknowledged byte, as
+    Scoreboard does.
+    '''
+
+    def __init__(self, maximum=MTU, probing=False, base=MTU, sizes=PMTU_PROBE_SIZES):
+        self.probing = probing
+        self.sizes = sizes
+        self.base = base
+        self.setMaximum(maximum)
+
+    def setMaximum(self, maximum):
+        '''Largest segment the receiver accepts, known once the handshake is done'''
+        self.maximum = maximum
+        self.limit = maximum # sizes above it are not probed
+        self.base = min(self.base, maximum)
+        self.size = self.base if self.probing else maximum
+        self.probeSize = None # size of the probe in flight, None if there is none
+        self.probeEnd = 0     # offset right after the probe
+        self.failures = 0     # lost probes of probeSize
+        self.timeouts = 0     # consecutive timeouts
+
+    def nextProbe(self):
+        '''Size of the probe to send as the next new segment, None if none is due'''
+        if not self.probing or self.probeSize is not None:
+            return None
+        for size in self.sizes + (self.maximum,):
+            if self.size < size <= self.limit:
+                return size
+        return None
+
+    def on_probe_sent(self, size, end):
+        '''A probe of `size` bytes went out, its data ends at offset `end`'''
+        self.probeSize = size
+        self.probeEnd = end
+
+    def on_ack(self, ackedDataLen):
+        '''The first unacknowledged byte moved by `ackedDataLen`, returns True if that confirmed a probe'''
+        self.timeouts = 0
+        if self.probeSize is None:
+            return False
+        self.probeEnd -= ackedDataLen
+        if self.probeEnd > 0:
+            return False
+        self.size, self.probeSize, self.failures = self.probeSize, None, 0
+        return True
+
+    def on_loss(self):
+        '''Fast retransmit or timeout: a probe in flight is taken as lost, it may be tried again'''
+        if self.probeSize is None:
+            return
+        self.failures += 1
+        if self.failures >= PMTU_MAX_PROBES:
+            self.limit = self.probeSize - 1
+            self.failures = 0
+        self.probeSize = None
+
+    def on_timeout(self):
+        probe = self.probeSize is not None
+        self.on_loss()
+        if not self.probing or probe or self.size <= self.base:
+            return # without probing the agreed size could never be found again
+        self.timeouts += 1
+        if self.timeouts >= PMTU_BLACKHOLE_TIMEOUTS:
+            self.size, self.timeouts = self.base, 0
+            self.limit = self.maximum
+
+
+if __name__ == '__main__':
+    assert checkMss(MTU) == MTU and checkMss(MAX_MSS) == MAX_MSS
+    for mss in (0, -1, MTU - 1, MAX_MSS + 1, 70000):
+        try:
+            checkMss(mss)
+            assert False, mss
+        except ValueError:
+            pass
+    assert agreedMss(MAX_MSS, None) == MTU and agreedMss(MAX_MSS, 1460) == 1460
+    assert agreedMss(1460, 65535) == 1460 and agreedMss(1460, 0) == MTU
+
+    # the agreed size is kept through timeouts unless probing can find it again
+    mtu = PathMtu(probing=False)
+    mtu.setMaximum(MAX_MSS)
+    for _ in range(PMTU_BLACKHOLE_TIMEOUTS + 1):
+        mtu.on_timeout()
+    mtu.on_ack(MTU)
+    assert mtu.size == MAX_MSS and mtu.nextProbe() is None
+
+    # probing starts at MTU, an acknowledged probe raises the size, a lost one is retried
+    mtu = PathMtu(probing=True)
+    mtu.setMaximum(MAX_MSS)
+    assert mtu.size == MTU and mtu.nextProbe() == PMTU_PROBE_SIZES[0]
+    mtu.on_probe_sent(1460, 1460)
+    assert mtu.nextProbe() is None
+    assert not mtu.on_ack(1000) and mtu.on_ack(460) and mtu.size == 1460
+    for _ in range(PMTU_MAX_PROBES):
+        assert mtu.nextProbe() == MAX_MSS
+        mtu.on_probe_sent(MAX_MSS, MAX_MSS)
+        mtu.on_loss()
+    assert mtu.size == 1460 and mtu.nextProbe() is None  # a path MTU below jumbo frames
+
+    # a raised size that keeps timing out falls back to MTU and the search starts over
+    for _ in range(PMTU_BLACKHOLE_TIMEOUTS):
+        mtu.on_timeout()
+    assert mtu.size == MTU and mtu.nextProbe() == 1460
+
+    # the receiver's limit caps the probes
+    mtu = PathMtu(probing=True)
+    mtu.setMaximum(1000)
+    assert mtu.nextProbe() == 1000
+    print("Test passed!")
@@ -0,0 +1,143 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+from .common import *
+
+
+class LossRecovery:
+    '''
+    Loss detection and recovery of a sender, shared by confundo.Socket, the asyncio socket and
+    client.py, which each keep their own send buffer and only resend where this tells them to.
+
+    DUP_ACK_THRESHOLD duplicate ACKs start a fast retransmit of the first unacknowledged segment
+    and NewReno fast recovery, which lasts until everything sent before it is acknowledged; an
+    ACK that advances but ends short of that (a partial ACK) means the next hole is lost as
+    well.  When the retransmission timer expires the sender goes back to its first
+    unacknowledged byte, unless the timer was the persist timer of a closed receive window.
+    The congestion controller `cc`, RttEstimator `rtt`, PathMtu `pmtu` and ConnectionMetrics
+    `metrics` (None for none) are told of every event; `resized` is called whenever the
+    segment size changes.
+    '''
+
+    def __init__(self, cc, rtt, pmtu, metrics=None, resized=None):
+        self.cc = cc
+        self.rtt = rtt
+        self.pmtu = pmtu
+        self.metrics = metrics
+        self.resized = resized
+        self.nDupAcks = 0
+        self.recoverEnd = None # bytes outstanding when fast recovery started, None outside of fast recovery
+
+    def reset(self):
+        '''A new transfer starts: nothing is being recovered'''
+        self.nDupAcks = 0
+        self.recoverEnd = None
+
+    def isDuplicate(self, advance, sentEnd, rwnd):
+        '''
+        Whether an ACK that acknowledges `advance` more bytes, while `sentEnd` bytes have been
+        sent, is a duplicate ACK.  An ACK whose window `rwnd` no longer covers what was sent is
+        flow control, not a sign of loss.
+        '''
+        return advance == 0 and sentEnd > 0 and (rwnd is None or rwnd >= sentEnd)
+
+    def on_dup_ack(self, sentEnd, flightSize, sack):
+        '''
+        A duplicate ACK arrived with `flightSize` bytes in flight and not SACKed (`sack`: whether
+        SACK is used).  Returns True when it is time for a fast retransmit: the sender resends
+        its first unacknowledged segment right away.
+        '''
+        self.nDupAcks += 1
+        if self.metrics is not None:
+            self.metrics.dupAcks.inc()
+        if self.recoverEnd is None and self.nDupAcks == DUP_ACK_THRESHOLD:
+            if self.metrics is not None:
+                self.metrics.fastRetransmits.inc()
+            self.cc.on_fast_retransmit(flightSize)
+            self.pmtu.on_loss()
+            self.recoverEnd = sentEnd
+            return True
+        if self.recoverEnd is not None and not sack:
+            self.cc.on_dup_ack() # with SACK, SACKed bytes already leave the window
+        return False
+
+    def on_new_ack(self, advance):
+        '''
+        `advance` more bytes were acknowledged.  Returns True for a partial ACK in fast recovery:
+        the sender resends its (new) first unacknowledged segment, once its scoreboard has taken
+        in the SACK blocks of the ACK.
+        '''
+        self.nDupAcks = 0
+        if self.metrics is not None:
+            self.metrics.bytesAcked.inc(advance)
+        if self.pmtu.on_ack(advance) and self.resized is not None:
+            self.resized() # the probe got through: larger segments from now on
+        if self.recoverEnd is None:
+            self.cc.on_ack(advance)
+            return False
+        if advance >= self.recoverEnd:
+            self.cc.on_recovery_exit()
+            self.recoverEnd = None
+            return False
+        self.cc.on_partial_ack(advance)
+        self.recoverEnd -= advance
+        return True
+
+    def on_expiry(self, rwnd, outstanding):
+        '''
+        The retransmission timer expired with `outstanding` bytes left to send.  Returns True if
+        it is the persist timer (RttEstimator.persist): the first segment goes out as a window
+        probe.  Otherwise it is a timeout, which ends fast recovery and shrinks the congestion
+        window.  Either way the timer backs off and the sender goes back to its first
+        unacknowledged byte.
+        '''
+        self.rtt.on_timeout()
+        if self.rtt.persist(rwnd, self.pmtu.size, outstanding):
+            return True
+        if self.metrics is not None:
+            self.metrics.timeouts.inc()
+        self.cc.on_timeout()
+        size = self.pmtu.size
+        self.pmtu.on_timeout()
+        if self.pmtu.size != size and self.resized is not None:
+            self.resized() # black hole: back to segments any path carries
+        self.reset()
+        return False
+
+
+if __name__ == '__main__':
+    from .cwnd_control import make_cwnd_control
+    from .pmtud import PathMtu
+    from .rtt import RttEstimator
+
+    def recovery():
+        cc = make_cwnd_control("reno")
+        cc.cwnd = 10 * MTU
+        return LossRecovery(cc, RttEstimator(), PathMtu(MTU))
+
+    # only ACKs that acknowledge nothing while data is out, within the window, are duplicates
+    loss = recovery()
+    assert loss.isDuplicate(0, 1000, None) and loss.isDuplicate(0, 1000, 1000)
+    assert not loss.isDuplicate(0, 0, None) and not loss.isDuplicate(10, 1000, None)
+    assert not loss.isDuplicate(0, 1000, 500) # the window shrank below what was sent
+
+    # the third duplicate ACK is a fast retransmit and starts recovery
+    assert not loss.on_dup_ack(10 * MTU, 10 * MTU, False) and not loss.on_dup_ack(10 * MTU, 10 * MTU, False)
+    assert loss.on_dup_ack(10 * MTU, 10 * MTU, False) and loss.recoverEnd == 10 * MTU
+    assert loss.cc.ssthresh == 5 * MTU
+    assert not loss.on_dup_ack(10 * MTU, 10 * MTU, False) # no second fast retransmit in recovery
+
+    # a partial ACK resends the next hole, the ACK of everything ends recovery
+    assert loss.on_new_ack(4 * MTU) and loss.recoverEnd == 6 * MTU
+    assert loss.on_new_ack(2 * MTU) and loss.recoverEnd == 4 * MTU
+    assert not loss.on_new_ack(4 * MTU) and loss.recoverEnd is None and loss.nDupAcks == 0
+    assert not loss.on_new_ack(MTU) # outside of recovery
+
+    # a timeout ends recovery; with a closed window the timer only probes it
+    loss = recovery()
+    for _ in range(DUP_ACK_THRESHOLD):
+        loss.on_dup_ack(10 * MTU, 10 * MTU, True)
+    rto = loss.rtt.rto
+    assert loss.on_expiry(0, 10 * MTU) and loss.recoverEnd == 10 * MTU and loss.rtt.rto == 2 * rto
+    assert not loss.on_expiry(None, 10 * MTU) and loss.recoverEnd is None and loss.nDupAcks == 0
+    assert loss.cc.cwnd < 10 * MTU and loss.rtt.rto == 4 * rto
+    print("Test passed!")
@@ -0,0 +1,113 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+import time
+
+from .common import *
+from .util import MOD, seqLess
+
+
+class RttEstimator:
+    '''
+    Retransmission timeout computed from RTT samples (RFC 6298).
+
+    One segment at a time is timed.  Its sample updates the smoothed RTT and RTT variation
+    with Jacobson's gains, and rto = srtt + max(CLOCK_GRANULARITY, 4 * rttvar), clamped to
+    [MIN_RTO, MAX_RTO].  Every timeout doubles rto until a new sample arrives.  Karn's rule:
+    once anything is retransmitted the timed segment is abandoned, since its ACK could
+    belong to either transmission.
+    '''
+
+    ALPHA = 1.0 / 8
+    BETA = 1.0 / 4
+    K = 4
+
+    def __init__(self, initialRto=RETX_TIME, minRto=MIN_RTO, maxRto=MAX_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.minRto = minRto
+        self.maxRto = maxRto
+        self.rto = min(max(initialRto, minRto), maxRto)
+        self.timedSeq = None  # sequence number that acknowledges the timed segment
+        self.timedAt = None
+        self.mod = MOD  # size of the connection's sequence space
+
+    def start(self, seqEnd):
+        '''A new segment ending right before `seqEnd` was sent; time it unless another one is being timed'''
+        if self.timedSeq is None:
+            self.timedSeq = seqEnd
+            self.timedAt = time.time()
+
+    def on_ack(self, ackNum):
+        '''Take a sample if `ackNum` covers the timed segment, returns the sample or None'''
+        if self.timedSeq is None or seqLess(ackNum, self.timedSeq, self.mod):
+            return None
+        rtt = time.time() - self.timedAt
+        self.on_sample(rtt)
+        self.timedSeq = None
+        return rtt
+
+    def on_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        rto = self.srtt + max(CLOCK_GRANULARITY, self.K * self.rttvar)
+        self.rto = min(max(rto, self.minRto), self.maxRto)
+
+    def on_retransmit(self):
+        '''Something was sent again: Karn's rule forbids sampling the segment being timed'''
+        self.timedSeq = None
+
+    def on_timeout(self):
+        '''Retransmission timer expired: back off exponentially'''
+        self.on_retransmit()
+        self.rto = min(self.rto * 2, self.maxRto)
+
+    def persist(self, window, segmentSize, outstanding):
+        '''
+        Whether the expired retransmission timer is the persist timer: the receiver's `window`
+        (None if it advertises none) has no room for the next segment of the `outstanding` bytes.
+        The first segment is then resent as a window probe, whose ACK carries the current window
+        (it may have reopened without the sender hearing of it), instead of treating the silence
+        as congestion.  on_timeout() backs off the probes like retransmissions.
+        '''
+        return window is not None and window < min(segmentSize, outstanding)
+
+    def __str__(self):
+        return f"srtt:{self.srtt} rttvar:{self.rttvar} rto:{self.rto}"
+
+
+if __name__ == '__main__':
+    rtt = RttEstimator(initialRto=1.0)
+    assert rtt.rto == 1.0 and rtt.on_ack(100) is None  # nothing timed
+    rtt.on_sample(0.2)
+    assert rtt.srtt == 0.2 and rtt.rttvar == 0.1 and abs(rtt.rto - 0.6) < 1e-9
+    rtt.on_sample(0.2)
+    assert abs(rtt.srtt - 0.2) < 1e-9 and abs(rtt.rttvar - 0.075) < 1e-9 and abs(rtt.rto - 0.5) < 1e-9
+    for _ in range(100):
+        rtt.on_sample(0.001)
+    assert rtt.rto == MIN_RTO  # clamped
+
+    # timeouts back off up to MAX_RTO
+    for _ in range(10):
+        rtt.on_timeout()
+    assert rtt.rto == MAX_RTO
+
+    # only an ACK that covers the timed segment is a sample, across wraparound
+    rtt.start(10)
+    rtt.start(20)  # already timing one
+    assert rtt.on_ack(MOD - 5) is None and rtt.timedSeq == 10
+    assert rtt.on_ack(15) is not None and rtt.timedSeq is None and rtt.rto < MAX_RTO
+
+    # Karn's rule: a retransmission abandons the timed segment
+    rtt.start(30)
+    rtt.on_retransmit()
+    assert rtt.on_ack(30) is None
+
+    # the persist timer: only a window too small for the next segment of what is left to send
+    assert rtt.persist(0, 1000, 5000) and rtt.persist(999, 1000, 5000)
+    assert not rtt.persist(None, 1000, 5000) and not rtt.persist(1000, 1000, 5000)
+    assert not rtt.persist(300, 1000, 200) and rtt.persist(0, 1000, 200)
+    print("Test passed!")
@@ -0,0 +1,83 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+from .util import MOD, seqDiff
+
+
+class Scoreboard:
+    '''
+    Sender-side record of the byte ranges the receiver reported in SACK blocks.
+
+    Ranges are kept as offsets from the first unacknowledged byte, sorted and disjoint,
+    so the send loop can skip data the receiver already holds and retransmit only holes.
+    '''
+
+    def __init__(self, mod=MOD):
+        self.ranges = []  # [start, end) offsets
+        self.mod = mod  # size of the connection's sequence space
+
+    def clear(self):
+        self.ranges = []
+
+    def update(self, base, blocks, inFlight):
+        '''Merge SACK blocks (sequence numbers) reported while `base` is the first unacknowledged byte'''
+        for left, right in blocks:
+            start = seqDiff(left, base, self.mod)
+            end = seqDiff(right, base, self.mod)
+            if start >= end or end > inFlight:
+                continue  # stale or bogus block
+            merged = []
+            for (s, e) in self.ranges:
+                if e < start or s > end:
+                    merged.append((s, e))
+                else:
+                    start, end = min(s, start), max(e, end)
+            merged.append((start, end))
+            merged.sort()
+            self.ranges = merged
+
+    def advance(self, amount):
+        '''The cumulative ACK moved forward by `amount` bytes'''
+        self.ranges = [(max(s - amount, 0), e - amount) for (s, e) in self.ranges if e > amount]
+
+    def covers(self, start, end):
+        return any(s <= start and end <= e for (s, e) in self.ranges)
+
+    def sacked(self, upTo):
+        '''Number of SACKed bytes below offset `upTo`'''
+        return sum(min(e, upTo) - s for (s, e) in self.ranges if s < upTo)
+
+    def skip(self, offset):
+        '''First offset at or after `offset` that is not SACKed'''
+        for (s, e) in self.ranges:
+            if s <= offset < e:
+                return e
+        return offset
+
+    def nextSacked(self, offset):
+        '''Start of the first SACKed range after `offset`, or None'''
+        for (s, e) in self.ranges:
+            if s > offset:
+                return s
+        return None
+
+
+if __name__ == '__main__':
+    base = MOD - 1000  # blocks are sequence numbers, which wrap around the sequence space
+    board = Scoreboard()
+    board.update(base, [((base + 2000) % MOD, (base + 3000) % MOD), ((base + 500) % MOD, (base + 1000) % MOD)], 4000)
+    assert board.ranges == [(500, 1000), (2000, 3000)]
+    board.update(base, [((base + 900) % MOD, (base + 2100) % MOD)], 4000)  # fills the hole: one range
+    assert board.ranges == [(500, 3000)]
+    board.update(base, [((base + 3500) % MOD, (base + 5000) % MOD), ((base + 100) % MOD, base)], 4000)
+    assert board.ranges == [(500, 3000)]  # beyond what is in flight, or empty: ignored
+
+    assert board.covers(600, 1000) and not board.covers(400, 600)
+    assert board.sacked(1000) == 500 and board.sacked(10000) == 2500
+    assert board.skip(100) == 100 and board.skip(500) == 3000
+    assert board.nextSacked(0) == 500 and board.nextSacked(500) is None
+
+    board.advance(800)  # the cumulative ACK moved into the range
+    assert board.ranges == [(0, 2200)]
+    board.advance(3000)
+    assert board.ranges == []
+    print("Test passed!")
@@ -0,0 +1,291 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+Sessions: many files over one Confundo connection.
+
+A session is a connection whose SYN and SYN|ACK both carry the session option
+(header.OPT_SESSION).  Its data is a sequence of frames, one per file, and the FIN ends it:
+
+    +------------------+----------------+---------------+-----------------+
+    | name length (2)  | file size (8)  | name (UTF-8)  | file size bytes |
+    +------------------+----------------+---------------+-----------------+
+
+Names are relative paths with '/' separators; receivers refuse empty, absolute and '..'
+components.  The files share one handshake, one FIN exchange and one congestion window, so
+a small file costs little more than its bytes.
+
+    sender:   sock = Socket(session=True); sock.connect(...); sock.sendfiles(["photos", "notes.txt"])
+    receiver: conn = listener.accept(); names = conn.recvfiles("incoming")
+'''
+
+import os
+import struct
+
+from .common import *
+from .buffer import mapFile
+from .sink import FileSink
+
+FILE_FRAME = struct.Struct('!H Q')  # name length, file size
+
+
+def sessionFiles(paths):
+    '''
+    (path, name) of every file to send for `paths`, files or directories.  A file is named
+    after its base name, the files under a directory (recursively, in sorted order) after
+    their path from the directory's parent, e.g. "photos/2024/a.jpg".
+    '''
+    files = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if not os.path.exists(path):
+            raise ValueError(f"{path}: no such file or directory")
+        if not os.path.isdir(path):
+            files.append((path, os.path.basename(path)))
+            continue
+        parent = os.path.dirname(os.path.abspath(path))
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                full = os.path.join(root, name)
+                files.append((full, os.path.relpath(os.path.abspath(full), parent).replace(os.sep, '/')))
+    seen = set()
+    for _, name in files:
+        if name in seen:
+            raise ValueError(f"two files are named {name!r} in the session")
+        seen.add(name)
+    return files
+
+
+def frameHeader(name, size):
+    '''The frame header and name that precede `size` bytes of the file `name`'''
+    encoded = name.encode('utf-8')
+    return FILE_FRAME.pack(len(encoded), size) + encoded
+
+
+def sessionChunks(files, useMmap=True, chunkSize=MMAP_CHUNK):
+    '''
+    The data of a session of `files`, (path, name) pairs, as chunks: each frame header
+    followed by the file, memory-mapped as by mapFile (or read `chunkSize` bytes at a time).
+    '''
+    for path, name in files:
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            yield frameHeader(name, size)
+            sent = 0
+            if useMmap and size > 0:
+                for chunk in mapFile(file, chunkSize):
+                    sent += len(chunk)
+                    yield chunk
+            else:
+                while sent < size:
+                    chunk = file.read(min(chunkSize, size - sent))
+                    if not chunk:
+                        break
+                    sent += len(chunk)
+                    yield chunk
+            if sent != size:
+                raise RuntimeError(f"{path} changed size while it was sent")
+
+
+def safePath(directory, name):
+    '''Where the file `name` of a session goes under `directory`; ValueError for names that would leave it'''
+    parts = name.split('/')
+    if not name or any(part in ('', '.', '..') or '\0' in part or os.sep in part for part in parts):
+        raise ValueError(f"bad file name in session: {name!r}")
+    return os.path.join(directory, *parts)
+
+
+class SessionReader:
+    '''
+    Incremental parser of session data: feed() takes the in-order data as it arrives, in
+    pieces of any size, and calls `openFile(name, size)` at the start of each file.  The object
+    it returns gets the file's data through write() and a close() at its end.
+    '''
+
+    def __init__(self, openFile):
+        self.openFile = openFile
+        self.frame = bytearray() # frame header and name received so far
+        self.current = None      # file being received
+        self.remaining = 0       # bytes of it still to come
+        self.files = []          # names of the files started so far
+
+    def complete(self):
+        '''Whether the data ended on a file boundary'''
+        return self.current is None and not self.frame
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            if self.current is not None:
+                piece = data[:self.remaining]
+                self.current.write(piece)
+                self.remaining -= len(piece)
+                data = data[len(piece):]
+                if self.remaining == 0:
+                    self._endFile()
+                continue
+
+            # the frame header, then as much of the name as it announces
+            need = FILE_FRAME.size
+            if len(self.frame) >= need:
+                need += FILE_FRAME.unpack_from(self.frame)[0]
+            piece = data[:need - len(self.frame)]
+            self.frame += piece
+            data = data[len(piece):]
+            if len(self.frame) >= FILE_FRAME.size and \
+               len(self.frame) == FILE_FRAME.size + FILE_FRAME.unpack_from(self.frame)[0]:
+                self._startFile()
+
+    def _startFile(self):
+        nameLength, size = FILE_FRAME.unpack_from(self.frame)
+        try:
+            name = bytes(self.frame[FILE_FRAME.size:FILE_FRAME.size + nameLength]).decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("file name in session is not UTF-8")
+        self.frame = bytearray()
+        self.files.append(name)
+        self.current = self.openFile(name, size)
+        self.remaining = size
+        if size == 0:
+            self._endFile()
+
+    def _endFile(self):
+        self.current.close()
+        self.current = None
+
+
+class SessionSink:
+    '''
+    Write-behind sink for the data of a session (server.py), with the interface of FileSink:
+    every file of the session is written to `directory`/<name> through a FileSink of its own.
+    The files being written share `capacity`, so memory stays bounded per connection however
+    many small files are still on their way to the disk.  A malformed session stops the
+    writes, and the error is reported like a write error.
+    '''
+
+    def __init__(self, directory, capacity=SINK_BUFFER_SIZE, writer=None):
+        self.directory = directory
+        self.capacity = capacity
+        self.writer = writer
+        self.sinks = [] # FileSinks of the files not completely written yet
+        self.reader = SessionReader(self._open)
+        self.sessionError = None
+        self.closed = False
+
+    @property
+    def error(self):
+        if self.sessionError is not None:
+            return self.sessionError
+        return next((sink.error for sink in self.sinks if sink.error is not None), None)
+
+    @property
+    def files(self):
+        return self.reader.files
+
+    @property
+    def finished(self):
+        return self.closed and all(sink.finished for sink in self.sinks)
+
+    def _open(self, name, size):
+        path = safePath(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        sink = FileSink(path, self.capacity, writer=self.writer)
+        self.sinks.append(sink)
+        return sink
+
+    def space(self):
+        # a file whose descriptor is closed has been written completely
+        self.sinks = [sink for sink in self.sinks if sink.fd is not None or sink.error is not None]
+        used = sum(sink.capacity - sink.space() for sink in self.sinks)
+        return max(self.capacity - used, 0)
+
+    def write(self, data):
+        if self.sessionError is not None:
+            return
+        try:
+            self.reader.feed(data)
+        except (ValueError, OSError) as e:
+            self.sessionError = e # the rest of the session is discarded
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.reader.current is not None:
+            self.reader.current.close()
+        if self.sessionError is None and not self.reader.complete():
+            self.sessionError = ValueError("session ended in the middle of a file")
+        for sink in self.sinks:
+            sink.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    session = frameHeader("a.txt", 5) + b"hello" + frameHeader("empty", 0) + frameHeader("d/b.bin", 3) + b"xyz"
+
+    class Recorder:
+        def __init__(self, name, size):
+            self.name, self.size, self.data, self.closed = name, size, bytearray(), False
+        def write(self, data):
+            self.data += data
+        def close(self):
+            self.closed = True
+
+    # frames split anywhere across feeds, down to one byte at a time
+    for step in (1, 2, 7, len(session)):
+        opened = []
+        reader = SessionReader(lambda name, size: opened.append(Recorder(name, size)) or opened[-1])
+        for i in range(0, len(session), step):
+            reader.feed(session[i:i + step])
+        assert reader.complete() and reader.files == ["a.txt", "empty", "d/b.bin"]
+        assert [(f.name, bytes(f.data), f.closed) for f in opened] == \
+            [("a.txt", b"hello", True), ("empty", b"", True), ("d/b.bin", b"xyz", True)]
+
+    # a session that ends inside a frame header, a name or a file is incomplete
+    for end in (1, FILE_FRAME.size + 2, FILE_FRAME.size + 5 + 2):
+        reader = SessionReader(Recorder)
+        reader.feed(session[:end])
+        assert not reader.complete()
+
+    # names that would leave the directory are refused
+    assert safePath("out", "d/b.bin") == os.path.join("out", "d", "b.bin")
+    for name in ("", "../x", "a/../../x", "/etc/passwd", "a//b", "./a", "a/.", "a\0b"):
+        try:
+            safePath("out", name)
+            assert False, name
+        except ValueError:
+            pass
+
+    with tempfile.TemporaryDirectory() as directory:
+        sink = SessionSink(directory)
+        sink.write(session[:10])
+        sink.write(session[10:])
+        sink.close()
+        while not sink.finished:
+            time.sleep(0.01)
+        assert sink.error is None and sink.files == ["a.txt", "empty", "d/b.bin"]
+        with open(os.path.join(directory, "d", "b.bin"), 'rb') as f:
+            assert f.read() == b"xyz"
+        assert os.path.getsize(os.path.join(directory, "empty")) == 0
+
+        # a traversal stops the session, and is reported as its error
+        sink = SessionSink(directory)
+        sink.write(frameHeader("../escaped", 1) + b"!")
+        sink.close()
+        assert isinstance(sink.error, ValueError) and not os.path.exists(os.path.join(directory, "..", "escaped"))
+
+        # so does a session cut in the middle of a file
+        sink = SessionSink(os.path.join(directory, "cut"))
+        sink.write(frameHeader("c", 10) + b"abc")
+        sink.close()
+        while not sink.finished:
+            time.sleep(0.01)
+        assert isinstance(sink.error, ValueError)
+
+    print("Test passed!")
@@ -0,0 +1,191 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from .common import *
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+
+_writer = None
+_writerLock = threading.Lock()
+
+
+def sharedWriter():
+    '''The thread pool that performs the disk writes of every FileSink that is not given its own'''
+    global _writer
+    with _writerLock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(SINK_WORKERS, thread_name_prefix="confundo-sink")
+        return _writer
+
+
+class FileSink:
+    '''
+    Write-behind buffer in front of an output file.
+
+    write() only queues the payload (a memoryview into the received datagram is kept as-is)
+    and returns right away; queued data is written by a worker thread once SINK_FLUSH_SIZE
+    bytes are pending or when flush() is called, so a slow disk never stalls the caller.  At
+    most one write per sink is in progress at a time, which keeps the file in order, while
+    sinks of different connections are written in parallel.  The owner checks space() before
+    accepting more data and drops what does not fit, which bounds memory to `capacity` bytes
+    per sink whatever the file size.
+
+    With an `offset` the data goes to the file from that offset on with positional writes,
+    and the file is not truncated, so that several sinks (even in different processes) can
+    each fill a range of the same file.
+    '''
+
+    def __init__(self, path, capacity=SINK_BUFFER_SIZE, flushSize=SINK_FLUSH_SIZE, writer=None, offset=None):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if offset is None else 0), 0o644)
+        self.offset = offset   # where the next byte goes with positional writes, None to append
+        self.capacity = capacity
+        self.flushSize = flushSize
+        self.writer = writer if writer is not None else sharedWriter()
+        self.lock = threading.Lock()
+        self.pending = []      # payloads not handed to the worker yet
+        self.pendingSize = 0
+        self.writingSize = 0   # bytes the worker is writing right now
+        self.busy = False      # a worker owns the file descriptor
+        self.closing = False
+        self.written = 0
+        self.error = None      # first OSError from a write, the data after it is discarded
+
+    def space(self):
+        '''Bytes that can still be queued without exceeding the capacity'''
+        with self.lock:
+            return max(self.capacity - self.pendingSize - self.writingSize, 0)
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        with self.lock:
+            self.pending.append(data)
+            self.pendingSize += len(data)
+            start = not self.busy and self.pendingSize >= self.flushSize
+            if start:
+                self.busy = True
+        if start:
+            self.writer.submit(self._drain)
+
+    def flush(self):
+        '''Start writing whatever is queued, without waiting for it'''
+        with self.lock:
+            start = not self.busy and (self.pending or (self.closing and self.fd is not None))
+            if start:
+                self.busy = True
+        if start:
+            self.writer.submit(self._drain)
+
+    @property
+    def finished(self):
+        '''Whether the file is closed after close(): `error` is final'''
+        with self.lock:
+            return self.closing and not self.busy and self.fd is None
+
+    def close(self):
+        '''Write the rest and close the file in the background'''
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+        self.flush()
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                chunks, self.pending = self.pending, []
+                self.writingSize, self.pendingSize = self.pendingSize, 0
+                if not chunks:
+                    self.busy = False
+                    if self.closing and self.fd is not None:
+                        os.close(self.fd)
+                        self.fd = None
+                    return
+            try:
+                if self.error is None:
+                    self._writeAll(chunks)
+                    self.written += self.writingSize
+            except OSError as e:
+                self.error = e # keep draining so the queue and the capacity are released
+            with self.lock:
+                self.writingSize = 0
+
+    def _writeAll(self, chunks):
+        positional = self.offset is not None
+        if not hasattr(os, 'pwritev' if positional else 'writev'):
+            data = b''.join(chunks)
+            if positional:
+                os.pwrite(self.fd, data, self.offset)
+                self.offset += len(data)
+            else:
+                os.write(self.fd, data)
+            return
+        while chunks:
+            batch = chunks[:_IOV_MAX]
+            if positional:
+                written = os.pwritev(self.fd, batch, self.offset)
+                self.offset += written
+            else:
+                written = os.writev(self.fd, batch)
+            # partial writes leave the tail of the batch for the next writev
+            for i, chunk in enumerate(batch):
+                if written < len(chunk):
+                    chunks = [memoryview(chunk)[written:]] + chunks[i + 1:]
+                    break
+                written -= len(chunk)
+            else:
+                chunks = chunks[len(batch):]
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    def wait(sink):
+        while not sink.finished:
+            time.sleep(0.01)
+        return sink
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "out")
+        data = os.urandom(3 * SINK_FLUSH_SIZE + 5)
+
+        # write-behind: queued data counts against the capacity until it is written
+        sink = FileSink(path, capacity=4 * SINK_FLUSH_SIZE)
+        assert sink.space() == 4 * SINK_FLUSH_SIZE
+        sink.write(memoryview(data)[:10])
+        assert sink.space() == 4 * SINK_FLUSH_SIZE - 10
+        for i in range(10, len(data), 1000):
+            sink.write(memoryview(data)[i:i + 1000])
+        sink.close()
+        assert wait(sink).error is None and sink.written == len(data) and sink.space() == sink.capacity
+        with open(path, 'rb') as f:
+            assert f.read() == data
+
+        # positional sinks fill their ranges of one file in any order, without truncating it
+        half = len(data) // 2
+        second = FileSink(path, offset=half)
+        second.write(data[half:][::-1])
+        second.flush()
+        first = FileSink(path, offset=0)
+        first.write(data[:half][::-1])
+        for sink in (first, second):
+            sink.close()
+            assert wait(sink).error is None
+        with open(path, 'rb') as f:
+            assert f.read() == data[:half][::-1] + data[half:][::-1]
+
+    # a failing write is reported once the sink is finished, and the rest is discarded
+    if os.path.exists('/dev/full'):
+        sink = FileSink('/dev/full')
+        sink.write(b'x' * SINK_FLUSH_SIZE)
+        sink.write(b'y')
+        sink.close()
+        assert isinstance(wait(sink).error, OSError) and sink.space() == sink.capacity
+    print("Test passed!")
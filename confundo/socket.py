@@ -1,13 +1,27 @@
 # -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
 
+from collections import deque
 from enum import Enum
+import os
 import socket
 import sys
+import threading
 import time
 
 from .common import *
 from .packet import Packet
-from .cwnd_control import CwndControl
+from .cwnd_control import make_cwnd_control
+from .buffer import SendBuffer, RecvBuffer, ReassemblyBuffer, mapFile
+from .delack import DelayedAck
+from .sack import Scoreboard
+from .rtt import RttEstimator
+from .recovery import LossRecovery
+from .pacing import Pacer
+from .pmtud import PathMtu, agreedMss, checkMss, dontFragment
+from .session import SessionReader, safePath, sessionChunks, sessionFiles
+from .batchio import BatchIO
+from .trace import SEND, RECV, DROPPED, defaultTracer
+from .metrics import ConnectionMetrics, Metrics
 from .util import *
 
 
@@ -28,11 +42,14 @@ class State(Enum):
 class Socket:
     '''Incomplete socket abstraction for Confundo protocol'''
 
-    def __init__(self, connId=0, inSeq=None, synReceived=False, sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM),
-                 noClose=False):
-        self.sock = sock
+    def __init__(self, connId=0, inSeq=None, synReceived=False, sock=None, noClose=False, parent=None, sack=True,
+                 ccAlgorithm="reno", pacing=True, maxRate=None, recvBufferSize=RECV_BUFFER_SIZE, extendedSeq=True,
+                 tracer=None, registry=None, delayedAck=True, mss=MAX_MSS, probeMss=False, session=False):
+        self.sock = sock if sock is not None else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tracer = tracer if tracer is not None else defaultTracer() # where SEND/RECV/DROP events go
         self.connId = connId
         self.sock.settimeout(RETX_TIME)
+        self.io = parent.io if parent else BatchIO(self.sock) # accepted sockets share the listener's batches
         self.timeout = GLOBAL_TIMEOUT
 
         self.base = MAX_SEQNO  # Last packet from this side that has been ACK'd
@@ -41,11 +58,27 @@ class Socket:
         self.inSeq = inSeq
 
         self.lastAckTime = time.time() # last time ACK was sent / activity timer
-        self.cc = CwndControl()
-        self.outBuffer = b""
-        self.inBuffer = b""
+        self.ccAlgorithm = ccAlgorithm # name of the congestion controller in cwnd_control.ALGORITHMS
+        self.cc = make_cwnd_control(ccAlgorithm)
+        self.rtt = RttEstimator()
+        self.pacer = Pacer(pacing, maxRate) # spreads the window over the RTT, maxRate caps it (bytes/s)
+        self.mss = checkMss(mss) # largest segment we accept, offered in our SYN
+        self.pmtu = PathMtu(MTU, probeMss) # size of the segments we send, agreed in the handshake (and probed)
+        if probeMss:
+            dontFragment(self.sock)
+        self.outBuffer = SendBuffer()
+        self.inBuffer = RecvBuffer()
+        self.recvBufferSize = recvBufferSize # inBuffer never holds more, the rest of it is advertised as the window
+        self.advertised = None # window sent in our last ACK
+        self.rwnd = None # window advertised by the other side, None if it does not advertise one
+        self.delayedAck = DelayedAck(delayedAck) # when the ACK of received data may be held back
         self.state = State.INVALID
-        self.nDupAcks = 0
+
+        self.sack = sack # requested in the SYN, then whether both sides agreed to use SACK
+        self.scoreboard = Scoreboard()
+        self.extendedSeq = extendedSeq # same for 32-bit sequence numbers
+        self.session = session # same for a session of framed files (sendfiles/recvfiles)
+        self._useSeqSpace(synReceived and extendedSeq)
 
         self.synReceived = synReceived
         self.finReceived = False
@@ -53,15 +86,35 @@ class Socket:
         self.remote = None
         self.noClose = noClose
 
+        # Demultiplexing state: a listening socket owns the UDP socket and routes datagrams
+        # by (fromAddr, connId) to the accepted sockets, which read from their own inQueue.
+        # Accepted sockets may be served from different threads: one of them at a time reads and
+        # dispatches for the listener while the others wait on the demux condition, each for its
+        # own deadline, so the tables are only used under it and the socket timeout never changes.
+        self.parent = parent
+        self.inQueue = deque()
+        self.children = {}
+        self.synQueue = deque()
+        self.synAddrs = {}
+        self.demux = threading.Condition()
+        self.reading = False # a thread is reading for the listener
+
+        self.registry = registry # None: confundo.metrics.defaultRegistry()
+        self.metrics = ConnectionMetrics(registry, labels=lambda: {'connId': self.connId, 'remote': self.remote})
+        self.metrics.watch(self)
+        self.recovery = LossRecovery(self.cc, self.rtt, self.pmtu, self.metrics, self._segmentSizeChanged)
+
     def __enter__(self):
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
         if self.state == State.OPEN:
             self.close()
+        self.metrics.close()
         if self.noClose:
+            self.io.flush()
             return
-        self.sock.close()
+        self.io.close()
 
     def connect(self, endpoint):
         remote = socket.getaddrinfo(endpoint[0], endpoint[1], family=socket.AF_INET, type=socket.SOCK_DGRAM)
@@ -79,6 +132,14 @@ class Socket:
         self.sock.bind(sockaddr)
         self.state = State.LISTEN
 
+        # a listening socket only dispatches: replace the connection metrics with those of a server
+        self.metrics.close()
+        self.metrics = Metrics("listener", self.registry, {'local': sockaddr})
+        self.acceptedCount = self.metrics.counter("connections_accepted")
+        self.droppedCount = self.metrics.counter("packets_dropped")
+        self.metrics.gauge("connections", lambda: len(self.children))
+        self.metrics.gauge("syn_queue", lambda: len(self.synQueue))
+
     def listen(self, queue):
         if self.state != State.LISTEN:
             raise RuntimeError("Cannot listen")
@@ -88,22 +149,96 @@ class Socket:
         if self.state != State.LISTEN:
             raise RuntimeError("Cannot accept")
 
-        hadNewConnId = True
         while True:
             # just wait forever until a new connection arrives
+            if not self._demux(lambda: self.synQueue, None):
+                continue
+            with self.demux:
+                syn = self.synQueue.popleft()
+
+            (synPkt, fromAddr) = syn
+            self.connId = self.connId % 65535 + 1 # use it for counting incoming connections, no other uses really
+            extendedSeq = self.extendedSeq and synPkt.extendedSeq
+            clientSock = Socket(connId=self.connId, synReceived=True, sock=self.sock,
+                                inSeq=incSeqNum(synPkt.seqNum, 1, EXT_MOD if extendedSeq else MOD),
+                                noClose=True, parent=self, sack=self.sack and synPkt.sackPermitted,
+                                ccAlgorithm=self.ccAlgorithm, pacing=self.pacer.enabled, maxRate=self.pacer.maxRate,
+                                recvBufferSize=self.recvBufferSize, extendedSeq=extendedSeq, tracer=self.tracer,
+                                registry=self.registry, delayedAck=self.delayedAck.enabled, mss=self.mss,
+                                probeMss=self.pmtu.probing, session=self.session and synPkt.session)
+            clientSock._agreeSegmentSize(synPkt.mss)
+            with self.demux:
+                self.children[(fromAddr, clientSock.connId)] = clientSock
+                self.synAddrs[fromAddr] = clientSock
+            try:
+                # at this point, syn was received, now need to send our SYN|ACK and wait for ACK
+                clientSock._connect(fromAddr)
+            except RuntimeError:
+                clientSock._detach()
+                clientSock.metrics.close()
+                continue
+            finally:
+                with self.demux:
+                    self.synAddrs.pop(fromAddr, None)
+            self.acceptedCount.inc()
+            return clientSock
+
+    def _demux(self, ready, timeout):
+        '''
+        "Private" method of the listening socket: read and dispatch datagrams until `ready()`, for
+        at most `timeout` seconds (None: one socket timeout).  Only one thread reads at a time;
+        the others wait for it to dispatch, or take over once it is done.  Returns `ready()`.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self.demux:
+            while not ready():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                if self.reading:
+                    self.demux.wait(remaining)
+                    continue
+                self.reading = True
+                self.demux.release()
+                try:
+                    datagram = self.io.recvfrom(remaining)
+                except socket.error as e:
+                    datagram = None
+                finally:
+                    self.demux.acquire()
+                    self.reading = False
+                    self.demux.notify_all() # they check again once this thread is done dispatching
+                if datagram is not None:
+                    self._dispatch(datagram)
+                if datagram is None and deadline is None:
+                    break
+            return bool(ready())
 
-            if hadNewConnId:
-                self.connId += 1 # use it for counting incoming connections, no other uses really
-                hadNewConnId = False
-            pkt = self._recv()
-            if pkt and pkt.isSyn:
-                hadNewConnId = True
-                ### UPDATE CORRECTLY HERE
-                clientSock = Socket(connId=self.connId, synReceived=True, sock=self.sock, inSeq=self.inSeq,
-                                    noClose=True)
-                # at this point, syn was received, ack for syn was sent, now need to send our SYN and wait for ACK
-                clientSock._connect(self.lastFromAddr)
-                return clientSock
+    def _dispatch(self, datagram):
+        '''"Private" method of the listening socket: route an incoming datagram to the socket that owns it, under demux'''
+
+        (inPacket, fromAddr) = datagram
+        inPkt = Packet().decode(inPacket)
+        child = self.children.get((fromAddr, inPkt.connId))
+        if child is None and inPkt.isSyn and inPkt.connId == 0:
+            child = self.synAddrs.get(fromAddr) # retransmitted SYN of a connection being accepted
+            if child is None:
+                if all(addr != fromAddr for (_, addr) in self.synQueue):
+                    self.synQueue.append((inPkt, fromAddr))
+                return
+        if child is not None:
+            child.inQueue.append((inPkt, fromAddr))
+            return
+
+        self.droppedCount.inc()
+        if self.tracer.drops:
+            self.tracer.packet(DROPPED, inPkt, self.cc.cwnd, self.cc.ssthresh)
+
+    def _detach(self):
+        '''Stop receiving datagrams dispatched by the listening socket'''
+        if self.parent:
+            with self.parent.demux:
+                self.parent.children.pop((self.remote, self.connId), None)
 
     def settimeout(self, timeout):
         self.timeout = timeout
@@ -111,44 +246,117 @@ class Socket:
     def _send(self, packet):
         '''"Private" method to send packet out'''
 
+        # queued: datagrams go out in batches, at the latest when the socket is about to wait for input
         if self.remote:
-            self.sock.sendto(packet.encode(), self.remote)
+            self.io.sendPacket(packet, self.remote)
         else:
-            self.sock.sendto(packet.encode(), self.lastFromAddr)
-        print(format_line("SEND", packet, self.cc.cwnd, self.cc.ssthresh))
-
-    def _recv(self):
-        '''"Private" method to receive incoming packets'''
-
-        try:
-            (inPacket, self.lastFromAddr) = self.sock.recvfrom(412 + 12)
-        except socket.error as e:
-            return None
-
-        ### TODO dispatch based on fromAddr... and it can only be done from the "parent" socket
+            self.io.sendPacket(packet, self.lastFromAddr)
+        if packet.window is not None:
+            self.advertised = packet.window
+        if packet.isAck:
+            self.delayedAck.on_ack_sent()
+        metrics = self.metrics
+        metrics.packetsSent.inc()
+        size = len(packet.payload)
+        if size:
+            metrics.bytesSent.inc(size)
+            if packet.isDup:
+                metrics.retransmits.inc()
+        if self.tracer.packets:
+            self.tracer.packet(SEND, packet, self.cc.cwnd, self.cc.ssthresh, packet.isDup)
+
+    def _useSeqSpace(self, extended):
+        '''Number sequences in the space agreed in the handshake: 32-bit (extended) or wrapping at MAX_SEQNO'''
+        self.mod = EXT_MOD if extended else MOD
+        self.maxFlight = EXT_MAX_FLIGHT if extended else MAX_SEQNO // 2 # keeps sequence numbers in flight unambiguous
+        self.reassembly = ReassemblyBuffer(EXT_MAX_REORDER_BYTES if extended else MAX_REORDER_BYTES, self.mod)
+        self.scoreboard.mod = self.rtt.mod = self.mod
+
+    def _window(self):
+        '''Receive window to advertise: free space in inBuffer, or 0 while less than a segment is free'''
+        free = self.recvBufferSize - len(self.inBuffer)
+        return free if free >= self.pmtu.maximum else 0
+
+    def _agreeSegmentSize(self, peerMss):
+        '''Segments are at most the smaller of both offers in the handshake, MTU for a peer that makes none'''
+        self.pmtu.setMaximum(agreedMss(self.mss, peerMss))
+        self._segmentSizeChanged()
+
+    def _segmentSizeChanged(self):
+        self.cc.set_mss(self.pmtu.size)
+        self.pacer.setSegmentSize(self.pmtu.size)
+
+    def _sendDelayedAck(self):
+        '''Send the ACK held back for the last segments once DELAYED_ACK_TIME has passed'''
+        if self.delayedAck.due(time.time()):
+            self._send(Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                              window=self._window()))
+
+    def _recv(self, timeout=None):
+        '''"Private" method to receive incoming packets, waiting at most `timeout` (current RTO by default)'''
+
+        self._sendDelayedAck()
+        timeout = timeout if timeout is not None else self.rtt.rto
+        if self.delayedAck.deadline is not None:
+            timeout = min(timeout, self.delayedAck.deadline - time.time()) # wake up to send the delayed ACK
+        timeout = max(timeout, 0.001)
+        if self.parent:
+            if not self.parent._demux(lambda: self.inQueue, timeout):
+                self._sendDelayedAck()
+                return None
+            with self.parent.demux:
+                (inPkt, self.lastFromAddr) = self.inQueue.popleft()
+        else:
+            try:
+                (inPacket, self.lastFromAddr) = self.io.recvfrom(timeout)
+            except socket.error as e:
+                self._sendDelayedAck()
+                return None
+            inPkt = Packet().decode(inPacket)
 
-        inPkt = Packet().decode(inPacket)
-        print(format_line("RECV", inPkt, self.cc.cwnd, self.cc.ssthresh))
+        if self.tracer.packets:
+            self.tracer.packet(RECV, inPkt, self.cc.cwnd, self.cc.ssthresh)
+        self.metrics.packetsReceived.inc()
+        if inPkt.isAck and inPkt.window is not None:
+            self.rwnd = inPkt.window
 
         outPkt = None
         if inPkt.isSyn:
+            self.extendedSeq = self.extendedSeq and inPkt.extendedSeq
+            if self.extendedSeq != (self.mod == EXT_MOD):
+                self._useSeqSpace(self.extendedSeq)
+                if self.state == State.SYN:
+                    self.seqNum = incSeqNum(self.base, 1, self.mod) # our SYN, numbered in the agreed space
             ### UPDATE CORRECTLY HERE
-            self.inSeq = incSeqNum(inPkt.seqNum, 1)
+            self.inSeq = incSeqNum(inPkt.seqNum, 1, self.mod)
             if inPkt.connId != 0:
                 self.connId = inPkt.connId
+            if not self.synReceived:
+                self._agreeSegmentSize(inPkt.mss)
             self.synReceived = True
-            outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True)
+            self.sack = self.sack and inPkt.sackPermitted
+            self.session = self.session and inPkt.session
+            if self.parent and self.state == State.SYN:
+                # our SYN|ACK got lost, the client retransmitted its SYN
+                outPkt = Packet(seqNum=self.base, ackNum=self.inSeq, connId=self.connId, isSyn=True, isAck=True, isDup=True,
+                                sackPermitted=self.sack, window=self._window(), extendedSeq=self.extendedSeq,
+                                mss=self.mss, session=self.session)
+                self.rtt.on_retransmit()
+            else:
+                outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                                window=self._window())
 
         elif inPkt.isFin:
             if self.inSeq == inPkt.seqNum: # all previous packets has been received, so safe to advance
                 ### UPDATE CORRECTLY HERE
-                self.inSeq = incSeqNum(self.inSeq, 1)
+                self.inSeq = incSeqNum(self.inSeq, 1, self.mod)
                 self.finReceived = True
             else:
                 # don't advance, which means we will send a duplicate ACK
                 pass
 
-            outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True)
+            outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                            window=self._window())
 
         elif len(inPkt.payload) > 0:
             if not self.synReceived:
@@ -157,15 +365,28 @@ class Socket:
             if self.finReceived:
                 raise RuntimeError("Received data after getting FIN (incoming connection closed)")
 
-            if self.inSeq == inPkt.seqNum: # all previous packets has been received, so safe to advance
+            free = self.recvBufferSize - len(self.inBuffer)
+            delay = False
+            if self.inSeq == inPkt.seqNum and len(inPkt.payload) <= free: # all previous packets has been received, so safe to advance
                 ### UPDATE CORRECTLY HERE
-                self.inSeq = incSeqNum(self.inSeq, len(inPkt.payload))
-                self.inBuffer += inPkt.payload
+                self.inSeq = incSeqNum(self.inSeq, len(inPkt.payload), self.mod)
+                self.inBuffer.append(inPkt.payload)
+                # segments buffered out of order may now be contiguous, ACK all of them at once
+                self.inSeq, payloads = self.reassembly.pull(self.inSeq)
+                for payload in payloads:
+                    self.inBuffer.append(payload)
+                self.metrics.bytesReceived.inc(len(self.inBuffer) - (self.recvBufferSize - free))
+                delay = self.delayedAck.on_segment(len(inPkt.payload), not payloads and len(self.reassembly) == 0,
+                                                   self._window() > 0)
             else:
-                # don't advance, which means we will send a duplicate ACK
-                pass
+                # keep it for later (unless it is beyond the window), but don't advance, which means we
+                # will send a duplicate ACK
+                self.reassembly.add(self.inSeq, inPkt.seqNum, inPkt.payload, limit=free)
 
-            outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True)
+            if not delay:
+                outPkt = Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                                sackBlocks=self.reassembly.blocks(self.inSeq) if self.sack else (),
+                                window=self._window())
 
         if outPkt:
             self._send(outPkt)
@@ -182,6 +403,7 @@ class Socket:
         self.state = State.SYN
 
         self.expectSynAck()
+        self.io.flush() # the ACK that completes the handshake, even if nothing is sent after it
 
     def close(self):
         if self.state != State.OPEN:
@@ -190,13 +412,26 @@ class Socket:
         self.sendFinPacket()
         self.state = State.FIN
 
-        self.expectFinAck()
-
-    def sendSynPacket(self):
-        synPkt = Packet(seqNum=self.seqNum, connId=self.connId, isSyn=True)
+        try:
+            self.expectFinAck()
+        finally:
+            self.io.flush()
+            self._detach()
+            self.metrics.close()
+
+    def sendSynPacket(self, isDup=False):
+        # accepted sockets answer the client's SYN with a combined SYN|ACK
+        synPkt = Packet(seqNum=self.base, ackNum=self.inSeq if self.synReceived else 0, connId=self.connId,
+                        isSyn=True, isAck=self.synReceived, isDup=isDup, sackPermitted=self.sack, window=self._window(),
+                        extendedSeq=self.extendedSeq, mss=self.mss, session=self.session)
         ### UPDATE CORRECTLY HERE
-        self.seqNum = 1
+        self.seqNum = incSeqNum(self.base, 1, self.mod)
         self._send(synPkt)
+        self.lastSynTime = time.time()
+        if isDup:
+            self.rtt.on_retransmit()
+        else:
+            self.rtt.start(self.seqNum)
 
     def expectSynAck(self):
         ### MAY NEED FIXES IN THIS METHOD
@@ -204,19 +439,33 @@ class Socket:
         while True:
             pkt = self._recv()
             if pkt and pkt.isAck and pkt.ackNum == self.seqNum:
+                self._sampleRtt(pkt.ackNum)
                 self.base = self.seqNum
                 self.state = State.OPEN
-                if self.synReceived:
-                    break
+            elif pkt and self.parent and len(pkt.payload) > 0:
+                # the client's ACK was lost, but it already started sending data
+                self.base = self.seqNum
+                self.state = State.OPEN
+            if self.state == State.OPEN and self.synReceived:
+                break
+            if self.state == State.SYN and time.time() - self.lastSynTime > self.rtt.rto:
+                self.rtt.on_timeout()
+                self.sendSynPacket(isDup=True)
             if time.time() - startTime > GLOBAL_TIMEOUT:
                 self.state = State.ERROR
                 raise RuntimeError("timeout")
 
-    def sendFinPacket(self):
-        synPkt = Packet(seqNum=self.seqNum, connId=self.connId, isFin=True)
+    def sendFinPacket(self, isDup=False):
+        # all data is acknowledged at this point, so the FIN always starts at base
+        synPkt = Packet(seqNum=self.base, connId=self.connId, isFin=True, isDup=isDup)
         ### UPDATE CORRECTLY HERE
-        self.seqNum = incSeqNum(self.seqNum, 1)
+        self.seqNum = incSeqNum(self.base, 1, self.mod)
         self._send(synPkt)
+        self.lastFinTime = time.time()
+        if isDup:
+            self.rtt.on_retransmit()
+        else:
+            self.rtt.start(self.seqNum)
 
     def expectFinAck(self):
         ### MAY NEED FIXES IN THIS METHOD
@@ -225,9 +474,13 @@ class Socket:
         while True:
             pkt = self._recv()
             currentTime = time.time()
-            if pkt and pkt.isAck and pkt.ackNum == self.seqNum:
+            if pkt and pkt.isAck and pkt.ackNum == self.seqNum and tWaitTime is None:
+                self._sampleRtt(pkt.ackNum)
                 self.base = self.seqNum
                 tWaitTime = currentTime
+            elif tWaitTime is None and currentTime - self.lastFinTime > self.rtt.rto:
+                self.rtt.on_timeout()
+                self.sendFinPacket(isDup=True)
 
             if currentTime - startTime > GLOBAL_TIMEOUT:
                 self.state = State.ERROR
@@ -242,17 +495,40 @@ class Socket:
         while len(self.inBuffer) == 0:
             self._recv()
             if self.finReceived:
+                self.io.flush()
                 return None
             if time.time() - startTime > GLOBAL_TIMEOUT:
                 self.state = State.ERROR
                 raise RuntimeError("timeout")
 
+        self._sendDelayedAck()
+        self.io.flush() # ACKs for the data being returned
         if len(self.inBuffer) > 0:
-            actualResponseSize = min(len(self.inBuffer), maxSize)
-            response = self.inBuffer[:actualResponseSize]
-            self.inBuffer = self.inBuffer[actualResponseSize:]
-
-            return response
+            data = self.inBuffer.read(maxSize)
+            if self.advertised is not None and self.advertised < self.pmtu.maximum <= self._window():
+                # the window was closed, tell the sender right away that it has reopened
+                self._send(Packet(seqNum=self.seqNum, ackNum=self.inSeq, connId=self.connId, isAck=True,
+                                  window=self._window()))
+                self.io.flush()
+            return data
+
+    def _sampleRtt(self, ackNum):
+        rtt = self.rtt.on_ack(ackNum)
+        if rtt is not None:
+            self.cc.on_rtt_sample(rtt, self.rtt.srtt)
+            self.metrics.rtt.observe(rtt)
+
+    def _retransmitFirst(self):
+        '''Resend the segment that starts at the lowest unacknowledged byte'''
+        size = self.pmtu.size
+        nextSacked = self.scoreboard.nextSacked(0)
+        if nextSacked is not None:
+            size = min(size, nextSacked)
+        toSend = self.outBuffer.peek(0, size)
+        if len(toSend) > 0:
+            self.rtt.on_retransmit()
+            self._send(Packet(seqNum=self.base, connId=self.connId, payload=toSend, isDup=True))
+            self.pacer.consume(len(toSend))
 
     def send(self, data):
         '''
@@ -267,47 +543,318 @@ class Socket:
         if self.state != State.OPEN:
             raise RuntimeError("Trying to send FIN, but socket is not in OPEN state")
 
-        self.outBuffer += data
+        startTime = time.time()
+        self.outBuffer.append(data)
+        self._sendBuffered()
+        self.metrics.sendLatency.observe(time.time() - startTime)
+        return len(data)
+
+    def sendfile(self, path, chunkSize=MMAP_CHUNK):
+        '''
+        Send the contents of the file at `path` without reading it into memory.  The file is
+        memory-mapped `chunkSize` bytes at a time and segments, retransmissions included, are
+        sliced from the mappings, so memory use does not grow with the file size.
+        '''
+        if self.state != State.OPEN:
+            raise RuntimeError("Trying to send, but socket is not in OPEN state")
+
+        startTime = time.time()
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            chunks = mapFile(file, chunkSize)
+            try:
+                self._sendBuffered(chunks)
+            finally:
+                chunks.close()
+        self.metrics.sendLatency.observe(time.time() - startTime)
+        return size
+
+    def sendfiles(self, paths, useMmap=True):
+        '''
+        Send the files in `paths` (files or directories, see confundo.session.sessionFiles) as
+        one session, each file framed with its name and size.  The connection must have been
+        opened with session=True on both sides.  Returns the (path, name) of each file sent.
+        '''
+        if self.state != State.OPEN:
+            raise RuntimeError("Trying to send, but socket is not in OPEN state")
+        if not self.session:
+            raise RuntimeError("Trying to send files, but the other side did not agree to a session")
 
+        startTime = time.time()
+        files = sessionFiles(paths)
+        chunks = sessionChunks(files, useMmap)
+        try:
+            self._sendBuffered(chunks)
+        finally:
+            chunks.close()
+        self.metrics.sendLatency.observe(time.time() - startTime)
+        return files
+
+    def recvfiles(self, directory):
+        '''
+        Receive a session into `directory` until the other side closes the connection, each
+        file to `directory`/<name>.  Returns the names of the files.
+        '''
+        if not self.session:
+            raise RuntimeError("Trying to receive files, but the other side did not agree to a session")
+
+        def openFile(name, size):
+            path = safePath(directory, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return open(path, 'wb')
+
+        reader = SessionReader(openFile)
+        try:
+            while True:
+                data = self.recv(self.recvBufferSize)
+                if data is None:
+                    break
+                reader.feed(data)
+        finally:
+            if reader.current is not None:
+                reader.current.close()
+        if not reader.complete():
+            raise RuntimeError("session ended in the middle of a file")
+        return reader.files
+
+    def _sendBuffered(self, source=None):
+        '''
+        Send everything in outBuffer, topping it up from the `source` iterator of chunks
+        whenever it holds less than the largest span that may be in flight.
+        '''
         reTrans = False
+        probe = False # the receiver's window is closed: send one segment anyway to learn when it reopens
+        sentEnd = 0 # offset after the highest byte sent so far, data below it is retransmitted
+        self.recovery.reset()
+        self.scoreboard.clear()
         startTime = time.time()
-        while len(self.outBuffer) > 0:
+        lastProgress = startTime
+        while True:
+            while source is not None and len(self.outBuffer) <= self.maxFlight:
+                chunk = next(source, None)
+                if chunk is None:
+                    source = None
+                else:
+                    self.outBuffer.append(chunk)
+            if len(self.outBuffer) == 0:
+                break
+
             if reTrans:
                 self.seqNum = self.base
 
-            dataS = (MOD + (self.seqNum - self.base)) % MOD
+            dataS = seqDiff(self.seqNum, self.base, self.mod)
             byteS = 0
+            self.pacer.update(self.cc.pacing_rate(self.rtt.srtt))
+            paceWait = 0
 
             while True:
-                toSend = self.outBuffer[dataS:dataS+MTU]
+                size = self.pmtu.size
+                probeSize = None
+                if dataS < sentEnd:
+                    # retransmission: skip what the receiver reported in SACK blocks
+                    skipTo = self.scoreboard.skip(dataS)
+                    if skipTo != dataS:
+                        self.seqNum = incSeqNum(self.seqNum, skipTo - dataS, self.mod)
+                        dataS = skipTo
+                        continue
+                    nextSacked = self.scoreboard.nextSacked(dataS)
+                    if nextSacked is not None:
+                        size = min(size, nextSacked - dataS)
+                else:
+                    # path MTU probe: a full segment of the next size, when everything lets it through
+                    probeSize = self.pmtu.nextProbe()
+                    if probeSize is not None and \
+                       dataS + probeSize <= min(len(self.outBuffer), self.maxFlight,
+                                                self.rwnd if self.rwnd is not None else self.maxFlight) and \
+                       self.cc.cwnd - (dataS - self.scoreboard.sacked(dataS)) >= probeSize:
+                        size = probeSize
+                toSend = self.outBuffer.peek(dataS, size)
 
                 lts = len(toSend)
-                if (self.cc.cwnd - dataS) < lts or lts == 0:
+                if (self.cc.cwnd - (dataS - self.scoreboard.sacked(dataS))) < lts or lts == 0:
+                    break
+                if dataS + lts > self.maxFlight: # keep sequence numbers in flight unambiguous
+                    break
+                if self.rwnd is not None and dataS + lts > self.rwnd and not (probe and dataS == 0):
+                    break # flow control: never more than the receiver has room for
+                paceWait = self.pacer.delay(lts)
+                if paceWait > 0:
                     break
-                pkt = Packet(seqNum=self.seqNum, connId=self.connId, payload=toSend, isDup=reTrans)
+                pkt = Packet(seqNum=self.seqNum, connId=self.connId, payload=toSend, isDup=dataS < sentEnd)
                 ### UPDATE CORRECTLY HERE
-                self.seqNum = incSeqNum(self.seqNum, len(pkt.payload))
+                self.seqNum = incSeqNum(self.seqNum, len(pkt.payload), self.mod)
                 self._send(pkt)
+                self.pacer.consume(lts)
+                if not pkt.isDup:
+                    self.rtt.start(self.seqNum)
+                if lts == probeSize:
+                    self.pmtu.on_probe_sent(lts, dataS + lts)
 
                 dataS += len(pkt.payload)
                 byteS += len(pkt.payload)
-
-            pkt = self._recv()  # if within RTO we didn't receive packets, things will be retransmitted
+                sentEnd = max(sentEnd, dataS)
+                probe = False
+            reTrans = False
+
+            timeout = lastProgress + self.rtt.rto - time.time()
+            if paceWait > 0:
+                timeout = min(timeout, paceWait) # wake up when the next segment may be sent
+            pkt = self._recv(timeout)  # if within RTO we didn't receive packets, things will be retransmitted
             if pkt and pkt.isAck:
                 ### UPDATE CORRECTLY HERE
-                advanceAmount = pkt.ackNum - self.base
-                if advanceAmount == 0:
-                    self.nDupAcks += 1
-                else:
-                    self.cc.on_ack()
-                    self.nDupAcks = 0
-
-                self.outBuffer = self.outBuffer[advanceAmount:]
-                ### UPDATE CORRECTLY HERE
-                self.base = pkt.ackNum
+                advanceAmount = seqDiff(pkt.ackNum, self.base, self.mod)
+                if self.rwnd is not None and self.rwnd < self.pmtu.size:
+                    startTime = time.time() # the receiver is alive, it is just not reading
+                partialAck = False
+                if self.recovery.isDuplicate(advanceAmount, sentEnd, self.rwnd):
+                    flightSize = seqDiff(self.seqNum, self.base, self.mod)
+                    if self.recovery.on_dup_ack(sentEnd, flightSize - self.scoreboard.sacked(flightSize), self.sack):
+                        self._retransmitFirst()
+                        lastProgress = time.time()
+                elif 0 < advanceAmount <= sentEnd:
+                    self._sampleRtt(pkt.ackNum)
+                    partialAck = self.recovery.on_new_ack(advanceAmount)
+                    self.outBuffer.advance(advanceAmount)
+                    self.scoreboard.advance(advanceAmount)
+                    sentEnd -= advanceAmount
+                    if seqDiff(self.seqNum, self.base, self.mod) < advanceAmount:
+                        self.seqNum = pkt.ackNum # ACK covers data we were about to retransmit
+                    ### UPDATE CORRECTLY HERE
+                    self.base = pkt.ackNum
+                    startTime = lastProgress = time.time()
+                if self.sack and pkt.sackBlocks:
+                    self.scoreboard.update(self.base, pkt.sackBlocks, sentEnd)
+                if partialAck:
+                    self._retransmitFirst()
+
+            if time.time() - lastProgress > self.rtt.rto:
+                probe = self.recovery.on_expiry(self.rwnd, len(self.outBuffer))
+                reTrans = True
+                lastProgress = time.time()
 
             if time.time() - startTime > GLOBAL_TIMEOUT:
                 self.state = State.ERROR
                 raise RuntimeError("timeout")
 
-        return len(data)
+
+if __name__ == '__main__':
+    # NewReno against a scripted receiver that loses the first transmission of two segments of
+    # one window: the first hole is resent on the third duplicate ACK, the second on the partial
+    # ACK that covers most of the window, so the transfer completes without a timeout
+    from .trace import Tracer
+
+    SEGMENTS, LOST = 20, {1, 15}
+    peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    peer.bind(('127.0.0.1', 0))
+    peer.settimeout(GLOBAL_TIMEOUT)
+
+    def receiver():
+        (data, addr) = peer.recvfrom(65536)
+        start = incSeqNum(Packet().decode(data).seqNum, 1, MOD)
+        peer.sendto(Packet(seqNum=1000, ackNum=start, connId=7, isSyn=True, isAck=True).encode(), addr)
+        received, dropped = set(), set()
+        while len(received) < SEGMENTS:
+            pkt = Packet().decode(peer.recvfrom(65536)[0])
+            if len(pkt.payload) == 0:
+                continue
+            index = seqDiff(pkt.seqNum, start, MOD) // MTU
+            if index in LOST and index not in dropped:
+                dropped.add(index)
+                continue
+            received.add(index)
+            acked = 0
+            while acked in received:
+                acked += 1
+            peer.sendto(Packet(seqNum=1001, ackNum=incSeqNum(start, acked * MTU, MOD), connId=7,
+                               isAck=True).encode(), addr)
+
+    thread = threading.Thread(target=receiver)
+    thread.start()
+    sender = Socket(sack=False, pacing=False, tracer=Tracer())
+    sender.connect(peer.getsockname())
+    sender.cc.cwnd = SEGMENTS * MTU
+    sender.send(bytes(SEGMENTS * MTU))
+    thread.join()
+    assert sender.metrics.fastRetransmits.value == 1 and sender.metrics.timeouts.value == 0
+    assert sender.metrics.retransmits.value == len(LOST)
+    sender.io.close()
+    peer.close()
+
+    # two connections accepted from one listener, served from their own threads: one thread
+    # reads for both while the other waits for its own deadline, the socket timeout stays put
+    listener = Socket(tracer=Tracer())
+    listener.bind(('127.0.0.1', 0))
+    payloads = [bytes([i]) * (50 * MTU) for i in (1, 2)]
+    sending = threading.Event()
+
+    def client(data):
+        sock = Socket(tracer=Tracer())
+        sock.connect(listener.sock.getsockname())
+        sending.wait(GLOBAL_TIMEOUT)
+        sock.send(data)
+        sock.close()
+        sock.io.close()
+
+    clients = [threading.Thread(target=client, args=(data,)) for data in payloads]
+    for thread in clients:
+        thread.start()
+    children = [listener.accept() for _ in payloads]
+    received = {child: bytearray() for child in children}
+
+    def serve(child):
+        while True:
+            data = child.recv(65536)
+            if data is None:
+                return
+            received[child] += data
+
+    reader = threading.Thread(target=children[0]._recv, args=(2.0,)) # reads for the listener meanwhile
+    reader.start()
+    time.sleep(0.05)
+    start = time.time()
+    children[1]._recv(0.1)
+    assert time.time() - start < 1.0 and reader.is_alive()
+    reader.join()
+    sending.set()
+    servers = [threading.Thread(target=serve, args=(child,)) for child in children]
+    for thread in servers:
+        thread.start()
+    for thread in servers + clients:
+        thread.join()
+    assert sorted(bytes(data) for data in received.values()) == payloads
+    assert listener.sock.gettimeout() == RETX_TIME
+    listener.io.close()
+
+    # sendfile: an empty file, then one larger than the receive window, mapped in several chunks
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        empty, large = os.path.join(directory, "empty"), os.path.join(directory, "large")
+        data = os.urandom(8 * RECV_BUFFER_SIZE + 123)
+        open(empty, 'wb').close()
+        with open(large, 'wb') as f:
+            f.write(data)
+        listener = Socket(tracer=Tracer())
+        listener.bind(('127.0.0.1', 0))
+        sent = []
+
+        def sender():
+            sock = Socket(tracer=Tracer())
+            sock.connect(listener.sock.getsockname())
+            sent.append(sock.sendfile(empty))
+            sent.append(sock.sendfile(large, chunkSize=RECV_BUFFER_SIZE))
+            sock.close()
+            sock.io.close()
+
+        thread = threading.Thread(target=sender)
+        thread.start()
+        receiver = listener.accept()
+        received = bytearray()
+        while True:
+            chunk = receiver.recv(RECV_BUFFER_SIZE)
+            if chunk is None:
+                break
+            received += chunk
+        thread.join()
+        assert sent == [0, len(data)] and received == data
+        listener.io.close()
+    print("Test passed!")
@@ -0,0 +1,208 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+Striped transfers: one file over several Confundo connections at once.
+
+The file is split into byte ranges (stripeRanges), each sent over a connection of its own
+whose SYN and SYN|ACK both carry the stripe option (header.OPT_STRIPE).  The data of such a
+connection starts with a stripe header and then carries exactly the bytes of its range:
+
+    +---------------+----------------+------------+------------+------------------+------+
+    | transfer (8)  | file size (8)  | offset (8) | length (8) | name length (2)  | name |
+    +---------------+----------------+------------+------------+------------------+------+
+
+The receiver writes each range at its offset with positional writes, so the ranges may
+arrive in any order, over any number of connections, and even at different processes (the
+server.py workers): the file is complete once every range has been received.  Each
+connection has its own congestion window and its own sender, so a stall in the loss
+recovery of one range does not hold up the others.
+'''
+
+import mmap
+import os
+import struct
+
+from .common import *
+from .buffer import mapFile
+from .session import safePath
+from .sink import FileSink
+
+STRIPE_HEADER = struct.Struct('!Q Q Q Q H')  # transfer, file size, offset, length, name length
+
+
+def stripeRanges(size, count):
+    '''
+    (offset, length) of `count` ranges covering `size` bytes, as equal as possible with
+    every offset a multiple of mmap.ALLOCATIONGRANULARITY so that each range can be mapped
+    on its own.  Small files get fewer ranges.
+    '''
+    granularity = mmap.ALLOCATIONGRANULARITY
+    stride = max(-(-size // count // granularity) * granularity, granularity)
+    ranges = [(offset, min(stride, size - offset)) for offset in range(0, size, stride)]
+    return ranges or [(0, 0)]
+
+
+def stripeHeader(transfer, size, offset, length, name):
+    '''The header at the start of the range [offset, offset + length) of the `size`-byte file `name`'''
+    encoded = name.encode('utf-8')
+    return STRIPE_HEADER.pack(transfer, size, offset, length, len(encoded)) + encoded
+
+
+def stripeChunks(path, name, transfer, offset, length, useMmap=True, chunkSize=MMAP_CHUNK):
+    '''The data of the stripe connection for one range of the file at `path`, as chunks'''
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        yield stripeHeader(transfer, size, offset, length, name)
+        sent = 0
+        if useMmap and length > 0:
+            for chunk in mapFile(file, chunkSize, offset, length):
+                sent += len(chunk)
+                yield chunk
+        else:
+            file.seek(offset)
+            while sent < length:
+                chunk = file.read(min(chunkSize, length - sent))
+                if not chunk:
+                    break
+                sent += len(chunk)
+                yield chunk
+        if sent != length:
+            raise RuntimeError(f"{path} changed size while it was sent")
+
+
+class StripeSink:
+    '''
+    Write-behind sink for the data of one stripe connection (server.py), with the interface
+    of FileSink.  Once the stripe header has arrived, the range is written to
+    `directory`/<transfer>/<name> from its offset on by a FileSink with positional writes; the
+    file is extended to its full size right away.  A malformed stripe stops the writes, and
+    the error is reported like a write error.
+    '''
+
+    def __init__(self, directory, capacity=SINK_BUFFER_SIZE, writer=None):
+        self.directory = directory
+        self.capacity = capacity
+        self.writer = writer
+        self.frame = bytearray() # stripe header and name received so far
+        self.sink = None         # FileSink of the range, once the header is complete
+        self.remaining = 0       # bytes of the range still to come
+        self.stripeError = None
+        self.closed = False
+        self.path = None
+
+    @property
+    def error(self):
+        if self.stripeError is not None:
+            return self.stripeError
+        return self.sink.error if self.sink is not None else None
+
+    @property
+    def finished(self):
+        return self.closed and (self.sink is None or self.sink.finished)
+
+    def space(self):
+        return self.sink.space() if self.sink is not None else self.capacity
+
+    def write(self, data):
+        if self.stripeError is not None or len(data) == 0:
+            return
+        data = memoryview(data)
+        try:
+            while self.sink is None and len(data) > 0:
+                # the stripe header, then as much of the name as it announces
+                need = STRIPE_HEADER.size
+                if len(self.frame) >= need:
+                    need += STRIPE_HEADER.unpack_from(self.frame)[4]
+                piece = data[:need - len(self.frame)]
+                self.frame += piece
+                data = data[len(piece):]
+                if len(self.frame) >= STRIPE_HEADER.size and \
+                   len(self.frame) == STRIPE_HEADER.size + STRIPE_HEADER.unpack_from(self.frame)[4]:
+                    self._open()
+            if len(data) == 0:
+                return
+            if len(data) > self.remaining:
+                raise ValueError("stripe carries more data than its range")
+            self.remaining -= len(data)
+            self.sink.write(data)
+        except (ValueError, OSError) as e:
+            self.stripeError = e # the rest of the stripe is discarded
+
+    def _open(self):
+        transfer, size, offset, length, nameLength = STRIPE_HEADER.unpack_from(self.frame)
+        try:
+            name = bytes(self.frame[STRIPE_HEADER.size:]).decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError("file name in stripe is not UTF-8")
+        if offset + length > size:
+            raise ValueError(f"stripe [{offset}, {offset + length}) is beyond the end of {name!r} ({size} bytes)")
+        self.path = safePath(os.path.join(self.directory, f"{transfer:016x}"), name)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.sink = FileSink(self.path, self.capacity, writer=self.writer, offset=offset)
+        if os.fstat(self.sink.fd).st_size < size:
+            os.ftruncate(self.sink.fd, size) # every stripe extends the file alike, whichever comes first
+        self.remaining = length
+
+    def flush(self):
+        if self.sink is not None:
+            self.sink.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.stripeError is None and (self.sink is None or self.remaining > 0):
+            self.stripeError = ValueError("stripe ended before the end of its range")
+        if self.sink is not None:
+            self.sink.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    def wait(sink):
+        while not sink.finished:
+            time.sleep(0.01)
+        return sink
+
+    granularity = mmap.ALLOCATIONGRANULARITY
+    assert stripeRanges(0, 4) == [(0, 0)]
+    assert stripeRanges(100, 4) == [(0, 100)]
+    ranges = stripeRanges(10 * granularity + 1, 4)
+    assert all(offset % granularity == 0 for offset, _ in ranges)
+    assert sum(length for _, length in ranges) == 10 * granularity + 1 and len(ranges) <= 4
+
+    with tempfile.TemporaryDirectory() as directory:
+        data = os.urandom(3 * granularity + 100)
+        source = os.path.join(directory, "source.bin")
+        with open(source, 'wb') as f:
+            f.write(data)
+
+        # the ranges, fed in pieces and in reverse order, make up the file
+        out = os.path.join(directory, "out")
+        for offset, length in reversed(stripeRanges(len(data), 3)):
+            for useMmap in (True, False):
+                stream = b"".join(bytes(chunk) for chunk in stripeChunks(source, "f.bin", 1, offset, length, useMmap))
+                assert stream == stripeHeader(1, len(data), offset, length, "f.bin") + data[offset:offset + length]
+            sink = StripeSink(out)
+            for i in range(0, len(stream), 1000):
+                sink.write(stream[i:i + 1000])
+            sink.close()
+            assert wait(sink).error is None
+        with open(os.path.join(out, f"{1:016x}", "f.bin"), 'rb') as f:
+            assert f.read() == data
+
+        # more data than the range, a range beyond the file, a short range and a bad name are errors
+        for stream in (stripeHeader(2, 10, 0, 4, "g") + b"12345",
+                       stripeHeader(2, 10, 8, 4, "g") + b"1234",
+                       stripeHeader(2, 10, 0, 4, "g") + b"123",
+                       stripeHeader(2, 10, 0, 4, "../g") + b"1234",
+                       stripeHeader(2, 10, 0, 4, "g")[:10]):
+            sink = StripeSink(out)
+            sink.write(stream)
+            sink.close()
+            assert isinstance(wait(sink).error, ValueError), stream
+        assert not os.path.exists(os.path.join(out, "g"))
+
+    print("Test passed!")
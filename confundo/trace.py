@@ -0,0 +1,368 @@
+# -*- Mode: python; py-indent-offset: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+
+'''
+Packet tracing.
+
+Every datagram sent, received or dropped is reported to a tracer as one event.  How much is
+traced is set by the tracer's level (OFF, DROP or PACKET) and where it goes by its kind:
+
+* Tracer: discards everything.  Callers test `tracer.packets` / `tracer.drops` before
+  reporting, so a disabled tracer costs one attribute lookup per datagram.
+* TextTracer: writes `SEND/RECV/DROP seq ack connId cwnd ssthresh FLAGS` lines right away,
+  the format the client, the server and confundo.Socket have always printed.
+* RingTracer: packs each event into a fixed-size binary record in a preallocated ring and
+  returns; a background thread drains the ring to a file, either as raw records (read them
+  back with readTrace(), `python3 -m confundo.trace FILE` or confundo.analysis.read_trace)
+  or formatted as text lines.  When a ring is full new events are counted in `lost`
+  instead of blocking the sender.
+'''
+
+import atexit
+import struct
+import sys
+import threading
+import time
+
+from .header import FLAG_ACK, FLAG_FIN, FLAG_SYN
+
+OFF = 0
+DROP = 1    # only datagrams that no connection accepted
+PACKET = 2  # every datagram
+LEVELS = {'off': OFF, 'drop': DROP, 'packet': PACKET}
+
+SEND = 0
+RECV = 1
+DROPPED = 2
+EVENTS = ("SEND", "RECV", "DROP")
+
+FLAG_DUP = 1 << 15 # not a header flag: the segment is a retransmission
+
+TRACE_MAGIC = b"CFTR\x01\x00\x00\x00" # first bytes of a binary trace file
+# time, event, connId, seq, ack, flags, cwnd, ssthresh (-1: none), laid out with natural alignment
+RECORD = struct.Struct('<dBxHIIHxxii')
+WINDOW_MAX = 0x7FFFFFFF     # cwnd/ssthresh recorded for larger ones, infinity included
+TRACE_RING_SIZE = 1 << 14   # records a thread keeps in a RingTracer before its new events are lost
+TRACE_DRAIN_INTERVAL = 0.1  # seconds between two drains of a RingTracer
+
+
+def formatEvent(event, seq, ack, connId, cwnd, ssthresh, flags):
+    '''The text line of one event, `-` for a missing cwnd/ssthresh'''
+    s = f"{EVENTS[event]} {seq} {ack} {connId} {'-' if cwnd < 0 else cwnd} {'-' if ssthresh < 0 else ssthresh}"
+    if flags & FLAG_ACK: s = s + " ACK"
+    if flags & FLAG_SYN: s = s + " SYN"
+    if flags & FLAG_FIN: s = s + " FIN"
+    if flags & FLAG_DUP: s = s + " DUP"
+    return s
+
+
+class Tracer:
+    '''Base class of the tracers; on its own it is the fully-off mode and discards every event'''
+
+    def __init__(self, level=OFF):
+        self.level = level
+        self.drops = level >= DROP
+        self.packets = level >= PACKET
+
+    def packet(self, event, header, cwnd=None, ssthresh=None, isDup=False):
+        '''
+        Report `header` (a Header or Packet) as SEND, RECV or DROPPED.  Callers check `packets`
+        (or `drops` for DROPPED) first, so nothing is computed when the event is not traced.
+        cwnd and ssthresh are recorded as int32: -1 for None, WINDOW_MAX for anything larger.
+        '''
+        flags = header.flags()
+        if isDup:
+            flags |= FLAG_DUP
+        self.record(event, header.sequence_number, header.acknowledgment_number, header.connection_id,
+                    -1 if cwnd is None else (int(cwnd) if cwnd < WINDOW_MAX else WINDOW_MAX),
+                    -1 if ssthresh is None else (int(ssthresh) if ssthresh < WINDOW_MAX else WINDOW_MAX), flags)
+
+    def record(self, event, seq, ack, connId, cwnd, ssthresh, flags):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TextTracer(Tracer):
+    '''Writes each event as a text line right away, to `stream` (sys.stdout at the time of the event by default)'''
+
+    def __init__(self, level=PACKET, stream=None):
+        super().__init__(level)
+        self.stream = stream
+
+    def record(self, event, seq, ack, connId, cwnd, ssthresh, flags):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(formatEvent(event, seq, ack, connId, cwnd, ssthresh, flags) + "\n")
+
+    def flush(self):
+        (self.stream if self.stream is not None else sys.stdout).flush()
+
+
+class _Ring:
+    '''The records of one thread: only that thread moves `head`, only the drain moves `tail`'''
+
+    __slots__ = ('buf', 'head', 'tail', 'lost', 'thread')
+
+    def __init__(self, capacity):
+        self.buf = bytearray(capacity * RECORD.size)
+        self.head = 0 # events recorded so far, the next one goes to slot head % capacity
+        self.tail = 0 # events drained so far
+        self.lost = 0 # events not recorded because the ring was full
+        self.thread = threading.current_thread()
+
+
+class RingTracer(Tracer):
+    '''
+    Records events as binary records into rings of `capacity` records, drained to `output`
+    (a binary file, or a text stream when `text` is set) by a background thread every
+    `interval` seconds.  Sockets of different threads may share one RingTracer: every
+    thread records into a ring of its own, so recording takes no lock, and each drain
+    merges the rings by time.
+    '''
+
+    def __init__(self, output, level=PACKET, text=False, capacity=TRACE_RING_SIZE, interval=TRACE_DRAIN_INTERVAL):
+        super().__init__(level)
+        self.output = output
+        self.text = text
+        self.capacity = capacity
+        self.interval = interval
+        self.local = threading.local()
+        self.rings = []
+        self.lock = threading.Lock()       # the list of rings
+        self.drainLock = threading.Lock()  # one drain writes to the output at a time
+        self.closed = threading.Event()
+        if not text:
+            output.write(TRACE_MAGIC)
+        self.thread = threading.Thread(target=self._run, name="confundo-trace", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @property
+    def lost(self):
+        '''Events not recorded because their ring was full'''
+        with self.lock:
+            return sum(ring.lost for ring in self.rings)
+
+    def packet(self, event, header, cwnd=None, ssthresh=None, isDup=False):
+        # Tracer.packet with record() inlined, this runs for every datagram
+        try:
+            ring = self.local.ring
+        except AttributeError:
+            ring = self._newRing()
+        head = ring.head
+        if head - ring.tail >= self.capacity:
+            ring.lost += 1
+            return
+        RECORD.pack_into(ring.buf, (head % self.capacity) * RECORD.size, time.time(), event,
+                         header.connection_id, header.sequence_number, header.acknowledgment_number,
+                         header.flags() | FLAG_DUP if isDup else header.flags(),
+                         -1 if cwnd is None else (int(cwnd) if cwnd < WINDOW_MAX else WINDOW_MAX),
+                         -1 if ssthresh is None else (int(ssthresh) if ssthresh < WINDOW_MAX else WINDOW_MAX))
+        ring.head = head + 1
+
+    def record(self, event, seq, ack, connId, cwnd, ssthresh, flags):
+        try:
+            ring = self.local.ring
+        except AttributeError:
+            ring = self._newRing()
+        head = ring.head
+        if head - ring.tail >= self.capacity:
+            ring.lost += 1
+            return
+        RECORD.pack_into(ring.buf, (head % self.capacity) * RECORD.size,
+                         time.time(), event, connId, seq, ack, flags, cwnd, ssthresh)
+        ring.head = head + 1 # published only once the record is complete
+
+    def _newRing(self):
+        ring = self.local.ring = _Ring(self.capacity)
+        with self.lock:
+            self.rings.append(ring)
+        return ring
+
+    def flush(self):
+        '''Drain whatever is recorded to the output now'''
+        with self.drainLock:
+            with self.lock:
+                rings = list(self.rings)
+            chunks = []
+            for ring in rings:
+                head, tail = ring.head, ring.tail
+                if head == tail:
+                    if not ring.thread.is_alive():
+                        with self.lock:
+                            self.rings.remove(ring)
+                    continue
+                # the records are copied out so that recording can go on while they are written
+                start, end = tail % self.capacity * RECORD.size, head % self.capacity * RECORD.size
+                if start < end:
+                    chunks.append(bytes(ring.buf[start:end]))
+                else:
+                    chunks.append(bytes(ring.buf[start:]) + bytes(ring.buf[:end]))
+                ring.tail = head
+            if len(chunks) > 1 or (chunks and self.text):
+                records = [record for chunk in chunks for record in RECORD.iter_unpack(chunk)]
+                records.sort(key=lambda record: record[0])
+                if self.text:
+                    self.output.write("".join(formatEvent(event, seq, ack, connId, cwnd, ssthresh, flags) + "\n"
+                                              for (_, event, connId, seq, ack, flags, cwnd, ssthresh) in records))
+                else:
+                    self.output.write(b"".join(RECORD.pack(*record) for record in records))
+            elif chunks:
+                self.output.write(chunks[0])
+            self.output.flush()
+
+    def close(self):
+        '''Stop the background thread and write out the remaining records'''
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                return # output closed under us: stop draining, events stay in the rings
+
+
+def readTrace(file):
+    '''Records of a binary trace file as (time, event, seq, ack, connId, cwnd, ssthresh, flags) tuples'''
+    if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        raise ValueError("not a Confundo binary trace")
+    while True:
+        chunk = file.read(RECORD.size * 4096)
+        chunk = chunk[:len(chunk) - len(chunk) % RECORD.size] # a record cut short by a crash is ignored
+        if not chunk:
+            return
+        for (now, event, connId, seq, ack, flags, cwnd, ssthresh) in RECORD.iter_unpack(chunk):
+            yield now, event, seq, ack, connId, cwnd, ssthresh, flags
+
+
+def makeTracer(level=PACKET, path=None):
+    '''
+    The tracer for the `--trace LEVEL` / `--trace-file PATH` options of client.py and server.py:
+    binary records written to `path` in the background, text lines on stdout without a path.
+    '''
+    if level == OFF:
+        return Tracer()
+    if path is not None:
+        return RingTracer(open(path, 'wb'), level)
+    return TextTracer(level)
+
+
+_default = TextTracer()
+
+
+def defaultTracer():
+    '''Tracer of the sockets created without one: text lines on stdout unless setDefaultTracer() changed it'''
+    return _default
+
+
+def setDefaultTracer(tracer):
+    global _default
+    _default = tracer
+
+
+def selfTest():
+    import io
+
+    # binary records, read back in order
+    output = io.BytesIO()
+    tracer = RingTracer(output, interval=3600)
+    for i in range(10):
+        tracer.record(SEND if i % 2 else RECV, i, i + 1, 7, 412 * i, -1, FLAG_ACK)
+    tracer.close()
+    output.seek(0)
+    records = list(readTrace(output))
+    assert [record[2] for record in records] == list(range(10))
+    assert records[3][1:] == (SEND, 3, 4, 7, 1236, -1, FLAG_ACK)
+    assert all(a[0] <= b[0] for a, b in zip(records, records[1:]))
+
+    # text lines in the format of TextTracer
+    output = io.StringIO()
+    tracer = RingTracer(output, text=True, interval=3600)
+    tracer.record(DROPPED, 5, 6, 1, -1, -1, FLAG_SYN | FLAG_DUP)
+    tracer.close()
+    assert output.getvalue() == formatEvent(DROPPED, 5, 6, 1, -1, -1, FLAG_SYN | FLAG_DUP) + "\n"
+
+    # a full ring counts new events as lost, and takes records again once drained, also
+    # when they wrap around its end
+    output = io.BytesIO()
+    tracer = RingTracer(output, capacity=4, interval=3600)
+    for i in range(6):
+        tracer.record(SEND, i, 0, 1, -1, -1, 0)
+    assert tracer.lost == 2
+    tracer.flush()
+    for i in range(6, 9):
+        tracer.record(SEND, i, 0, 1, -1, -1, 0)
+    tracer.flush()
+    for i in range(9, 12):
+        tracer.record(SEND, i, 0, 1, -1, -1, 0)
+    tracer.close()
+    output.seek(0)
+    assert [record[2] for record in readTrace(output)] == [0, 1, 2, 3] + list(range(6, 12))
+    assert tracer.lost == 2
+
+    # the rings of several threads are merged by time
+    output = io.BytesIO()
+    tracer = RingTracer(output, interval=3600)
+    def run(connId):
+        for i in range(1000):
+            tracer.record(SEND, i, 0, connId, -1, -1, 0)
+    threads = [threading.Thread(target=run, args=(connId,)) for connId in (1, 2, 3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tracer.close()
+    output.seek(0)
+    records = list(readTrace(output))
+    assert tracer.lost == 0 and len(records) == 3000
+    assert all(a[0] <= b[0] for a, b in zip(records, records[1:]))
+    for connId in (1, 2, 3):
+        assert [record[2] for record in records if record[4] == connId] == list(range(1000))
+
+    # windows beyond int32 (an infinite ssthresh, a float cwnd) are clamped, in both forms
+    from .header import Header
+    output = io.BytesIO()
+    tracer = RingTracer(output, interval=3600)
+    tracer.packet(SEND, Header(1, 2, 3, ack=True), 1e12, float("inf"))
+    tracer.packet(RECV, Header(1, 2, 3, ack=True), 412.5, None)
+    tracer.close()
+    output.seek(0)
+    assert [record[5:7] for record in readTrace(output)] == [(WINDOW_MAX, WINDOW_MAX), (412, -1)]
+    output = io.StringIO()
+    TextTracer(stream=output).packet(SEND, Header(1, 2, 3, ack=True), float("inf"), 1 << 40)
+    assert output.getvalue() == f"SEND 1 2 3 {WINDOW_MAX} {WINDOW_MAX} ACK\n"
+    print("Test passed!")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Print binary Confundo traces as text lines")
+    parser.add_argument("files", nargs='*', help="files written by RingTracer / --trace-file")
+    parser.add_argument("--time", action="store_true", help="prefix each line with its timestamp")
+    parser.add_argument("--self-test", action="store_true", help="test the tracers and exit")
+    args = parser.parse_args()
+
+    if args.self_test:
+        selfTest()
+        return
+    if not args.files:
+        parser.error("the following arguments are required: files")
+
+    for path in args.files:
+        with open(path, 'rb') as f:
+            for (now, event, seq, ack, connId, cwnd, ssthresh, flags) in readTrace(f):
+                line = formatEvent(event, seq, ack, connId, cwnd, ssthresh, flags)
+                print(f"{now:.6f} {line}" if args.time else line)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
 
 MOD = 50000 + 1
+EXT_MOD = 1 << 32 # negotiated extended sequence numbers use the whole 32-bit header field
 def format_line(command, pkt, cwnd, ssthresh):
-    s = f"{command} {pkt.seqNum} {pkt.ackNum} {pkt.connId} {int(cwnd)} {ssthresh}"
+    s = f"{command} {pkt.seqNum} {pkt.ackNum} {pkt.connId} {int(cwnd)} {int(ssthresh)}"
     if pkt.isAck: s = s + " ACK"
     if pkt.isSyn: s = s + " SYN"
     if pkt.isFin: s = s + " FIN"
     if pkt.isDup: s = s + " DUP"
     return s
-def incSeqNum(seqNumber, bytes):
+def incSeqNum(seqNumber, bytes, mod=MOD):
     seqNumber += bytes
-    if seqNumber >= MOD:
-        seqNumber %= MOD
-    return seqNumber
\ No newline at end of file
+    if seqNumber >= mod:
+        seqNumber %= mod
+    return seqNumber
+def seqDiff(a, b, mod=MOD):
+    '''Distance from `b` forward to `a` in a sequence space of `mod` numbers'''
+    return (a - b) % mod
+def seqLess(a, b, mod=MOD):
+    '''Wraparound-safe a < b: `b` is less than half the sequence space ahead of `a` (RFC 1982)'''
+    return 0 < (b - a) % mod < mod // 2
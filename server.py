@@ -1,62 +1,570 @@
 import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
 import socket
 import sys
+import time
+from enum import Enum
 from confundo.header import Header
+from confundo.buffer import ReassemblyBuffer
+from confundo.delack import DelayedAck
+from confundo.batchio import BatchIO
+from confundo.pmtud import agreedMss, checkMss
+from confundo.sink import FileSink
+from confundo.session import SessionSink
+from confundo.stripe import StripeSink
+from confundo.common import EXT_MAX_REORDER_BYTES, GLOBAL_TIMEOUT, MAX_MSS, \
+    MAX_REORDER_BYTES, MTU, RETRANSMISSION_TIMEOUT
+from confundo.util import EXT_MOD, MOD, incSeqNum
+from confundo.trace import DROPPED, LEVELS, RECV, SEND, TextTracer, Tracer, makeTracer
+from confundo.metrics import Metrics, parseAddress, serve
+
+
+class ConnState(Enum):
+    SYN_RECEIVED = 1
+    OPEN = 2
+    FIN_WAIT = 3
+
+
+class Connection:
+    '''Per-connection state machine, keyed in the server by (client address, connection ID)'''
+
+    def __init__(self, conn_id, client_address, syn_seq_number, extended_seq=False, mss=MTU, delayed_ack=True):
+        self.conn_id = conn_id
+        self.client_address = client_address
+        self.extended_seq = extended_seq  # 32-bit sequence numbers, requested in the client's SYN
+        self.mss = mss  # largest segment the client may send, agreed in the handshake
+        self.mod = EXT_MOD if extended_seq else MOD
+        self.expected_seq_number = incSeqNum(syn_seq_number, 1, self.mod)
+        self.seq_number = 0
+        self.state = ConnState.SYN_RECEIVED
+        self.reassembly = ReassemblyBuffer(EXT_MAX_REORDER_BYTES if extended_seq else MAX_REORDER_BYTES, self.mod)
+        self.sack = False
+        self.session = False  # the data is a session of framed files, requested in the client's SYN
+        self.stripe = False  # the data is one range of a striped file, requested in the client's SYN
+        self.last_activity = time.time()
+        self.last_send_time = self.last_activity
+        self.sink = None  # FileSink (SessionSink, StripeSink) receiving the in-order data, None to discard it
+        self.advertised = None  # receive window sent in the last ACK
+        self.delayed_ack = DelayedAck(delayed_ack)  # when the ACK of received data may be held back
+
+        self.metrics = Metrics("connection", labels={'connId': conn_id, 'remote': client_address})
+        self.bytes_received = self.metrics.counter("bytes_received")
+        self.out_of_order = self.metrics.counter("out_of_order")
+        self.window_drops = self.metrics.counter("window_drops")  # segments beyond the advertised window
+        self.metrics.gauge("reassembly", lambda: len(self.reassembly))
+        self.metrics.gauge("window", self.window)
+        self.metrics.gauge("state", lambda: self.state.name)
+
+    def window(self):
+        '''Receive window: free space in the sink, 0 while less than a segment is free, None without a sink'''
+        if self.sink is None:
+            return None
+        free = self.sink.space()
+        return free if free >= self.mss else 0
+
 
 class ConfundoServer:
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, save_dir=None, tracer=None, sock=None, worker=0, workers=1, delayed_ack=True,
+                 mss=MAX_MSS, shared_conn_id=None):
         self.server_ip = ip
         self.server_port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.bind((ip, port))
-
-        self.conn_id = None
-        self.expected_seq_number = None
-
-    def send_packet(self, syn=False, ack=False, fin=False, ack_num=0, conn_id=0, client_address=None):
-        header = Header(0, ack_num, conn_id, ack, syn, fin)
-        packet = header.encode()
-        self.sock.sendto(packet, client_address)
-        print(f"SEND 0 {ack_num} {conn_id} - -", end=" ")
-        if ack: print("ACK", end=" ")
-        if syn: print("SYN", end=" ")
-        if fin: print("FIN", end=" ")
-        print()
+        self.save_dir = save_dir  # each connection's data is streamed to <save_dir>/<conn_id>.file
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((ip, port))
+        self.sock = sock  # already bound when given, e.g. one of the reuseport_sockets() of the workers
+        self.sock.settimeout(RETRANSMISSION_TIMEOUT)
+        self.io = BatchIO(self.sock)  # ACKs for a batch of received datagrams go out with one sendmmsg
+        self.tracer = tracer if tracer is not None else TextTracer()  # SEND/RECV lines on stdout by default
+
+        self.connections = {}  # (client_address, conn_id) -> Connection
+        self.handshakes = {}  # client_address -> Connection still waiting for the ACK of its SYN|ACK
+        self.delayed_ack = delayed_ack  # one ACK per DELAYED_ACK_SEGMENTS full in-order segments, or DELAYED_ACK_TIME
+        self.delayed_acks = {}  # Connection -> time its held-back ACK is due, earliest first
+        self.closing_sinks = {}  # Connection -> its closed sink, until the last write is over and checked
+        self.mss = checkMss(mss)  # largest segment offered in the SYN|ACK
+        # worker k of n hands out the connection IDs k+1, k+1+n, ... so that IDs (and the files
+        # named after them) are unique across the processes sharing the port
+        self.worker = worker
+        self.workers = workers
+        # with `shared_conn_id`, a multiprocessing.Value kept at next_conn_id, a restarted worker
+        # carries on after the IDs of the one it replaces instead of overwriting their files
+        self.shared_conn_id = shared_conn_id
+        self.next_conn_id = shared_conn_id.value if shared_conn_id is not None else worker + 1
+        self.wrapped = False  # next_conn_id went past 65535: the IDs it comes to may still be in use
+        self.last_housekeeping = time.time()
+
+        self.metrics = Metrics("server", labels={'port': port, 'worker': worker} if workers > 1 else {'port': port})
+        self.packets_received = self.metrics.counter("packets_received")
+        self.packets_sent = self.metrics.counter("packets_sent")
+        self.packets_dropped = self.metrics.counter("packets_dropped")  # no connection for them
+        self.bytes_received = self.metrics.counter("bytes_received")
+        self.connections_accepted = self.metrics.counter("connections_accepted")
+        self.connections_refused = self.metrics.counter("connections_refused")  # no sink or connection ID for them
+        self.metrics.gauge("connections", lambda: len(self.connections))
+        self.metrics.gauge("handshakes", lambda: len(self.handshakes))
+        self.metrics.gauge("sink_backlog", lambda: sum(conn.sink.capacity - conn.sink.space()
+                                                       for conn in list(self.connections.values()) if conn.sink))
+
+    def send_packet(self, syn=False, ack=False, fin=False, ack_num=0, conn_id=0, client_address=None, seq_num=0,
+                    sack_permitted=False, sack_blocks=(), window=None, extended_seq=False, mss=None, session=False,
+                    stripe=False):
+        header = Header(seq_num, ack_num, conn_id, ack, syn, fin, sack_permitted, sack_blocks, window, extended_seq,
+                        mss, session, stripe)
+        self.io.sendPacket(header, client_address)
+        self.packets_sent.inc()
+        if self.tracer.packets:
+            self.tracer.packet(SEND, header)
 
     def recv_packet(self):
-        data, client_address = self.sock.recvfrom(424)
-        header = Header.decode(data[:12])
-        print(f"RECV {header.sequence_number} {header.acknowledgment_number} {header.connection_id} - -", end=" ")
-        if header.ack: print("ACK", end=" ")
-        if header.syn: print("SYN", end=" ")
-        if header.fin: print("FIN", end=" ")
-        print()
-        return header, data[12:], client_address
-
-    def handle_connection(self):
-        header, flags, client_address= self.recv_packet()
-        if header.syn:
-            self.conn_id = header.connection_id + 1
-            self.expected_seq_number = header.sequence_number + 1
-            self.send_packet(syn=True, ack=True, ack_num=self.expected_seq_number, conn_id=self.conn_id, client_address=client_address)
-
-    def handle_data_transfer(self):
-        while True:
-            header, data, client_address = self.recv_packet()
-            if header.sequence_number == self.expected_seq_number:
-                # expected data received
-                self.expected_seq_number += len(data)
-                self.send_packet(ack=True, ack_num=self.expected_seq_number, conn_id=self.conn_id, client_address=client_address)
+        data, client_address = self.io.recvfrom()
+        header = Header()
+        header_length = header.decode_from(data)
+        self.packets_received.inc()
+        if self.tracer.packets:
+            self.tracer.packet(RECV, header)
+        return header, memoryview(data)[header_length:], client_address
+
+    def dispatch(self, header, data, client_address):
+        '''Route an incoming datagram to the state machine of its connection'''
+        if header.syn and header.connection_id == 0:
+            self.handle_connection(header, client_address)
+            return
+
+        conn = self.connections.get((client_address, header.connection_id))
+        if conn is None:
+            self.packets_dropped.inc()
+            if self.tracer.drops:
+                self.tracer.packet(DROPPED, header)
+            return
+        self.handle_data_transfer(conn, header, data)
+
+    def open_sink(self, conn_id, session, stripe):
+        '''Sink for the data of a new connection, None without save_dir; raises OSError if it cannot be opened'''
+        if self.save_dir is None:
+            return None
+        if stripe:
+            # the range goes to its place in DIR/<transfer>/<name>, whichever connection or worker carries it
+            return StripeSink(self.save_dir)
+        if session:
+            # every file of the session goes to DIR/<connId>/<name>
+            return SessionSink(os.path.join(self.save_dir, str(conn_id)))
+        return FileSink(os.path.join(self.save_dir, f"{conn_id}.file"))
+
+    def free_conn_id(self):
+        '''
+        next_conn_id, moved past the IDs that connections still use once the IDs have wrapped
+        around; None if this worker has none left
+        '''
+        if not self.wrapped:
+            return self.next_conn_id
+        in_use = {conn_id for (_, conn_id) in self.connections}
+        for _ in range(65535 // self.workers + 1):
+            if self.next_conn_id not in in_use:
+                return self.next_conn_id
+            self.step_conn_id()
+        return None
+
+    def step_conn_id(self):
+        self.next_conn_id += self.workers
+        if self.next_conn_id > 65535:
+            self.next_conn_id = self.worker + 1
+            self.wrapped = True
+        if self.shared_conn_id is not None:
+            self.shared_conn_id.value = self.next_conn_id
+
+    def refuse(self, client_address, reason):
+        '''Answer a SYN with a FIN instead of a SYN|ACK'''
+        sys.stderr.write(f"ERROR: refusing connection from {client_address[0]}:{client_address[1]}: {reason}\n")
+        self.connections_refused.inc()
+        self.send_packet(fin=True, client_address=client_address)
+
+    def handle_connection(self, header, client_address):
+        conn = self.handshakes.get(client_address)
+        if conn is None:
+            conn_id = self.free_conn_id()
+            if conn_id is None:
+                self.refuse(client_address, "no connection ID left")
+                return
+            stripe = header.stripe and not header.session
+            try:
+                sink = self.open_sink(conn_id, header.session, stripe)
+            except OSError as e:
+                # nowhere to put the data
+                self.refuse(client_address, e)
+                return
+            # segments are at most the smaller of both offers, MTU for a client that makes none
+            conn = Connection(conn_id, client_address, header.sequence_number, header.extended_seq,
+                              agreedMss(self.mss, header.mss), self.delayed_ack)
+            self.step_conn_id()
+            conn.sack = header.sack_permitted
+            conn.session = header.session
+            conn.stripe = stripe
+            conn.sink = sink
+            self.connections[(client_address, conn.conn_id)] = conn
+            self.handshakes[client_address] = conn
+            self.connections_accepted.inc()
+        # a retransmitted SYN gets the same SYN|ACK again
+        self.send_packet(syn=True, ack=True, seq_num=conn.seq_number, ack_num=conn.expected_seq_number,
+                         conn_id=conn.conn_id, client_address=client_address, sack_permitted=conn.sack,
+                         window=conn.window(), extended_seq=conn.extended_seq, mss=self.mss, session=conn.session,
+                         stripe=conn.stripe)
+        conn.last_send_time = time.time()
+
+    def handle_data_transfer(self, conn, header, data):
+        conn.last_activity = time.time()
+
+        if conn.state == ConnState.SYN_RECEIVED and (header.ack or data):
+            # ACK of our SYN|ACK (possibly lost, but then the client is already sending data)
+            conn.state = ConnState.OPEN
+            conn.seq_number = incSeqNum(conn.seq_number, 1, conn.mod)
+            self.handshakes.pop(conn.client_address, None)
+
+        if conn.state == ConnState.FIN_WAIT and header.ack and \
+           header.acknowledgment_number == incSeqNum(conn.seq_number, 1, conn.mod):
+            # our FIN is acknowledged, the connection is done
+            del self.connections[(conn.client_address, conn.conn_id)]
+            self.delayed_acks.pop(conn, None)
+            conn.metrics.close()
+            return
+
+        if not data and not header.fin:
+            return
+
+        delay = False
+        if conn.sink is not None and len(data) > conn.sink.space():
+            # the disk is behind and the segment is beyond the advertised window: drop it (the
+            # duplicate ACK below carries the window) instead of buffering it or waiting for the write
+            conn.window_drops.inc()
+        elif header.sequence_number == conn.expected_seq_number:
+            # expected data received, FIN consumes one sequence number
+            conn.expected_seq_number = incSeqNum(conn.expected_seq_number, len(data) + (1 if header.fin else 0),
+                                                conn.mod)
+            self.deliver(conn, data)
             if header.fin:
+                conn.state = ConnState.FIN_WAIT
+                self.close_sink(conn)
+            else:
+                # segments buffered out of order may now be contiguous, ACK all of them at once
+                conn.expected_seq_number, payloads = conn.reassembly.pull(conn.expected_seq_number)
+                for payload in payloads:
+                    self.deliver(conn, payload)
+                delay = conn.delayed_ack.on_segment(len(data), not payloads and len(conn.reassembly) == 0,
+                                                    conn.window() != 0)
+        elif data:
+            conn.out_of_order.inc()
+            conn.reassembly.add(conn.expected_seq_number, header.sequence_number, data,
+                                limit=conn.sink.space() if conn.sink is not None else None)
+        if delay:
+            self.delayed_acks.setdefault(conn, conn.delayed_ack.deadline)
+            return
+        # out-of-order segments are answered with a duplicate ACK, reporting what is buffered in SACK blocks
+        sack_blocks = conn.reassembly.blocks(conn.expected_seq_number) if conn.sack else ()
+        self.send_ack(conn, sack_blocks)
+        if conn.state == ConnState.FIN_WAIT:
+            self.send_fin(conn)
+
+    def send_ack(self, conn, sack_blocks=()):
+        conn.advertised = conn.window()
+        conn.delayed_ack.on_ack_sent()
+        self.delayed_acks.pop(conn, None)
+        self.send_packet(ack=True, seq_num=conn.seq_number, ack_num=conn.expected_seq_number,
+                         conn_id=conn.conn_id, client_address=conn.client_address, sack_blocks=sack_blocks,
+                         window=conn.advertised)
+
+    def deliver(self, conn, data):
+        conn.bytes_received.inc(len(data))
+        self.bytes_received.inc(len(data))
+        if conn.sink is not None:
+            conn.sink.write(data)
+
+    def close_sink(self, conn):
+        '''Close the sink of `conn`; the last write ends in the background, check_sinks() reports its error'''
+        if conn.sink is not None and conn not in self.closing_sinks:
+            conn.sink.close()
+            self.closing_sinks[conn] = conn.sink
+
+    def check_sinks(self):
+        '''Report the write errors of closed sinks whose last write is over, even if the connection is gone'''
+        for conn, sink in list(self.closing_sinks.items()):
+            if sink.finished:
+                del self.closing_sinks[conn]
+                if sink.error is not None:
+                    sys.stderr.write(f"ERROR: writing connection {conn.conn_id}: {sink.error}\n")
+
+    def send_fin(self, conn):
+        # the FIN also acknowledges the client's, whose ACK may have been lost: once the client ACKs
+        # this FIN the connection is gone, and a retransmitted FIN of the client would go unanswered
+        self.send_packet(fin=True, ack=True, seq_num=conn.seq_number, ack_num=conn.expected_seq_number,
+                         conn_id=conn.conn_id, client_address=conn.client_address)
+        conn.last_send_time = time.time()
+
+    def send_delayed_acks(self, now):
+        '''Send the ACKs held back for DELAYED_ACK_TIME'''
+        while self.delayed_acks:
+            conn, due = next(iter(self.delayed_acks.items()))
+            if due > now:
                 break
+            self.send_ack(conn)
+
+    def housekeeping(self):
+        '''Retransmit unacknowledged FINs and SYN|ACKs, expire idle connections'''
+        now = time.time()
+        self.check_sinks()
+        for key, conn in list(self.connections.items()):
+            if conn.sink is not None:
+                conn.sink.flush()  # periodic write-behind, also for connections that went quiet
+                if conn.state == ConnState.OPEN and conn.advertised is not None and \
+                   conn.advertised < conn.mss <= conn.window():
+                    self.send_ack(conn)  # the disk caught up: reopen the window without waiting for a probe
+            if now - conn.last_activity > GLOBAL_TIMEOUT:
+                self.close_sink(conn)
+                del self.connections[key]
+                self.delayed_acks.pop(conn, None)
+                conn.metrics.close()
+                if self.handshakes.get(conn.client_address) is conn:
+                    del self.handshakes[conn.client_address]
+            elif now - conn.last_send_time > RETRANSMISSION_TIMEOUT:
+                if conn.state == ConnState.FIN_WAIT:
+                    self.send_fin(conn)
+                elif conn.state == ConnState.SYN_RECEIVED:
+                    self.send_packet(syn=True, ack=True, seq_num=conn.seq_number, ack_num=conn.expected_seq_number,
+                                     conn_id=conn.conn_id, client_address=conn.client_address,
+                                     sack_permitted=conn.sack, window=conn.window(), extended_seq=conn.extended_seq,
+                                     mss=self.mss, session=conn.session, stripe=conn.stripe)
+                    conn.last_send_time = now
+        self.last_housekeeping = now
 
     def run(self):
-        print(f"Server listening on {self.server_ip}:{self.server_port}")
+        worker = f" (worker {self.worker + 1}/{self.workers})" if self.workers > 1 else ""
+        print(f"Server listening on {self.server_ip}:{self.server_port}{worker}")
+        timeout = RETRANSMISSION_TIMEOUT
         while True:
-            self.handle_connection()
-            self.handle_data_transfer()
+            if not self.io.inQueue and (self.delayed_acks or timeout != RETRANSMISSION_TIMEOUT):
+                # about to block: wake up in time for the earliest delayed ACK (delays are equal, so it
+                # is the oldest)
+                timeout = RETRANSMISSION_TIMEOUT
+                if self.delayed_acks:
+                    due = next(iter(self.delayed_acks.values()))
+                    timeout = min(max(due - time.time(), 0.001), RETRANSMISSION_TIMEOUT)
+                self.sock.settimeout(timeout)
+            try:
+                header, data, client_address = self.recv_packet()
+                self.dispatch(header, data, client_address)
+            except socket.timeout:
+                pass
+            if self.delayed_acks:
+                self.send_delayed_acks(time.time())
+            if time.time() - self.last_housekeeping > RETRANSMISSION_TIMEOUT:
+                self.housekeeping()
 
-if __name__ == "__main__":
-    server = ConfundoServer("0.0.0.0", 5000)
+
+def reuseport_sockets(ip, port, count):
+    '''
+    `count` UDP sockets bound to the same port with SO_REUSEPORT.  The kernel spreads the
+    datagrams over them by a hash of the source address and port, so every datagram of a
+    client, and thus of its connection, reaches the same socket.
+    '''
+    socks = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((ip, port))
+        socks.append(sock)
+    return socks
+
+
+def start_server(args, sock=None, worker=0, shared_conn_id=None):
+    '''Run the server of process `worker` of args.workers on `sock` (a socket of its own when None)'''
+    trace_file, metrics = args.trace_file, args.metrics and parseAddress(args.metrics)
+    if args.workers > 1:
+        sys.stdout.reconfigure(line_buffering=True)  # trace lines of different workers do not interleave
+        if trace_file is not None:
+            trace_file = f"{trace_file}.{worker}"
+        if isinstance(metrics, str):
+            metrics = f"{metrics}.{worker}"
+        elif metrics:
+            metrics = (metrics[0], metrics[1] + worker)
+    if trace_file is not None:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # exit handlers write out the trace
+    server = ConfundoServer("0.0.0.0", args.port, args.dir, makeTracer(LEVELS[args.trace], trace_file), sock,
+                            worker, args.workers, delayed_ack=not args.no_delayed_ack, mss=args.mss,
+                            shared_conn_id=shared_conn_id)
+    if metrics:
+        serve(metrics)
     server.run()
+
+
+def run_worker(args, sock, worker, shared_conn_id):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole process group, the supervisor stops us
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    start_server(args, sock, worker, shared_conn_id)
+
+
+def run_workers(args):
+    '''
+    Serve from args.workers processes, one per SO_REUSEPORT socket: every connection stays
+    with the worker its client's datagrams hash to, so the workers share no state.  The
+    sockets are bound here before the workers are forked and stay open in this process, so a
+    worker that dies is restarted on the same socket and the connections still map to it.
+    Each worker's next connection ID is kept in shared memory, so the restarted worker does
+    not hand out the IDs, and reuse the file names, of the one it replaces.
+    '''
+    socks = reuseport_sockets("0.0.0.0", args.port, args.workers)
+    context = multiprocessing.get_context("fork")  # the workers inherit their bound socket
+    conn_ids = [context.RawValue('i', worker + 1) for worker in range(args.workers)]
+
+    def start(worker):
+        process = context.Process(target=run_worker, args=(args, socks[worker], worker, conn_ids[worker]),
+                                  name=f"confundo-worker-{worker}")
+        process.start()
+        return process
+
+    processes = [start(worker) for worker in range(args.workers)]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+            for worker, process in enumerate(processes):
+                if process.exitcode is not None:
+                    sys.stderr.write(f"ERROR: worker {worker} exited with code {process.exitcode}, restarting it\n")
+                    time.sleep(1)  # no busy loop if it keeps failing
+                    processes[worker] = start(worker)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+def self_test():
+    import io
+    import tempfile
+
+    class CaptureIO:
+        '''Stands in for a server's BatchIO: keeps the packets it would send'''
+
+        def __init__(self):
+            self.sent = []  # (header, client address)
+
+        def sendPacket(self, header, address, payload=None):
+            self.sent.append((header, address))
+
+    # the workers' sockets share the port, and the workers hand out disjoint connection IDs
+    socks = reuseport_sockets("127.0.0.1", 0, 1)
+    port = socks[0].getsockname()[1]
+    socks += reuseport_sockets("127.0.0.1", port, 2)
+    assert all(sock.getsockname()[1] == port for sock in socks)
+    conn_ids = set()
+    for worker, sock in enumerate(socks):
+        server = ConfundoServer("127.0.0.1", port, tracer=Tracer(), sock=sock, worker=worker, workers=len(socks))
+        server.io = CaptureIO()
+        for client in range(100):
+            server.handle_connection(Header(1000, syn=True), ("127.0.0.1", 20000 + client))
+        server.handle_connection(Header(1000, syn=True), ("127.0.0.1", 20000))  # retransmitted SYN
+        ids = [header.connection_id for header, _ in server.io.sent]
+        assert ids[-1] == ids[0] and len(set(ids)) == 100
+        assert all(conn_id % len(socks) == (worker + 1) % len(socks) for conn_id in ids)
+        conn_ids.update(ids)
+        sock.close()
+    assert len(conn_ids) == 300
+
+    # past 65535 the IDs start over, skipping those still in use
+    server = ConfundoServer("127.0.0.1", 0, tracer=Tracer())
+    server.io = CaptureIO()
+    for client in range(2):
+        server.handle_connection(Header(1000, syn=True), ("127.0.0.1", 20000 + client))
+    server.next_conn_id = 65535
+    for client in range(2, 4):
+        server.handle_connection(Header(1000, syn=True), ("127.0.0.1", 20000 + client))
+    assert [header.connection_id for header, _ in server.io.sent] == [1, 2, 65535, 3]
+    server.sock.close()
+
+    # delayed ACKs: one per two full segments or after the delay, right away for a gap
+    server = ConfundoServer("127.0.0.1", 0, tracer=Tracer())
+    server.io = CaptureIO()
+    client = ("127.0.0.1", 30000)
+    server.handle_connection(Header(1000, syn=True), client)
+    conn_id = server.io.sent[0][0].connection_id
+    server.dispatch(Header(1001, 1, conn_id, ack=True), b'', client)  # ACK of the SYN|ACK
+
+    def segment(offset):
+        del server.io.sent[:]
+        server.dispatch(Header(1001 + offset, 1, conn_id, ack=True), bytes(MTU), client)
+        return [header.acknowledgment_number for header, _ in server.io.sent]
+
+    assert segment(0) == []
+    delay = server.connections[(client, conn_id)].delayed_ack.delay
+    server.send_delayed_acks(time.time())
+    assert server.io.sent == []
+    server.send_delayed_acks(time.time() + delay)
+    assert [header.acknowledgment_number for header, _ in server.io.sent] == [1001 + MTU]
+    assert segment(MTU) == [] and segment(2 * MTU) == [1001 + 3 * MTU] and not server.delayed_acks
+    assert segment(4 * MTU) == [1001 + 3 * MTU]  # out of order: duplicate ACK
+    assert segment(3 * MTU) == [1001 + 5 * MTU]  # fills the gap
+
+    # the FIN that answers the client's acknowledges it as well
+    server.dispatch(Header(1001 + 5 * MTU, 1, conn_id, ack=True, fin=True), b'', client)
+    fin = server.io.sent[-1][0]
+    assert fin.fin and fin.ack and fin.acknowledgment_number == 1001 + 5 * MTU + 1
+    server.sock.close()
+
+    # a sink that cannot be opened refuses the connection, the server carries on
+    with tempfile.NamedTemporaryFile() as regular:
+        server = ConfundoServer("127.0.0.1", 0, save_dir=os.path.join(regular.name, "out"), tracer=Tracer())
+        server.io = CaptureIO()
+        stderr, sys.stderr = sys.stderr, io.StringIO()  # ENOTDIR: save_dir is under a regular file
+        try:
+            server.handle_connection(Header(1000, syn=True), client)
+        finally:
+            sys.stderr = stderr
+        (refusal, _), = server.io.sent
+        assert refusal.fin and not refusal.syn and refusal.connection_id == 0
+        assert not server.connections and not server.handshakes and server.next_conn_id == 1
+        assert server.connections_refused.value == 1
+        server.sock.close()
+    print("Test passed!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Confundo server")
+    parser.add_argument("port", nargs="?", type=int, default=5000, help="Set Port Number")
+    parser.add_argument("dir", nargs="?", default=None,
+                        help="Save the data of each connection to DIR/<connId>.file, the files of a session to "
+                             "DIR/<connId>/<name>, a striped file to DIR/<transfer>/<name>")
+    parser.add_argument("--trace", choices=LEVELS, default="packet", help="Trace every packet, only drops, or nothing")
+    parser.add_argument("--trace-file", default=None,
+                        help="Record the trace in binary form to TRACE_FILE from a background thread instead of printing it")
+    parser.add_argument("--metrics", default=None, metavar="ADDR",
+                        help="Export metrics over HTTP on [HOST:]PORT, or on the Unix socket at path ADDR")
+    parser.add_argument("--no-delayed-ack", action="store_true", help="Acknowledge every data segment right away")
+    parser.add_argument("--mss", type=int, default=MAX_MSS, help="Largest segment to offer in the handshake (bytes)")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="Serve from N processes sharing the port with SO_REUSEPORT (Linux); worker K "
+                             "traces to TRACE_FILE.K and exports metrics on PORT+K or PATH.K")
+    parser.add_argument("--self-test", action="store_true", help="Test the connection handling and exit")
+    args = parser.parse_args()
+    if args.self_test:
+        self_test()
+        sys.exit(0)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        checkMss(args.mss)
+    except ValueError as e:
+        parser.error(f"--{e}")
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--workers needs SO_REUSEPORT")
+
+    if args.dir is not None:
+        os.makedirs(args.dir, exist_ok=True)
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        start_server(args)